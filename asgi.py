@@ -0,0 +1,26 @@
+"""
+Asynchronous Server Gateway Interface (ASGI) entry point
+
+The read endpoints run on asyncio with an async engine, every other
+request runs the Flask app in a pool of WSGI_THREADS threads. Serve it with
+uvicorn asgi:app or gunicorn -k uvicorn_worker.UvicornWorker asgi:app
+"""
+
+import os
+from a2wsgi import WSGIMiddleware
+from service import create_app
+
+PORT = int(os.getenv("PORT", "8080"))
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", "10"))
+
+flask_app = create_app()
+
+# The routes are imported by create_app, inside the application context
+from service.async_routes import AsyncReads  # noqa: E402 pylint: disable=wrong-import-position
+
+app = AsyncReads(flask_app, WSGIMiddleware(flask_app, workers=WSGI_THREADS))
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
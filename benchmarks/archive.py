@@ -0,0 +1,99 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Benchmark of looking promotions up in the archive
+
+Usage: python -m benchmarks.archive [--rows 1000000] [--batch-size 1000] [--block-size 64] [--fanout 8]
+
+Writes --rows generated promotions to a scratch archive in segments of
+--batch-size promotions, like flask promotions-archive, then prints the
+size of the archive against the NDJSON it holds, and the median latency
+of looking up one archived id, a missing id, and a page of 50 ids, before
+and after the segments are merged in tiers of --fanout.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+from service.models import Promotion
+from service.common.archive import Archive, compact, write_segment
+from service.common.bulk import batched, generate_promotions
+
+
+def write(directory: str, rows: int, batch_size: int, block_size: int) -> list[str]:
+    """Writes rows generated promotions as segments, returning their ids and printing the sizes"""
+    ids = []
+    raw = 0
+    start = time.perf_counter()
+    for batch in batched(generate_promotions(rows, seed=49), batch_size):
+        promotions = [Promotion.serialize(SimpleNamespace(**{"external_id": None, "version": 1, **row})) for row in batch]
+        raw += sum(len(json.dumps(promotion)) + 1 for promotion in promotions)
+        ids.extend(promotion["id"] for promotion in promotions)
+        write_segment(directory, promotions, block_size)
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    print(f"Wrote {rows} promotions in {elapsed:.1f} s: {size / 2**20:.1f} MiB for {raw / 2**20:.1f} MiB of NDJSON")
+    return ids
+
+
+def measure(archive: Archive, lookups: list[list[uuid.UUID]]) -> float:
+    """Returns the median seconds of looking up each list of ids"""
+    timings = []
+    for ids in lookups:
+        start = time.perf_counter()
+        archive.find(ids)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    """Writes an archive, then times the lookups"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--block-size", type=int, default=64)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=1000)
+    options = parser.parse_args()
+    rng = random.Random(49)
+    with tempfile.TemporaryDirectory() as directory:
+        ids = [uuid.UUID(promotion_id) for promotion_id in write(directory, options.rows, options.batch_size,
+                                                                 options.block_size)]
+        cases = {
+            "archived id": [[rng.choice(ids)] for _ in range(options.repeat)],
+            "missing id": [[uuid.uuid4()] for _ in range(options.repeat)],
+            "50 archived ids": [rng.sample(ids, 50) for _ in range(options.repeat // 10)],
+        }
+        for step in ("written", "merged"):
+            if step == "merged":
+                start = time.perf_counter()
+                merged = compact(directory, options.fanout, options.block_size)
+                print(f"Merged {merged} segments in {time.perf_counter() - start:.1f} s")
+            archive = Archive(directory)
+            print(f"{len(archive.segments())} segments {step}")
+            archive.find(ids[::options.batch_size])  # maps the segments outside of the timings
+            for name, lookups in cases.items():
+                print(f"{name:<16}{measure(archive, lookups) * 1e6:10.0f} us")
+            archive.close()
+
+
+if __name__ == "__main__":
+    main()
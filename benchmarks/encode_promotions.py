@@ -0,0 +1,70 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Benchmark of the JSON encoders on a list of promotions
+
+Usage: python -m benchmarks.encode_promotions [--count 10000] [--repeat 5]
+
+Needs the same DATABASE_URI as the service because importing the app
+connects to the database.
+"""
+import argparse
+import time
+from flask_restx import marshal
+from wsgi import app
+from service.models import Promotion
+from service.routes import promotion_model, promotion_serializer
+from service.common.bulk import generate_promotions
+from service.common.encoders import ENCODERS
+
+
+def best_of(repeat: int, func, *args) -> float:
+    """Returns the fastest of repeat runs of func in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    """Times the serializers, then every encoder on the marshalled list and on the raw column values"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    rows = list(generate_promotions(options.count))
+    promotions = [Promotion(**row) for row in rows]
+    with app.app_context():
+        elapsed = best_of(options.repeat, lambda: marshal([p.serialize() for p in promotions], promotion_model))
+        print(f"{'serialize + marshal':<24}{elapsed * 1000:10.1f} ms {options.count / elapsed:12,.0f} rows/s")
+        elapsed = best_of(options.repeat, promotion_serializer(many=True), promotions)
+        print(f"{'compiled serializer':<24}{elapsed * 1000:10.1f} ms {options.count / elapsed:12,.0f} rows/s")
+        marshalled = marshal([p.serialize() for p in promotions], promotion_model)
+        for name, encoder in ENCODERS.items():
+            for label, data in (("marshalled", marshalled), ("raw", rows)):
+                elapsed = best_of(options.repeat, encoder, data)
+                size = len(encoder(data))
+                print(
+                    f"{name + ' ' + label:<24}{elapsed * 1000:10.1f} ms {options.count / elapsed:12,.0f} rows/s"
+                    f"{size / elapsed / 2**20:10.1f} MiB/s"
+                )
+
+
+if __name__ == "__main__":
+    main()
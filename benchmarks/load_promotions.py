@@ -0,0 +1,193 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Load test of the read endpoints served by one sync and one async worker
+
+Usage: python -m benchmarks.load_promotions [--count 10000] [--concurrency 1,8,32,128]
+
+Loads generated promotions with COPY until the table holds --count rows,
+then starts one worker at a time, the way a pod runs it: gunicorn with a
+single sync worker and with a single gthread worker of 8 threads on
+wsgi:app, and uvicorn with a single worker on asgi:app. Each worker gets GET /api/promotions/{id} and filtered
+GET /api/promotions?name=...&view=summary requests from every level of
+--concurrency clients for --duration seconds, and the throughput and
+latency percentiles are printed. Use --url to load an already running
+server instead.
+
+With --db-latency the workers reach the database through a local proxy
+delaying every reply of the database, like a database on another host.
+"""
+import argparse
+import asyncio
+import http.client
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote_plus, urlsplit
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from wsgi import app
+from service.models import db, Promotion
+from service.common.bulk import copy_promotions, generate_promotions
+
+SERVERS = {
+    "sync": [
+        "gunicorn", "--worker-class", "sync", "--workers", "1", "--threads", "1", "--bind", "127.0.0.1:{port}", "wsgi:app",
+    ],
+    "gthread": [
+        "gunicorn", "--worker-class", "gthread", "--workers", "1", "--threads", "8", "--bind", "127.0.0.1:{port}", "wsgi:app",
+    ],
+    "async": ["uvicorn", "--workers", "1", "--port", "{port}", "--no-access-log", "asgi:app"],
+}
+
+
+async def _pipe(reader, writer, delay: float):
+    """Copies a stream, writing every chunk delay seconds after it was read"""
+    loop = asyncio.get_running_loop()
+    while data := await reader.read(65536):
+        loop.call_later(delay, writer.write, data)
+    loop.call_later(delay, writer.close)
+
+
+def start_latency_proxy(database_uri: str, delay: float) -> str:
+    """Starts a proxy delaying the replies of the database, returning the database URI through it"""
+    url = make_url(database_uri)
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection(url.host, url.port or 5432)
+        await asyncio.gather(_pipe(client_reader, server_writer, 0), _pipe(server_reader, client_writer, delay))
+
+    loop = asyncio.new_event_loop()
+    proxy = loop.run_until_complete(asyncio.start_server(handle, "127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    port = proxy.sockets[0].getsockname()[1]
+    return url.set(host="127.0.0.1", port=port).render_as_string(hide_password=False)
+
+
+def sample_paths(size: int = 1000) -> list:
+    """Returns a random mix of single and filtered list reads of existing promotions"""
+    with app.app_context():
+        rows = db.session.execute(
+            select(Promotion.id, Promotion.name).order_by(func.random()).limit(size)  # pylint: disable=not-callable
+        ).all()
+    return [
+        f"/api/promotions/{row.id}" if index % 2 else f"/api/promotions?name={quote_plus(row.name)}&view=summary"
+        for index, row in enumerate(rows)
+    ]
+
+
+def client(url: str, paths: list, deadline: float) -> tuple:
+    """Sends requests on one keep-alive connection until the deadline, returning latencies and errors"""
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+    latencies, errors = [], 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            connection.request("GET", random.choice(paths))
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+    return latencies, errors
+
+
+def load(url: str, paths: list, concurrency: int, duration: float):
+    """Runs concurrency clients for duration seconds, printing throughput and latencies"""
+    deadline = time.perf_counter() + duration
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda _: client(url, paths, deadline), range(concurrency)))
+    latencies = sorted(latency for result in results for latency in result[0])
+    errors = sum(result[1] for result in results)
+
+    def percentile(fraction: float) -> float:
+        return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+    print(
+        f"{concurrency:6d} clients {len(latencies) / duration:8.0f} req/s "
+        f"p50 {percentile(0.50):7.1f} ms  p99 {percentile(0.99):7.1f} ms  {errors} errors"
+    )
+
+
+def wait_until_ready(url: str, timeout: float = 30):
+    """Waits until the server answers its health check"""
+    parts = urlsplit(url)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=1)
+            connection.request("GET", "/health")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start")
+
+
+def main():
+    """Loads the promotions, then loads every server with every level of concurrency"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--concurrency", default="1,8,32,128")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--db-latency", type=float, default=0, help="milliseconds added to every database reply")
+    parser.add_argument("--server", choices=SERVERS, action="append")
+    parser.add_argument("--url")
+    options = parser.parse_args()
+    levels = [int(level) for level in options.concurrency.split(",")]
+
+    with app.app_context():
+        existing = db.session.scalar(select(func.count()).select_from(Promotion))  # pylint: disable=not-callable
+        if existing < options.count:
+            copy_promotions(generate_promotions(options.count - existing, seed=existing))
+    paths = sample_paths()
+    print(f"{options.count} promotions")
+
+    if options.url:
+        for concurrency in levels:
+            load(options.url, paths, concurrency, options.duration)
+        return
+
+    env = dict(os.environ)
+    if options.db_latency:
+        env["DATABASE_URI"] = start_latency_proxy(app.config["SQLALCHEMY_DATABASE_URI"], options.db_latency / 1000)
+        print(f"{options.db_latency} ms database latency")
+
+    for name in options.server or SERVERS:
+        url = f"http://127.0.0.1:{options.port}"
+        command = [part.format(port=options.port) for part in SERVERS[name]]
+        with subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as server:
+            try:
+                wait_until_ready(url)
+                print(f"{name}: {' '.join(command)}")
+                for concurrency in levels:
+                    load(url, paths, concurrency, options.duration)
+            finally:
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
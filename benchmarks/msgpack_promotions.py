@@ -0,0 +1,64 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Benchmark of MessagePack against JSON on a list of promotions
+
+Usage: python -m benchmarks.msgpack_promotions [--count 10000] [--repeat 5]
+
+Compares the payload size, the time to serialize and encode the list the
+way the list endpoint does, and the time a client takes to decode it.
+"""
+import argparse
+import gzip
+import json
+from types import SimpleNamespace
+import msgpack
+from wsgi import app
+from service.routes import promotion_serializer
+from service.common.bulk import generate_promotions
+from service.common.encoders import ENCODERS, dumps_msgpack, orjson
+from benchmarks.encode_promotions import best_of
+
+
+def main():
+    """Prints size, encode and decode time of every format"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    # Rows as the list endpoint reads them for MessagePack, with native UUIDs
+    rows = [SimpleNamespace(external_id=None, **row) for row in generate_promotions(options.count)]
+    text_serializer = promotion_serializer(many=True)
+    native_serializer = promotion_serializer(many=True, native=True)
+    decoders = {"json": json.loads, "orjson": getattr(orjson, "loads", None)}
+    formats = {name: (text_serializer, encoder, decoders[name]) for name, encoder in ENCODERS.items()}
+    formats["msgpack"] = (native_serializer, dumps_msgpack, lambda body: msgpack.unpackb(body, timestamp=3))
+
+    with app.app_context():
+        print(f"{'format':<10}{'size':>10}{'gzipped':>10}{'encode':>12}{'decode':>12}")
+        for name, (serialize, encode, decode) in formats.items():
+            body = encode(serialize(rows))
+            encode_time = best_of(options.repeat, lambda: encode(serialize(rows)))  # pylint: disable=cell-var-from-loop
+            decode_time = best_of(options.repeat, decode, body)
+            print(
+                f"{name:<10}{len(body) / 2**20:8.2f}MB{len(gzip.compress(body)) / 2**20:8.2f}MB"
+                f"{encode_time * 1000:9.1f} ms{decode_time * 1000:9.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Benchmark of the current promotion queries on the partitioned table and on a flat one
+
+Usage: python -m benchmarks.partitions [--rows 2000000] [--years 5] [--repeat 20]
+
+Replaces the promotions with --rows generated ones whose dates are spread
+over --years years of history and one year ahead, so most of them expired
+long ago. A flat copy of the table with the same indexes is made, then the
+queries of the current promotions run --repeat times on both tables, and
+the median latency and the buffers read by one run are printed, along with
+the lookups by id, through promotion_key and by the id alone. Run it on a
+scratch database.
+"""
+import argparse
+import json
+import re
+import statistics
+import time
+from datetime import timedelta
+from sqlalchemy import func, select, text
+from wsgi import app
+from service.models import db, promotion_key, Promotion, utc_now
+from service.common import partitions
+from service.common.bulk import SEED_BASE_DATE, SEED_DAYS_SPREAD, copy_promotions, generate_promotions
+
+FLAT = f"{Promotion.__tablename__}_flat"
+SUMMARY = ("id", "name", "start_date", "end_date", "active_status")
+
+
+def spread(promotions, years: int):
+    """Moves the dates of generated promotions over years of history and one year ahead"""
+    first = partitions.month_start(utc_now()) - timedelta(days=365 * years)
+    scale = 365 * (years + 1) / SEED_DAYS_SPREAD
+    for promotion in promotions:
+        length = promotion["end_date"] - promotion["start_date"]
+        promotion["start_date"] = first + (promotion["start_date"] - SEED_BASE_DATE) * scale
+        promotion["end_date"] = promotion["start_date"] + length
+        promotion["created_at"] = promotion["updated_at"] = promotion["start_date"] - timedelta(days=1)
+        yield promotion
+
+
+def load(rows: int, years: int):
+    """Replaces the promotions with rows spread over the years, and copies them into a flat table"""
+    first = partitions.month_start(utc_now()) - timedelta(days=365 * years)
+    with db.engine.begin() as connection:
+        # TRUNCATE fires no trigger, so the keys go with the promotions
+        connection.execute(text(f"TRUNCATE {Promotion.__tablename__}, {promotion_key.name}"))
+        partitions.ensure_partitions(connection, app.config["PARTITION_MONTHS_AHEAD"], since=first)
+    start = time.perf_counter()
+    copy_promotions(spread(generate_promotions(rows, seed=48), years))
+    print(f"Loaded {rows} promotions in {time.perf_counter() - start:.0f} s")
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {FLAT}"))
+        connection.execute(text(f"CREATE TABLE {FLAT} (LIKE {Promotion.__tablename__} INCLUDING DEFAULTS INCLUDING INDEXES)"))
+        connection.execute(text(f"INSERT INTO {FLAT} SELECT * FROM {Promotion.__tablename__}"))
+        for table in (Promotion.__tablename__, FLAT):
+            connection.execute(text(f"VACUUM ANALYZE {table}"))
+
+
+def queries(promotion_id) -> dict:
+    """Returns the SQL of the current promotion queries, as the list endpoint builds them, and of a lookup by id"""
+    now = utc_now()
+    columns = [Promotion.__table__.c[name] for name in SUMMARY]
+    statements = {
+        "count current": Promotion.find_by_date_range(
+            select(func.count()).select_from(Promotion), now, now  # pylint: disable=not-callable
+        ),
+        "list current": Promotion.find_by_date_range(select(*columns), now, now),
+        "ending this week": Promotion.find_by_end_date(
+            select(*columns).where(Promotion.end_date >= now), now + timedelta(days=7)
+        ),
+        # Reads the end_date from promotion_key, so only the partition of the promotion is read
+        "find by id": select(*columns).where(*Promotion.by_id(promotion_id)),
+        # Probes the primary key of every partition, its end_date is not known
+        "find by id alone": select(*columns).where(Promotion.id == promotion_id),
+    }
+    return {
+        name: str(statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+        for name, statement in statements.items()
+    }
+
+
+def measure(connection, sql: str, repeat: int) -> tuple[float, int]:
+    """Runs a query repeat times, returning the median seconds and the buffers of one run"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        connection.execute(text(sql)).all()
+        timings.append(time.perf_counter() - start)
+    plan = connection.scalar(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}"))
+    plan = (plan if isinstance(plan, list) else json.loads(plan))[0]["Plan"]
+    return statistics.median(timings), plan["Shared Hit Blocks"] + plan["Shared Read Blocks"]
+
+
+def main():
+    """Loads the history, then times the current promotion queries on both tables"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--no-load", action="store_true", help="Reuse the promotions of the last run")
+    options = parser.parse_args()
+    with app.app_context():
+        if not options.no_load:
+            load(options.rows, options.years)
+        with db.engine.connect() as connection:
+            promotion_id = connection.scalar(select(Promotion.id).limit(1))
+            for name, sql in queries(promotion_id).items():
+                for table in (Promotion.__tablename__, FLAT):
+                    on_table = re.sub(rf"\b{Promotion.__tablename__}\b", table, sql)
+                    seconds, buffers = measure(connection, on_table, options.repeat)
+                    print(f"{name:<18}{table:<16}{seconds * 1000:9.2f} ms {buffers:9d} buffers")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Benchmark of listing promotions through the ORM and through Core rows
+
+Usage: python -m benchmarks.read_promotions [--count 100000]
+
+Loads generated promotions with COPY until the table holds --count rows,
+then measures each read path in a fresh process: the latency and peak
+memory of building the response body of GET /api/promotions, from ORM
+instances, from Core rows, and streamed from a server-side cursor.
+"""
+import argparse
+import resource
+import subprocess
+import sys
+import time
+from sqlalchemy import func, select
+from wsgi import app
+from service.models import db, Promotion
+from service.routes import promotion_serializer
+from service.common.bulk import copy_promotions, generate_promotions
+from service.common.encoders import get_encoder, output_json_array
+
+
+def read_orm() -> int:
+    """Loads ORM instances, then serializes and encodes them in one body"""
+    promotions = Promotion.find_by_filters(Promotion.query, {}).all()
+    return len(get_encoder()(promotion_serializer(many=True)(promotions)))
+
+
+def read_rows() -> int:
+    """Loads Core rows, then serializes and encodes them in one body"""
+    rows = db.session.execute(select(*Promotion.__table__.c)).all()
+    return len(get_encoder()(promotion_serializer(many=True)(rows)))
+
+
+def read_stream() -> int:
+    """Streams Core rows batch by batch like GET /api/promotions"""
+    batches = Promotion.stream_rows({}, app.config["LIST_BATCH_SIZE"])
+    response = output_json_array(promotion_serializer(many=True)(batch) for batch in batches)
+    return sum(len(chunk) for chunk in response.response)
+
+
+MODES = {"orm": read_orm, "rows": read_rows, "stream": read_stream}
+
+
+def max_rss() -> float:
+    """Returns the peak resident memory of this process in MiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(mode: str):
+    """Builds the list response once, printing its latency and the memory it took"""
+    with app.test_request_context():
+        db.session.execute(select(1))
+        baseline = max_rss()
+        start = time.perf_counter()
+        size = MODES[mode]()
+        elapsed = time.perf_counter() - start
+        db.session.rollback()
+    print(
+        f"{mode:<8}{elapsed * 1000:8.0f} ms {max_rss():8.1f} MiB peak RSS "
+        f"{max_rss() - baseline:8.1f} MiB for the response {size / 2**20:8.1f} MiB body"
+    )
+
+
+def main():
+    """Loads the promotions, then measures every mode in its own process"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--mode", choices=MODES)
+    options = parser.parse_args()
+    if options.mode:
+        measure(options.mode)
+        return
+
+    with app.app_context():
+        existing = db.session.scalar(select(func.count()).select_from(Promotion))  # pylint: disable=not-callable
+        if existing < options.count:
+            copy_promotions(generate_promotions(options.count - existing, seed=existing))
+    print(f"{options.count} promotions")
+    for mode in MODES:
+        subprocess.run([sys.executable, "-m", "benchmarks.read_promotions", "--mode", mode], check=True)
+
+
+if __name__ == "__main__":
+    main()
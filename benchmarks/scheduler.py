@@ -0,0 +1,77 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Benchmark of the passes of the scheduler
+
+Usage: python -m benchmarks.scheduler [--batch-size 1000]
+
+Runs on the promotions in the database, like the ones python -m
+benchmarks.partitions loads. Prints the latency and buffers of finding a
+batch to activate and to deactivate, with the partial indexes and without
+them (dropped in a transaction rolled back), then times a first pass that
+catches up with the dates, and a second one once it caught up. Run it on
+a scratch database.
+"""
+import argparse
+import json
+import re
+import time
+from sqlalchemy import select, text
+from wsgi import app
+from service.models import db, Promotion, utc_now
+from service.common import scheduler
+
+PARTIAL_INDEXES = ("ix_promotion_inactive_start", "ix_promotion_active_end")
+
+
+def explain(connection, sql: str) -> tuple[float, int, list[str]]:
+    """Returns the milliseconds, the buffers and the indexes of a query"""
+    plan = connection.scalar(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}"))
+    plan = (plan if isinstance(plan, list) else json.loads(plan))[0]
+    indexes = sorted(set(re.findall(r'"Index Name": "\w*?(ix_promotion_\w+)"', json.dumps(plan))))
+    return plan["Execution Time"], plan["Plan"]["Shared Hit Blocks"] + plan["Plan"]["Shared Read Blocks"], indexes
+
+
+def lookups(batch_size: int):
+    """Prints what finding a batch of every transition costs, with and without the partial indexes"""
+    for name, (_, where) in scheduler.transitions(utc_now()).items():
+        statement = select(Promotion.id).where(*where).limit(batch_size).with_for_update(skip_locked=True)
+        sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+        with db.engine.connect() as connection:
+            for label in ("partial", "without"):
+                if label == "without":
+                    for index in PARTIAL_INDEXES:
+                        connection.execute(text(f"DROP INDEX {index}"))
+                milliseconds, buffers, indexes = explain(connection, sql)
+                print(f"{name:<12}{label:<9}{milliseconds:10.1f} ms {buffers:9d} buffers  {', '.join(indexes)}")
+            connection.rollback()
+
+
+def main():
+    """Times the lookups of the scheduler, then a catching up pass and a steady one"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    options = parser.parse_args()
+    with app.app_context():
+        lookups(options.batch_size)
+        for label in ("first pass", "next pass"):
+            start = time.perf_counter()
+            counts = scheduler.apply_schedule(batch_size=options.batch_size)
+            print(f"{label:<12}{time.perf_counter() - start:10.2f} s  {counts}")
+
+
+if __name__ == "__main__":
+    main()
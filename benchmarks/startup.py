@@ -0,0 +1,118 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Cold start of a worker, from the process start to the first served request
+
+Usage: python -m benchmarks.startup [--runs 5] [--db-latency 5] [--imports 15]
+
+Compares the statements and time of the schema step of create_app: the
+db.create_all() every worker used to run, and the version check that
+replaced it. Then starts gunicorn with one sync worker --runs times and
+prints the median time until GET /api/promotions answers. --imports
+prints the packages that take the longest to import with the service.
+"""
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import time
+from sqlalchemy import event
+from wsgi import app
+from service.models import db
+from service.common import migrations
+from service.common.startup import import_breakdown
+from benchmarks.load_promotions import start_latency_proxy
+
+COMMAND = ["gunicorn", "--worker-class", "sync", "--workers", "1", "--threads", "1", "--bind", "127.0.0.1:{port}"]
+
+
+def measure_step(name: str, step):
+    """Prints the statements and time a schema step takes on a fresh connection"""
+    statements = []
+
+    def count(*_):
+        statements.append(1)
+
+    with app.app_context():
+        db.engine.dispose()
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            start = time.perf_counter()
+            step()
+            elapsed = time.perf_counter() - start
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+            db.session.rollback()
+    print(f"{name:<14}{len(statements):4d} statements {elapsed * 1000:8.1f} ms")
+
+
+def first_request(port: int, env: dict) -> float:
+    """Starts gunicorn, returning the seconds until it served GET /api/promotions"""
+    command = [part.format(port=port) for part in COMMAND]
+    start = time.perf_counter()
+    with subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as server:
+        try:
+            while True:
+                try:
+                    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                    connection.request("GET", "/api/promotions?view=summary&name=none")
+                    if connection.getresponse().status == 200:
+                        return time.perf_counter() - start
+                except OSError:
+                    time.sleep(0.01)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def print_imports(env: dict, top: int):
+    """Prints the packages taking the longest to import in a new interpreter"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import wsgi"], env=env, capture_output=True, text=True, check=True
+    )
+    for package, seconds in import_breakdown(result.stderr)[:top]:
+        print(f"{package:<24}{seconds * 1000:8.1f} ms")
+
+
+def main():
+    """Measures the schema steps, then the time to the first request"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--db-latency", type=float, default=0, help="milliseconds added to every database reply")
+    parser.add_argument("--imports", type=int, default=0, help="number of slowest imported packages to print")
+    options = parser.parse_args()
+
+    env = dict(os.environ)
+    if options.db_latency:
+        env["DATABASE_URI"] = start_latency_proxy(app.config["SQLALCHEMY_DATABASE_URI"], options.db_latency / 1000)
+        app.config["SQLALCHEMY_DATABASE_URI"] = env["DATABASE_URI"]
+        print(f"{options.db_latency} ms database latency")
+
+    if options.imports:
+        print_imports(env, options.imports)
+
+    measure_step("create_all", db.create_all)
+    measure_step("check_schema", lambda: migrations.check_schema(app.config))
+
+    times = [first_request(options.port, env) for _ in range(options.runs)]
+    print(f"first request {statistics.median(times) * 1000:8.0f} ms median of {options.runs} starts")
+
+
+if __name__ == "__main__":
+    main()
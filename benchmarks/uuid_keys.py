@@ -0,0 +1,91 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Benchmark of bulk loading promotions keyed by version 4 and version 7 UUIDs
+
+Usage: python -m benchmarks.uuid_keys [--rows 10000000] [--batch-size 10000]
+
+For every kind of id, creates a scratch copy of the promotion table with
+only its primary key, loads --rows promotions into it with COPY, committing
+every --batch-size rows like flask db-seed, and prints the throughput, the
+size of the primary key index and of the table, and the WAL written. The
+scratch tables are dropped at the end.
+"""
+import argparse
+import time
+import uuid
+from sqlalchemy import text
+from wsgi import app
+from service.models import db, Promotion
+from service.common.bulk import COLUMNS, generate_promotions, to_copy_row
+from service.common.ids import uuid7
+
+KINDS = {"uuid4": uuid.uuid4, "uuid7": uuid7}
+STATS = text(
+    "SELECT pg_relation_size(:table || '_pkey'), pg_table_size(:table), "
+    "pg_wal_lsn_diff(pg_current_wal_lsn(), :lsn)"
+)
+
+
+def copy_rows(connection, table: str, make_id, rows: int, batch_size: int) -> float:
+    """Loads rows promotions with ids from make_id into a table, returning the seconds it took"""
+    # Only the ids differ from one batch to the next
+    template = [to_copy_row(promotion)[1:] for promotion in generate_promotions(batch_size, seed=47)]
+    cursor = connection.connection.cursor()
+    start = time.perf_counter()
+    for offset in range(0, rows, batch_size):
+        with cursor.copy(f"COPY {table} ({', '.join(COLUMNS)}) FROM STDIN") as copy:
+            for rest in template[:rows - offset]:
+                copy.write_row((make_id(), *rest))
+        connection.connection.commit()
+    return time.perf_counter() - start
+
+
+def load(kind: str, rows: int, batch_size: int):
+    """Loads rows promotions with ids of a kind into a scratch table, printing what it cost"""
+    table = f"{Promotion.__tablename__}_{kind}"
+    with db.engine.connect() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {table}"))
+        connection.execute(text(f"CREATE TABLE {table} (LIKE {Promotion.__tablename__} INCLUDING DEFAULTS, PRIMARY KEY (id))"))
+        connection.commit()
+        lsn = connection.scalar(text("SELECT pg_current_wal_lsn()"))
+        connection.commit()
+
+        elapsed = copy_rows(connection, table, KINDS[kind], rows, batch_size)
+
+        index, size, wal = connection.execute(STATS, {"table": table, "lsn": lsn}).one()
+        connection.execute(text(f"DROP TABLE {table}"))
+        connection.commit()
+    print(
+        f"{kind:<6}{rows:10d} rows {rows / elapsed:10.0f} rows/s  primary key {index / 2**20:8.1f} MiB  "
+        f"table {size / 2**20:8.1f} MiB  WAL {wal / 2**20:8.1f} MiB"
+    )
+
+
+def main():
+    """Loads the same promotions keyed by every kind of id"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--kind", choices=KINDS, action="append")
+    options = parser.parse_args()
+    with app.app_context():
+        for kind in options.kind or KINDS:
+            load(kind, options.rows, options.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Gunicorn configuration, loaded from the working directory by gunicorn
+
+GUNICORN_PROFILE picks the worker class and sizes the workers from the CPU
+limit of the container:
+
+    sync     one request per worker, 2 x CPUs + 1 workers (at least 2)
+    gthread  GUNICORN_THREADS threads per worker, 2 x CPUs workers (at least 1)
+    gevent   GUNICORN_WORKER_CONNECTIONS greenlets per worker, one worker per CPU,
+             without preload_app
+    asgi     asgi:app on uvicorn workers, one worker per CPU
+
+The CPU limit is read from GUNICORN_CPU_LIMIT in millicores (see the
+downward API in k8s/deployment.yaml), then from the cgroup, then from the
+CPU count. Every other setting can be overridden with its own variable.
+"""
+
+import math
+import os
+
+PROFILES = {
+    "sync": {"worker_class": "sync", "workers": lambda cpus: max(2, int(2 * cpus) + 1)},
+    "gthread": {"worker_class": "gthread", "workers": lambda cpus: max(1, int(2 * cpus)), "threads": 8},
+    # gevent patches the standard library when the worker starts, after a preloaded app imported it
+    "gevent": {"worker_class": "gevent", "workers": lambda cpus: max(1, math.ceil(cpus)), "preload_app": False},
+    "asgi": {
+        "worker_class": "uvicorn_worker.UvicornWorker",
+        "workers": lambda cpus: max(1, math.ceil(cpus)),
+        "wsgi_app": "asgi:app",
+    },
+}
+
+
+def cpu_limit(cgroup: str = "/sys/fs/cgroup") -> float:
+    """Returns the number of CPUs the container may use"""
+    if os.getenv("GUNICORN_CPU_LIMIT"):
+        return int(os.environ["GUNICORN_CPU_LIMIT"]) / 1000
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open(os.path.join(cgroup, "cpu.max"), encoding="ascii") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    return float(os.cpu_count() or 1)
+
+
+def env_int(name: str, default: int) -> int:
+    """Returns an integer setting from the environment"""
+    return int(os.getenv(name, str(default)))
+
+
+profile_name = os.getenv("GUNICORN_PROFILE", "gthread")
+if profile_name not in PROFILES:
+    raise ValueError(f"GUNICORN_PROFILE must be one of {', '.join(PROFILES)}, not {profile_name}")
+profile = PROFILES[profile_name]
+cpus = cpu_limit()
+
+# Application and socket
+wsgi_app = os.getenv("GUNICORN_APP", profile.get("wsgi_app", "wsgi:app"))
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+backlog = env_int("GUNICORN_BACKLOG", 2048)
+
+# Workers
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", profile["worker_class"])
+workers = env_int("GUNICORN_WORKERS", profile["workers"](cpus))
+threads = env_int("GUNICORN_THREADS", profile.get("threads", 1))
+worker_connections = env_int("GUNICORN_WORKER_CONNECTIONS", 100)
+# The heartbeat file of the workers lives in memory instead of the overlay filesystem
+worker_tmp_dir = os.getenv("GUNICORN_WORKER_TMP_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else None)
+
+# Load the app once in the master, the workers share its memory copy-on-write
+preload_app = os.getenv("GUNICORN_PRELOAD", str(profile.get("preload_app", True))).lower() == "true"
+
+# Restart workers now and then, at different times, to bound leaks
+max_requests = env_int("GUNICORN_MAX_REQUESTS", 1000)
+max_requests_jitter = env_int("GUNICORN_MAX_REQUESTS_JITTER", 100)
+
+# Timeouts: keepalive should outlast the idle timeout of the load balancer in front
+timeout = env_int("GUNICORN_TIMEOUT", 30)
+graceful_timeout = env_int("GUNICORN_GRACEFUL_TIMEOUT", 20)
+keepalive = env_int("GUNICORN_KEEPALIVE", 75)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Drops the database connections a preloaded app inherited from the master"""
+    if not server.cfg.preload_app:
+        return
+    # pylint: disable=import-outside-toplevel
+    from service.models import db
+
+    app = server.app.wsgi()
+    flask_app = getattr(app, "flask_app", app)
+    with flask_app.app_context():
+        for engine in db.engines.values():
+            # close=False leaves the sockets to the master instead of closing them under it
+            engine.dispose(close=False)
@@ -19,10 +19,18 @@ This module creates and configures the Flask app and sets up the logging
 and SQL database
 """
 import sys
-from flask import Flask
-from flask_restx import Api
-from service import config
-from service.common import log_handlers
+import time
+
+# Startup of the package, before the imports below
+IMPORT_START = time.perf_counter()
+IMPORT_MODULES = len(sys.modules)
+
+# pylint: disable=wrong-import-position
+import click  # noqa: E402
+from flask import Flask  # noqa: E402
+from service import config  # noqa: E402
+from service.common import log_handlers  # noqa: E402
+from service.common.startup import StartupProfile  # noqa: E402
 
 
 ############################################################
@@ -31,31 +39,50 @@ from service.common import log_handlers
 def create_app():
     """Initialize the core application."""
 
+    # The startup counts from the import of the package
+    profile = StartupProfile(IMPORT_START)
+    profile.phases.append(("imports", time.perf_counter() - IMPORT_START, len(sys.modules) - IMPORT_MODULES))
+
     # Create Flask application
-    app = Flask(__name__)
-    app.config.from_object(config)
+    with profile.phase("config"):
+        app = Flask(__name__)
+        app.config.from_object(config)
 
-    # Turn off strict slashes because it violates best practices
-    app.url_map.strict_slashes = False
+        # Turn off strict slashes because it violates best practices
+        app.url_map.strict_slashes = False
 
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
-    from service.models import db
+    with profile.phase("database"):
+        from service.models import db
 
-    db.init_app(app)
+        db.init_app(app)
 
     with app.app_context():
-        # Dependencies require we import the routes AFTER the Flask app is created
-        # pylint: disable=wrong-import-position, wrong-import-order, unused-import
-        from service import routes, models  # noqa: F401 E402
-        from service.common import error_handlers, cli_commands  # noqa: F401, E402
-
-        try:
-            db.create_all()
-        except Exception as error:  # pylint: disable=broad-except
-            app.logger.critical("%s: Cannot continue", error)
-            # gunicorn requires exit code 4 to stop spawning workers when they die
-            sys.exit(4)
+        with profile.phase("routes"):
+            # Dependencies require we import the routes AFTER the Flask app is created
+            # pylint: disable=wrong-import-position, wrong-import-order, unused-import
+            from service import routes, models  # noqa: F401 E402
+            from service.common import error_handlers, cli_commands, representations, compression, api_spec  # noqa: F401, E402
+
+        with profile.phase("schema"):
+            from service.common import migrations
+
+            # The flask commands still load, so flask db-upgrade can bring the schema up to date,
+            # and flask api-spec-export runs without a database
+            command = click.get_current_context(silent=True) is not None
+            try:
+                # One query, the migrations are applied by flask db-upgrade
+                schema_ready = migrations.check_schema(app.config)
+            except Exception as error:  # pylint: disable=broad-except
+                if not command:
+                    app.logger.critical("%s: Cannot continue", error)
+                    # gunicorn requires exit code 4 to stop spawning workers when they die
+                    sys.exit(4)
+                app.logger.warning("%s: The database is unavailable", error)
+                schema_ready = False
+            if not schema_ready and not command:
+                sys.exit(4)
 
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
@@ -64,6 +91,13 @@ def create_app():
         app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
 
+        app.logger.info("Startup: %s", profile.report())
+        if profile.total > app.config["STARTUP_BUDGET"]:
+            app.logger.warning(
+                "Startup took %.1f s, longer than STARTUP_BUDGET, %.1f s", profile.total, app.config["STARTUP_BUDGET"]
+            )
+        app.extensions["startup"] = profile
+
         app.logger.info("Service initialized!")
 
         return app
@@ -0,0 +1,352 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Async Read Endpoints
+
+An ASGI application answering the read endpoints of the Promotion API on
+asyncio: GET /api/promotions/{id} and GET /api/promotions with its filters
+run on an async SQLAlchemy engine with the async psycopg driver, so one
+worker keeps many reads waiting on the database at once. The queries,
+serializers and encoders are the ones of the Flask routes, and so is the
+choice of the database: a lookup runs on the shard of the id and a list on
+every shard at once, merged by id, as in service/common/sharding.py.
+Unsharded reads go to a replica picked by service/common/replicas.py, or to
+the primary for a client that must read its own writes. Every database has
+its own async engine, created on first use.
+
+Every other request goes to the fallback ASGI application, normally the
+Flask app behind a WSGI adapter (see asgi.py), and so does every read this
+application does not answer itself: MessagePack responses, invalid query
+parameters, missing promotions and database errors. Flask then gives the
+same response it always did. A replica a read failed on is skipped until
+its next health check.
+"""
+import asyncio
+import heapq
+import re
+import uuid
+import zlib
+from collections import deque
+from contextlib import AsyncExitStack
+from functools import partial
+from operator import attrgetter
+from typing import AsyncIterator, Callable
+from urllib.parse import parse_qs
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from werkzeug.datastructures import Accept, MIMEAccept
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header, parse_cookie
+
+from service.models import Promotion
+from service.routes import api, promotion_args, promotion_serializer, requested_fields, version_etag
+from service.common.route_utils import parse_with_try
+from service.common.encoders import get_encoder, encode_items
+from service.common.compression import COMPRESSORS
+from service.common.replicas import READ_PRIMARY_COOKIE, READ_PRIMARY_HEADER, Replica, get_replicas
+from service.common.sharding import get_shards
+
+LIST_PATHS = ("/api/promotions", "/api/promotions/")
+PROMOTION_PATH = re.compile(
+    r"/api/promotions/(?P<id>[A-Fa-f0-9]{8}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{12})"
+)
+
+
+def async_database_uri(uri: str):
+    """Returns the database URI with the psycopg driver, which has an async dialect"""
+    url = make_url(uri)
+    if url.get_backend_name() == "postgresql":
+        url = url.set(drivername="postgresql+psycopg")
+    return url
+
+
+def header(scope: dict, name: bytes) -> str | None:
+    """Returns the value of a request header, repeated headers joined by commas"""
+    values = [value.decode("latin-1") for key, value in scope["headers"] if key == name]
+    return ", ".join(values) if values else None
+
+
+def reads_from_primary(scope: dict) -> bool:
+    """Returns whether the client must read its own writes, like replicas.reads_from_primary"""
+    if READ_PRIMARY_COOKIE in parse_cookie(header(scope, b"cookie")):
+        return True
+    return (header(scope, READ_PRIMARY_HEADER.lower().encode()) or "").lower() == "true"
+
+
+async def merge_results(results: list, key: Callable, batch_size: int) -> AsyncIterator[list]:
+    """Merges streamed results sorted by key, yielding the rows batch_size at a time"""
+    buffers = [deque(rows) for rows in await asyncio.gather(*(result.fetchmany(batch_size) for result in results))]
+    heap = [(key(buffer[0]), index) for index, buffer in enumerate(buffers) if buffer]
+    heapq.heapify(heap)
+    batch = []
+    while heap:
+        _, index = heapq.heappop(heap)
+        buffer = buffers[index]
+        batch.append(buffer.popleft())
+        if not buffer:
+            buffer.extend(await results[index].fetchmany(batch_size))
+        if buffer:
+            heapq.heappush(heap, (key(buffer[0]), index))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+######################################################################
+#  A S G I   A P P L I C A T I O N
+######################################################################
+class AsyncReads:
+    """
+    Serves the read endpoints on an async engine and passes the rest to a fallback
+
+    Args:
+        flask_app (Flask): the application whose configuration and logger are used
+        fallback: the ASGI application answering every other request
+        engine (AsyncEngine, optional): the engine of the primary, created on first use when None
+    """
+
+    def __init__(self, flask_app, fallback, engine: AsyncEngine | None = None):
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.logger = flask_app.logger
+        self.fallback = fallback
+        self.engine = engine
+        # The async engines of the shards and replicas, by bind name
+        self.engines = {}
+
+    def create_engine(self, uri) -> AsyncEngine:
+        """Returns a new async engine on a database URI"""
+        return create_async_engine(
+            async_database_uri(uri),
+            pool_size=self.config["ASYNC_DB_POOL_SIZE"],
+            max_overflow=self.config["ASYNC_DB_MAX_OVERFLOW"],
+        )
+
+    def get_engine(self) -> AsyncEngine:
+        """Returns the async engine of the primary, creating it in the running event loop the first time"""
+        if self.engine is None:
+            self.engine = self.create_engine(self.config["SQLALCHEMY_DATABASE_URI"])
+        return self.engine
+
+    def bind_engine(self, name: str, engine) -> AsyncEngine:
+        """Returns the async engine of a bind, on the database of its sync engine"""
+        if name not in self.engines:
+            self.engines[name] = self.create_engine(engine.url)
+        return self.engines[name]
+
+    async def dispose(self):
+        """Closes the connections of the async engines"""
+        for engine in [self.engine, *self.engines.values()]:
+            if engine is not None:
+                await engine.dispose()
+        self.engine = None
+        self.engines = {}
+
+    def choose_replica(self, replicas) -> Replica | None:
+        """Picks a replica, in a worker thread since its health checks block"""
+        with self.flask_app.app_context():
+            return replicas.choose()
+
+    async def read_engines(self, scope, promotion_id: uuid.UUID | None = None) -> tuple[list, Replica | None]:
+        """
+        Returns the async engines a read runs on, and the replica among them
+
+        That is the shard of the id, or every shard for a list, when the
+        promotions are sharded, and else a healthy replica unless the client
+        must read from the primary.
+        """
+        with self.flask_app.app_context():
+            shards = get_shards()
+            replicas = get_replicas()
+        if shards is not None:
+            if promotion_id is not None:
+                name = shards.name_for(promotion_id)
+                return [self.bind_engine(name, shards.engines[name])], None
+            return [self.bind_engine(name, engine) for name, engine in shards.engines.items()], None
+        if replicas is not None and not reads_from_primary(scope):
+            replica = await asyncio.to_thread(self.choose_replica, replicas)
+            if replica is not None:
+                return [self.bind_engine(replica.name, replica.engine)], replica
+        return [self.get_engine()], None
+
+    def read_failed(self, error: SQLAlchemyError, replica: Replica | None):
+        """Logs a read left to Flask, skipping the replica it failed on"""
+        self.logger.error("Async read failed, falling back: %s", error)
+        if replica is not None:
+            with self.flask_app.app_context():
+                get_replicas().mark_down(replica)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        handler = self.route(scope)
+        if handler is None or not await handler(scope, send):
+            await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Answers the lifespan protocol, closing the connections at shutdown"""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.get_engine()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def route(self, scope):
+        """Returns the handler of a JSON read request, None for the fallback"""
+        if scope["type"] != "http" or scope["method"] != "GET":
+            return None
+        accept = parse_accept_header(header(scope, b"accept"), MIMEAccept)
+        if accept.best_match(api.representations, default="application/json") != "application/json":
+            return None
+        if scope["path"] in LIST_PATHS:
+            return self.list_promotions
+        match = PROMOTION_PATH.fullmatch(scope["path"])
+        if match:
+            return partial(self.get_promotion, uuid.UUID(match["id"]))
+        return None
+
+    ######################################################################
+    #  R E Q U E S T   H E L P E R S
+    ######################################################################
+    def parse_args(self, scope) -> dict | None:
+        """
+        Parses the query string with the arguments of promotion_args
+
+        Returns None when an argument is invalid, so Flask reports the error.
+        """
+        query = parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        args = {}
+        try:
+            # parse_with_try and requested_fields log and abort through the Flask app
+            with self.flask_app.app_context():
+                for argument in promotion_args.args:
+                    values = [argument.type(value) for value in query.get(argument.name, [])]
+                    if argument.choices and any(value not in argument.choices for value in values):
+                        return None
+                    args[argument.name] = values[0] if values else argument.default
+                args["start_date"] = parse_with_try(args.get("start_date"))
+                args["end_date"] = parse_with_try(args.get("end_date"))
+                args["fields"] = requested_fields(args)
+        except (ValueError, HTTPException):
+            return None
+        return args
+
+    def get_compressor(self, scope):
+        """Returns the encoding and compressor the client accepts, or None and None"""
+        accept = parse_accept_header(header(scope, b"accept-encoding"), Accept)
+        encoding = accept.best_match(list(COMPRESSORS))
+        if encoding is None:
+            return None, None
+        return encoding, COMPRESSORS[encoding](self.config)
+
+    ######################################################################
+    #  E N D P O I N T S
+    ######################################################################
+    async def get_promotion(self, promotion_id: uuid.UUID, scope, send) -> bool:
+        """Sends a single Promotion, False when Flask has to answer"""
+        self.logger.info("Request to Retrieve a promotion with id [%s] (async)", promotion_id)
+        engines, replica = await self.read_engines(scope, promotion_id)
+        try:
+            async with engines[0].connect() as connection:
+                row = (await connection.execute(Promotion.select_row(promotion_id))).first()
+        except SQLAlchemyError as error:
+            self.read_failed(error, replica)
+            return False
+        if row is None:
+            return False
+
+        body = get_encoder(self.config)(promotion_serializer()(row))
+        etag = f'"{version_etag(row.version)}"'
+        headers = [(b"content-type", b"application/json"), (b"vary", b"Accept-Encoding")]
+        encoding, compressor = self.get_compressor(scope)
+        if compressor and len(body) >= self.config["COMPRESS_MIN_SIZE"]:
+            body = compressor.compress(body) + compressor.flush()
+            headers.append((b"content-encoding", encoding.encode()))
+            # The compressed body is another representation, so its ETag can only be weak
+            etag = "W/" + etag
+        headers += [(b"etag", etag.encode()), (b"content-length", str(len(body)).encode())]
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+        return True
+
+    async def list_query(self, scope, args: dict) -> tuple:
+        """Returns the engines to list the Promotions from, the replica among them or None, and the query"""
+        engines, replica = await self.read_engines(scope)
+        columns = args["fields"]
+        # The merge of the shards needs the id of every row, the serializer leaves it out when it was not asked for
+        if len(engines) > 1 and columns is not None and "id" not in columns:
+            columns = (*columns, "id")
+        statement = Promotion.select_rows(args, columns).execution_options(yield_per=self.config["LIST_BATCH_SIZE"])
+        if len(engines) > 1:
+            statement = statement.order_by(Promotion.__table__.c.id)
+        return engines, replica, statement
+
+    async def list_promotions(self, scope, send) -> bool:
+        """Streams the Promotions matching the query as a JSON array, False when Flask has to answer"""
+        self.logger.info("Request to list promotions... (async)")
+        args = self.parse_args(scope)
+        if args is None:
+            return False
+        serialize = promotion_serializer(True, args["fields"])
+        batch_size = self.config["LIST_BATCH_SIZE"]
+        engines, replica, statement = await self.list_query(scope, args)
+        started = False
+        try:
+            async with AsyncExitStack() as stack:
+                connections = [await stack.enter_async_context(engine.connect()) for engine in engines]
+                results = await asyncio.gather(*(connection.stream(statement) for connection in connections))
+                started = True
+                if len(results) == 1:
+                    batches = results[0].partitions()
+                else:
+                    batches = merge_results(results, attrgetter("id"), batch_size)
+                await self.send_json_array(scope, send, batches, serialize)
+        except SQLAlchemyError as error:
+            if started:
+                raise
+            self.read_failed(error, replica)
+            return False
+        return True
+
+    async def send_json_array(self, scope, send, batches: AsyncIterator[list], serialize):
+        """Sends batches of rows as a JSON array, compressed chunk by chunk when accepted"""
+        encoder = get_encoder(self.config)
+        encoding, compressor = self.get_compressor(scope)
+
+        async def send_chunk(chunk: bytes, more_body: bool = True):
+            if compressor:
+                chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        headers = [(b"content-type", b"application/json"), (b"vary", b"Accept-Encoding")]
+        if compressor:
+            headers.append((b"content-encoding", encoding.encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        await send_chunk(b"[")
+        separator = b""
+        async for batch in batches:
+            if batch:
+                await send_chunk(separator + encode_items(encoder, serialize(batch)))
+                separator = b","
+        await send_chunk(b"]\n", more_body=False)
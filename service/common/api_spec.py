@@ -0,0 +1,97 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: api_spec
+
+Serves the OpenAPI spec of the API, the /api/swagger.json that /apidocs
+loads, from bytes made once per worker. flask-restx encodes the spec on
+every request. Here it is encoded, hashed and compressed on the first
+request, or read from the file flask api-spec-export wrote at build time
+(API_SPEC_FILE), and then served with a strong ETag and Cache-Control.
+"""
+import hashlib
+import json
+import os
+from typing import NamedTuple
+from flask import current_app as app  # Import Flask application
+from flask import Response, request
+from flask_restx import Swagger
+from service.routes import api
+from service.common.compression import COMPRESSORS
+
+
+class ApiSpec(NamedTuple):
+    """The encoded spec, with its ETag and compressed bodies"""
+
+    etag: str
+    bodies: dict
+
+
+def build_spec() -> bytes:
+    """Returns the OpenAPI spec of the API encoded as JSON"""
+    # The spec links to the API with url_for, which needs a request
+    with app.test_request_context():
+        return json.dumps(Swagger(api).as_dict(), separators=(",", ":")).encode("utf-8")
+
+
+def load_spec() -> bytes:
+    """Returns the spec from API_SPEC_FILE, building it when there is no such file"""
+    path = app.config["API_SPEC_FILE"]
+    if path and os.path.isfile(path):
+        with open(path, "rb") as spec_file:
+            return spec_file.read()
+    if path:
+        app.logger.warning("API_SPEC_FILE %s does not exist, building the spec", path)
+    return build_spec()
+
+
+def get_spec() -> ApiSpec:
+    """Returns the spec of this app, made on the first call"""
+    spec = app.extensions.get("api_spec")
+    if spec is None:
+        body = load_spec()
+        bodies = {}
+        for encoding, make_compressor in COMPRESSORS.items():
+            compressor = make_compressor(app.config)
+            bodies[encoding] = compressor.compress(body) + compressor.flush()
+        # Last, so a client accepting a compression gets it
+        bodies["identity"] = body
+        spec = app.extensions["api_spec"] = ApiSpec(hashlib.sha256(body).hexdigest(), bodies)
+    return spec
+
+
+######################################################################
+# GET THE OPENAPI SPEC
+######################################################################
+def serve_spec():
+    """Returns the spec in the best encoding the client accepts"""
+    spec = get_spec()
+    encoding = request.accept_encodings.best_match(list(spec.bodies), default="identity")
+    response = Response(spec.bodies[encoding], mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if encoding == "identity":
+        response.set_etag(spec.etag)
+    else:
+        # Every representation gets its own strong ETag
+        response.headers["Content-Encoding"] = encoding
+        response.set_etag(f"{spec.etag}-{encoding}")
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["API_SPEC_MAX_AGE"]
+    return response.make_conditional(request)
+
+
+# Replaces the view of flask-restx, keeping its endpoint so /apidocs still links to it
+app.view_functions[api.endpoint("specs")] = serve_spec
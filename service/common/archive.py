@@ -0,0 +1,453 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: archive
+
+Cold storage of the expired promotions. flask promotions-archive deletes
+the promotions that ended before a cutoff, batch by batch, and writes each
+batch as a segment of ARCHIVE_DIR before committing the delete:
+
+* <segment>.ndjson.gz holds the promotions sorted by id, as flask
+  promotions-export writes them, in gzip members of ARCHIVE_BLOCK_SIZE
+  promotions: it is a plain gzip file, and every block inflates on its own
+* <segment>.idx indexes the blocks, with the first id, offset and length
+  of each in fixed size entries sorted by id, after the range of the ids
+
+GET /api/promotions/archive looks the ids up through memory maps of the
+segments: a binary search of the index finds the one block that can hold
+an id, so a lookup reads a few pages however large the archive grows.
+Only the ARCHIVE_MAX_OPEN_SEGMENTS segments used last stay mapped, and
+the segments are merged tier by tier after archiving, so a lookup
+searches a number of segments that grows with the log of the archive.
+"""
+import bisect
+import gzip
+import heapq
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+from flask import current_app as app  # Import Flask application
+from sqlalchemy import delete, select
+from service.models import Promotion
+from service.common.bulk import batched
+from service.common.ids import uuid7
+from service.common.sharding import promotion_engines
+
+logger = logging.getLogger("flask.app")
+
+INDEX_MAGIC = b"PROMIDX1"
+# Magic, number of blocks, first and last id of the segment
+INDEX_HEADER = struct.Struct(">8sI16s16s")
+# First id, offset and length of a block
+INDEX_ENTRY = struct.Struct(">16sQI")
+SEGMENT_SUFFIX = ".ndjson.gz"
+INDEX_SUFFIX = ".idx"
+
+AGE_PATTERN = re.compile(r"^(\d+)([hdw])$")
+AGE_UNITS = {"h": "hours", "d": "days", "w": "weeks"}
+
+
+def parse_age(value: str) -> timedelta:
+    """Parses an age like 180d, 26w or 12h"""
+    match = AGE_PATTERN.match(value.strip())
+    if not match:
+        raise ValueError(f"Invalid age '{value}': use a number of hours, days or weeks like 12h, 180d or 26w")
+    return timedelta(**{AGE_UNITS[match[2]]: int(match[1])})
+
+
+######################################################################
+#  S E G M E N T S
+######################################################################
+def _write_durably(path: str, chunks: Iterable[bytes]):
+    """Writes a file under a temporary name and renames it once it is on disk"""
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as stream:
+        for chunk in chunks:
+            stream.write(chunk)
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(temporary, path)
+
+
+def _sync_directory(directory: str):
+    """Syncs a directory, so the files renamed into it or removed from it stay so after a crash"""
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def _write_lines(path: str, lines: Iterable[tuple[bytes, bytes]], block_size: int):
+    """
+    Writes the NDJSON lines of promotions, sorted by id and paired with their ids, as a segment
+
+    The lines are compressed one block at a time, so a segment of any size
+    is written in constant memory. The index is renamed into place last, so
+    a segment is only listed once both files are complete on disk.
+    """
+    entries = []
+    last = None
+
+    def blocks():
+        nonlocal last
+        offset = 0
+        for block in batched(lines, block_size):
+            body = gzip.compress(b"".join(line for _, line in block), mtime=0)
+            entries.append(INDEX_ENTRY.pack(block[0][0], offset, len(body)))
+            last = block[-1][0]
+            offset += len(body)
+            yield body
+
+    _write_durably(path + SEGMENT_SUFFIX, blocks())
+    header = INDEX_HEADER.pack(INDEX_MAGIC, len(entries), INDEX_ENTRY.unpack(entries[0])[0], last)
+    _write_durably(path + INDEX_SUFFIX, [header, *entries])
+
+
+def write_segment(directory: str, promotions: list[dict], block_size: int = 64) -> str:
+    """
+    Writes serialized promotions as a segment, sorted by id
+
+    Returns:
+        str: the path of the segment, without its suffixes
+    """
+    promotions = sorted(promotions, key=lambda promotion: uuid.UUID(promotion["id"]))
+    path = os.path.join(directory, f"promotions-{uuid7().hex}")
+    _write_lines(
+        path,
+        ((uuid.UUID(promotion["id"]).bytes, (json.dumps(promotion) + "\n").encode("utf-8")) for promotion in promotions),
+        block_size,
+    )
+    _sync_directory(directory)
+    return path
+
+
+class _BlockKeys:
+    """The first ids of the blocks of an index, as a sequence bisect can search"""
+
+    def __init__(self, index: mmap.mmap, count: int):
+        self.index = index
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, position: int) -> bytes:
+        return INDEX_ENTRY.unpack_from(self.index, INDEX_HEADER.size + position * INDEX_ENTRY.size)[0]
+
+
+class Segment:
+    """A segment of the archive, memory mapped while it is in use"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path + INDEX_SUFFIX, "rb") as stream:
+            header = stream.read(INDEX_HEADER.size)
+        magic, self.count, self.first, self.last = INDEX_HEADER.unpack(header.ljust(INDEX_HEADER.size, b"\0"))
+        if magic != INDEX_MAGIC:
+            raise ValueError(f"{path}{INDEX_SUFFIX} is not an archive index")
+        self._maps = None
+
+    @property
+    def name(self) -> str:
+        """The name of the segment, ordered like the times the segments were written"""
+        return os.path.basename(self.path)
+
+    @property
+    def mapped(self) -> bool:
+        """Tells whether the files of the segment are mapped"""
+        return self._maps is not None
+
+    def maps(self) -> tuple[mmap.mmap, mmap.mmap]:
+        """Returns the memory maps of the index and the data, mapping the files when they are not"""
+        maps = self._maps
+        if maps is None:
+            with open(self.path + INDEX_SUFFIX, "rb") as index, open(self.path + SEGMENT_SUFFIX, "rb") as data:
+                maps = (
+                    mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ),
+                    mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ),
+                )
+            self._maps = maps
+        return maps
+
+    @property
+    def keys(self) -> _BlockKeys:
+        """The first ids of the blocks"""
+        return _BlockKeys(self.maps()[0], self.count)
+
+    def covers(self, promotion_id: uuid.UUID) -> bool:
+        """Tells whether the id is within the range of the ids of the segment"""
+        return self.first <= promotion_id.bytes <= self.last
+
+    def _block(self, position: int) -> bytes:
+        """Returns the inflated NDJSON lines of a block"""
+        index, data = self.maps()
+        _, offset, length = INDEX_ENTRY.unpack_from(index, INDEX_HEADER.size + position * INDEX_ENTRY.size)
+        return gzip.decompress(data[offset:offset + length])
+
+    def find(self, promotion_id: uuid.UUID) -> dict | None:
+        """Returns the archived promotion with an id, None when this segment does not hold it"""
+        if not self.covers(promotion_id):
+            return None
+        block = self._block(bisect.bisect_right(self.keys, promotion_id.bytes) - 1)
+        # The text search only skips the lines that cannot match: an "id" nested in
+        # extra can hold the same value, so the id of each candidate line is compared
+        needle = f'"id": "{promotion_id}"'.encode("utf-8")
+        start = block.find(needle)
+        while start >= 0:
+            line_start = block.rfind(b"\n", 0, start) + 1
+            line_end = block.index(b"\n", start)
+            promotion = json.loads(block[line_start:line_end])
+            if promotion["id"] == str(promotion_id):
+                return promotion
+            start = block.find(needle, line_end)
+        return None
+
+    def lines(self) -> Iterator[tuple[bytes, bytes]]:
+        """Yields the NDJSON lines of the promotions in id order, paired with their ids"""
+        for position in range(self.count):
+            for line in self._block(position).splitlines(keepends=True):
+                yield uuid.UUID(json.loads(line)["id"]).bytes, line
+
+    def release(self):
+        """Drops the maps of the segment, unmapped once the lookups still reading them are done"""
+        self._maps = None
+
+    def close(self):
+        """Unmaps the files of the segment"""
+        maps, self._maps = self._maps, None
+        for mapped in maps or ():
+            mapped.close()
+
+
+class Archive:
+    """
+    The segments of an archive directory, reopened when segments are added
+
+    At most max_open segments stay mapped, the ones used last, so a large
+    archive does not hold two file descriptors per segment.
+    """
+
+    def __init__(self, directory: str, max_open: int = 64):
+        self.directory = directory
+        self.max_open = max_open
+        self._segments = {}
+        self._mapped = OrderedDict()
+        self._listed = None
+        self._lock = threading.Lock()
+
+    def segments(self) -> list[Segment]:
+        """Returns the segments, the newest first"""
+        try:
+            listed = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self._lock:
+            # A segment added within the resolution of the modification time does not change it
+            if listed != self._listed or time.time_ns() - listed < 2_000_000_000:
+                names = {name[:-len(INDEX_SUFFIX)] for name in os.listdir(self.directory) if name.endswith(INDEX_SUFFIX)}
+                for name in set(self._segments) - names:
+                    # Released rather than closed, a lookup may still be reading it
+                    self._segments.pop(name).release()
+                    self._mapped.pop(name, None)
+                for name in names - set(self._segments):
+                    try:
+                        self._segments[name] = Segment(os.path.join(self.directory, name))
+                    except FileNotFoundError:
+                        continue  # merged since it was listed
+                self._listed = listed
+            return [self._segments[name] for name in sorted(self._segments, reverse=True)]
+
+    def _use(self, segment: Segment):
+        """Marks a segment as used last, releasing the maps of the least recently used ones over max_open"""
+        with self._lock:
+            self._mapped[segment.name] = segment
+            self._mapped.move_to_end(segment.name)
+            while len(self._mapped) > self.max_open:
+                self._mapped.popitem(last=False)[1].release()
+
+    def _find(self, segments: list[Segment], promotion_id: uuid.UUID) -> dict | None:
+        """Returns the archived promotion with an id from the newest segment holding it"""
+        for segment in segments:
+            if segment.covers(promotion_id):
+                self._use(segment)
+                promotion = segment.find(promotion_id)
+                if promotion is not None:
+                    return promotion
+        return None
+
+    def find(self, ids: Iterable[uuid.UUID]) -> list[dict]:
+        """Returns the archived promotions with the ids, in their order, leaving out the ids not archived"""
+        segments = self.segments()
+        found = []
+        for promotion_id in ids:
+            # A promotion archived twice, when a commit failed, is read from the newest segment
+            try:
+                promotion = self._find(segments, promotion_id)
+            except FileNotFoundError:
+                # Merged since it was listed: the merged segment was written before it was removed
+                segments = self.segments()
+                promotion = self._find(segments, promotion_id)
+            if promotion is not None:
+                found.append(promotion)
+        return found
+
+    def close(self):
+        """Unmaps every segment"""
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+            self._mapped.clear()
+            self._listed = None
+
+
+######################################################################
+#  C O M P A C T I O N
+######################################################################
+def _tier(segment: Segment, fanout: int) -> int:
+    """Returns the tier of a segment, the number of times fanout divides its number of blocks"""
+    tier, count = 0, segment.count
+    while count >= fanout:
+        tier, count = tier + 1, count // fanout
+    return tier
+
+
+def _merge_lines(segments: list[Segment]) -> Iterator[tuple[bytes, bytes]]:
+    """Merges the lines of segments, oldest first, in id order, keeping the newest copy of an id"""
+    def ranked(rank: int, segment: Segment):
+        for promotion_id, line in segment.lines():
+            yield promotion_id, -rank, line
+
+    previous = None
+    for promotion_id, _, line in heapq.merge(*(ranked(rank, segment) for rank, segment in enumerate(segments))):
+        if promotion_id != previous:
+            previous = promotion_id
+            yield promotion_id, line
+
+
+def compact(directory: str, fanout: int = 8, block_size: int = 64) -> int:
+    """
+    Merges the segments of an archive directory tier by tier
+
+    A segment is in tier n when it has fanout**n blocks or more. Once a tier
+    holds fanout segments, the oldest fanout are merged into one of the next
+    tier, along with the segments written between them, so a merged segment
+    stands in for a run of consecutive segments. It is named after the newest
+    of them, and a promotion archived twice keeps its newest copy. Every promotion is
+    rewritten about log(segments) / log(fanout) times, and an archive keeps
+    fewer than fanout segments per tier.
+
+    The merged segment is on disk before its sources are removed, so a
+    lookup running at the same time finds every promotion.
+
+    Returns:
+        int: the number of segments merged
+    """
+    merged = 0
+    while True:
+        names = sorted(name[:-len(INDEX_SUFFIX)] for name in os.listdir(directory) if name.endswith(INDEX_SUFFIX))
+        segments = [Segment(os.path.join(directory, name)) for name in names]
+        tiers = {}
+        for position, segment in enumerate(segments):
+            tiers.setdefault(_tier(segment, fanout), []).append(position)
+        full = next((tiers[tier][:fanout] for tier in sorted(tiers) if len(tiers[tier]) >= fanout), None)
+        if full is None:
+            return merged
+        sources = segments[full[0]:full[-1] + 1]
+        # Sorts right after the newest source, before any segment written after it
+        _write_lines(f"{sources[-1].path}-c", _merge_lines(sources), block_size)
+        _sync_directory(directory)
+        for segment in sources:
+            segment.close()
+            os.remove(segment.path + INDEX_SUFFIX)
+            os.remove(segment.path + SEGMENT_SUFFIX)
+        _sync_directory(directory)
+        merged += len(sources)
+        logger.info("Merged %d archive segments into %s-c", len(sources), sources[-1].name)
+
+
+def get_archive() -> Archive:
+    """Returns the archive of this app, in ARCHIVE_DIR"""
+    if "archive" not in app.extensions:
+        app.extensions["archive"] = Archive(app.config["ARCHIVE_DIR"], app.config["ARCHIVE_MAX_OPEN_SEGMENTS"])
+    return app.extensions["archive"]
+
+
+######################################################################
+#  A R C H I V I N G
+######################################################################
+def _archive_batch(engine, cutoff: datetime, directory: str, batch_size: int, block_size: int) -> int:
+    """Deletes a batch of expired promotions and writes them as a segment before committing"""
+    table = Promotion.__table__
+    # Materialized, the batch is picked once: a subquery run again for every partition
+    # would skip the rows the DELETE already removed and pick the next ones
+    expired = (
+        select(table.c.id, table.c.end_date)
+        .where(table.c.end_date < cutoff)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .cte("expired")
+        .prefix_with("MATERIALIZED")
+    )
+    statement = delete(table).where(
+        table.c.end_date < cutoff, table.c.id == expired.c.id, table.c.end_date == expired.c.end_date
+    )
+    with engine.begin() as connection:
+        rows = connection.execute(statement.returning(*table.c)).all()
+        if rows:
+            write_segment(directory, [Promotion.serialize(row) for row in rows], block_size)
+    return len(rows)
+
+
+def archive_expired(cutoff: datetime, directory: str, batch_size: int = 1000, block_size: int = 64,
+                    pause: float = 0) -> int:
+    """
+    Moves the promotions that ended before cutoff to segments of the archive
+
+    Every batch is deleted with DELETE ... RETURNING and written as a
+    segment within its transaction, committed once the segment is on disk,
+    so a promotion is never lost. Rows locked by the traffic are skipped
+    until a later run. When sharded, every shard is archived in turn.
+
+    Args:
+        cutoff (datetime): archive the promotions whose end_date is before it
+        directory (str): the directory of the segments, created if needed
+        batch_size (int): the number of promotions per transaction and segment
+        block_size (int): the number of promotions per compressed block
+        pause (float): the seconds to sleep between batches
+
+    Returns:
+        int: the number of promotions archived
+    """
+    os.makedirs(directory, exist_ok=True)
+    total = 0
+    for engine in promotion_engines():
+        while archived := _archive_batch(engine, cutoff, directory, batch_size, block_size):
+            total += archived
+            logger.info("Archived %d promotions", total)
+            if pause:
+                time.sleep(pause)
+    return total
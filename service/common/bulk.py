@@ -0,0 +1,378 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Bulk Data Utilities
+
+This module contains helpers to move large numbers of Promotions in and
+out of the database with PostgreSQL COPY instead of the ORM. When the
+promotions are sharded, every row is loaded into the shard of its id and
+the exports read every shard.
+"""
+import csv
+import json
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from operator import attrgetter, itemgetter
+from typing import Callable, Iterable, Iterator, TextIO
+from sqlalchemy import select
+from service.models import db, Promotion, DataValidationError, to_naive_utc, utc_now
+from service.common.ids import make_uuid7, uuid7
+from service.common.sharding import get_shards
+
+# Columns in the order the COPY statements read and write them
+COLUMNS = [column.name for column in Promotion.__table__.columns]
+JSON_COLUMNS = {"product_ids", "extra"}
+BOOLEAN_COLUMNS = {"active_status", "schedule_override"}
+
+SEED_BASE_DATE = datetime(2024, 1, 1)
+SEED_DAYS_SPREAD = 730
+SEED_USERS = 50
+SEED_PROMOTION_TYPES = ["percentage", "discount", "bogo", "description"]
+
+
+######################################################################
+#  D A T A   G E N E R A T I O N
+######################################################################
+def _random_uuid(rng: random.Random) -> uuid.UUID:
+    """Returns a version 4 UUID drawn from the given random generator"""
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def _seeded_id(rng: random.Random, number: int) -> uuid.UUID:
+    """Returns the version 7 UUID of the number-th promotion, increasing with number like the ids of the service"""
+    timestamp = int(SEED_BASE_DATE.replace(tzinfo=timezone.utc).timestamp() * 1000) + number
+    return make_uuid7(timestamp, rng.getrandbits(41), rng.getrandbits(32))
+
+
+def generate_promotions(
+    count: int, products: int = 3, overlap: float = 0.5, seed: int = 42
+) -> Iterator[dict]:
+    """
+    Generates promotions deterministically for load testing
+
+    Args:
+        count (int): the number of promotions to generate
+        products (int): the number of product ids attached to each promotion
+        overlap (float): the fraction of product ids drawn from a shared pool
+            of hot products, the rest are unique to their promotion
+        seed (int): the seed of the random generator, the same seed always
+            generates the same promotions
+    """
+    rng = random.Random(seed)
+    hot_products = [str(_random_uuid(rng)) for _ in range(max(products * 10, 1))]
+    users = [_random_uuid(rng) for _ in range(SEED_USERS)]
+
+    for number in range(count):
+        start_date = SEED_BASE_DATE + timedelta(
+            days=rng.randrange(SEED_DAYS_SPREAD), seconds=rng.randrange(86400)
+        )
+        end_date = start_date + timedelta(days=rng.randint(1, 90))
+        created_at = start_date - timedelta(days=rng.randint(1, 30))
+        yield {
+            "id": _seeded_id(rng, number),
+            "product_ids": [
+                rng.choice(hot_products) if rng.random() < overlap else str(_random_uuid(rng))
+                for _ in range(products)
+            ],
+            "name": f"Seeded Promotion {number}",
+            "description": f"Generated promotion {number} from seed {seed}",
+            "start_date": start_date,
+            "end_date": end_date,
+            "active_status": rng.random() < 0.5,
+            "created_by": rng.choice(users),
+            "updated_by": rng.choice(users),
+            "created_at": created_at,
+            "updated_at": created_at,
+            "extra": {
+                "promotion_type": rng.choice(SEED_PROMOTION_TYPES),
+                "value": rng.randint(1, 90),
+            },
+            "version": 1,
+            "schedule_override": False,
+        }
+
+
+######################################################################
+#  C O P Y   L O A D I N G
+######################################################################
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Splits an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def to_copy_row(promotion: dict) -> tuple:
+    """Converts a promotion dictionary into a tuple in COPY column order"""
+    row = []
+    for name in COLUMNS:
+        value = promotion.get(name)
+        if name in JSON_COLUMNS and value is not None:
+            value = json.dumps(value)
+        row.append(value)
+    return tuple(row)
+
+
+def _copy_batch(cursor, table: str, batch: list[dict]) -> int:
+    """Streams one batch of promotions into a table with COPY"""
+    with cursor.copy(f"COPY {table} ({', '.join(COLUMNS)}) FROM STDIN") as copy:
+        for promotion in batch:
+            copy.write_row(to_copy_row(promotion))
+    return len(batch)
+
+
+def _shard_batches(batch: list[dict]) -> list[tuple]:
+    """Pairs the engine of every shard with its promotions of a batch, the primary gets them all when unsharded"""
+    shards = get_shards()
+    if shards is None:
+        return [(db.engine, batch)]
+    return [(shards.engines[name], rows) for name, rows in shards.split(batch, itemgetter("id")).items()]
+
+
+def _load_batches(promotions: Iterable[dict], batch_size: int, write: Callable) -> int:
+    """
+    Writes promotions batch by batch with write(cursor, rows), committing after every batch
+
+    Every database gets its own raw connection, opened when a batch first has rows for it.
+
+    Returns:
+        int: the sum of the counts write returned
+    """
+    loaded = 0
+    connections = {}
+    try:
+        for batch in batched(promotions, batch_size):
+            for engine, rows in _shard_batches(batch):
+                if engine not in connections:
+                    connections[engine] = engine.raw_connection()
+                with connections[engine].cursor() as cursor:
+                    loaded += write(cursor, rows)
+            for connection in connections.values():
+                connection.commit()
+    except Exception:
+        for connection in connections.values():
+            connection.rollback()
+        raise
+    finally:
+        for connection in connections.values():
+            connection.close()
+    return loaded
+
+
+def copy_promotions(promotions: Iterable[dict], batch_size: int = 10000) -> int:
+    """
+    Loads promotions with COPY, committing after every batch
+
+    Only one batch is held in memory at a time, so the generator feeding
+    this function can be arbitrarily large.
+
+    Args:
+        promotions (Iterable[dict]): the promotions to load
+        batch_size (int): the number of rows to load per transaction
+
+    Returns:
+        int: the number of promotions loaded
+    """
+    return _load_batches(
+        promotions, batch_size, lambda cursor, rows: _copy_batch(cursor, Promotion.__tablename__, rows)
+    )
+
+
+######################################################################
+#  S T R E A M I N G   E X P O R T
+######################################################################
+def stream_promotions(filters: dict, batch_size: int = 10000) -> Iterator[dict]:
+    """
+    Streams serialized promotions matching the filters from a server-side cursor
+
+    Rows are fetched batch_size at a time and never become ORM instances,
+    so memory stays constant however many rows match.
+
+    Args:
+        filters (dict): parsed filter values as accepted by Promotion.find_by_filters
+        batch_size (int): the number of rows fetched per round trip
+    """
+    statement = Promotion.find_by_filters(select(*Promotion.__table__.columns), filters)
+    shards = get_shards()
+    if shards is not None:
+        for batch in shards.fan_out(statement.order_by(Promotion.id), batch_size, key=attrgetter("id")):
+            for row in batch:
+                yield Promotion.serialize(row)
+        return
+    result = db.session.execute(statement.execution_options(yield_per=batch_size))
+    for row in result:
+        yield Promotion.serialize(row)
+
+
+def write_ndjson(promotions: Iterable[dict], stream: TextIO) -> int:
+    """Writes promotions as newline delimited JSON and returns how many were written"""
+    written = 0
+    for promotion in promotions:
+        stream.write(json.dumps(promotion))
+        stream.write("\n")
+        written += 1
+    return written
+
+
+def write_csv(promotions: Iterable[dict], stream: TextIO) -> int:
+    """Writes promotions as CSV with JSON encoded list and object columns"""
+    writer = csv.writer(stream)
+    writer.writerow(COLUMNS)
+    written = 0
+    for promotion in promotions:
+        writer.writerow(
+            json.dumps(promotion[name]) if name in JSON_COLUMNS else promotion[name]
+            for name in COLUMNS
+        )
+        written += 1
+    return written
+
+
+WRITERS = {"ndjson": write_ndjson, "csv": write_csv}
+
+
+######################################################################
+#  S T R E A M I N G   I M P O R T
+######################################################################
+def to_promotion_row(record: dict) -> dict:
+    """
+    Validates a record with the same rules as Promotion.deserialize
+
+    The id, timestamps, version and schedule_override are kept when the
+    record has them so an export can be reloaded as is.
+
+    Args:
+        record (dict): a promotion as serialized by the API
+
+    Returns:
+        dict: the column values of the promotion
+
+    Raises:
+        DataValidationError: when the record is not a valid Promotion
+    """
+    if not isinstance(record, dict):
+        raise DataValidationError("Invalid Promotion: record must be an object")
+    promotion = Promotion().deserialize(record)
+    try:
+        promotion.id = uuid.UUID(str(record["id"])) if record.get("id") else uuid7()
+        now = utc_now()
+        created_at = record.get("created_at")
+        updated_at = record.get("updated_at")
+        promotion.created_at = datetime.fromisoformat(created_at) if created_at else now
+        promotion.updated_at = datetime.fromisoformat(updated_at) if updated_at else now
+        promotion.version = max(int(record.get("version") or 1), 1)
+        promotion.schedule_override = record.get("schedule_override") is True
+    except (TypeError, ValueError) as error:
+        raise DataValidationError(f"Invalid Promotion: {error}") from error
+
+    row = {}
+    for name in COLUMNS:
+        value = getattr(promotion, name)
+        row[name] = to_naive_utc(value) if isinstance(value, datetime) else value
+    return row
+
+
+def read_ndjson(stream: TextIO) -> Iterator[tuple[int, str, dict | Exception]]:
+    """Reads NDJSON lines, yielding (line number, raw line, record or error)"""
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield number, line, json.loads(line)
+        except ValueError as error:
+            yield number, line, error
+
+
+def read_csv(stream: TextIO) -> Iterator[tuple[int, str, dict | Exception]]:
+    """Reads CSV rows as written by write_csv, yielding (line number, raw row, record or error)"""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        try:
+            record = dict(row)
+            for name in JSON_COLUMNS.intersection(record):
+                record[name] = json.loads(record[name]) if record[name] else None
+            for name in BOOLEAN_COLUMNS.intersection(record):
+                lowered = (record[name] or "").lower()
+                record[name] = {"true": True, "false": False}.get(lowered, lowered)
+            if not record.get("description"):
+                record["description"] = None
+            yield reader.line_num, json.dumps(row), record
+        except ValueError as error:
+            yield reader.line_num, json.dumps(row), error
+
+
+READERS = {"ndjson": read_ndjson, "csv": read_csv}
+
+
+def validate_records(records, rejects: TextIO | None = None) -> Iterator[dict]:
+    """
+    Turns (line number, raw line, record) tuples into column values
+
+    Lines that fail validation are written as NDJSON to rejects and skipped.
+    """
+    for number, line, record in records:
+        try:
+            if isinstance(record, Exception):
+                raise DataValidationError(f"Invalid line: {record}")
+            yield to_promotion_row(record)
+        except DataValidationError as error:
+            if rejects is not None:
+                rejects.write(json.dumps({"line": number, "error": str(error), "raw": line.rstrip("\n")}))
+                rejects.write("\n")
+
+
+def merge_promotions(promotions: Iterable[dict], batch_size: int = 10000) -> int:
+    """
+    Upserts promotions by id, staging every batch with COPY
+
+    Each batch is copied into a temporary table, the promotions already
+    stored are updated from it and the others inserted, then committed. The
+    partitioned table has no unique index on the id alone for an ON CONFLICT.
+    Updated rows get their version incremented like any other write.
+
+    Args:
+        promotions (Iterable[dict]): the column values of the promotions
+        batch_size (int): the number of rows merged per transaction
+
+    Returns:
+        int: the number of promotions merged
+    """
+    table = Promotion.__tablename__
+    staging = f"{table}_import"
+    columns = ", ".join(COLUMNS)
+    updates = ", ".join(
+        f"{name} = {staging}.{name}" for name in COLUMNS if name not in ("id", "version")
+    )
+    updates += f", version = {table}.version + 1"
+
+    def merge_batch(cursor, batch: list[dict]) -> int:
+        # An UPDATE ... FROM cannot touch a row twice, so the last copy of an id wins
+        batch = list({promotion["id"]: promotion for promotion in batch}.values())
+        cursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        _copy_batch(cursor, staging, batch)
+        cursor.execute(
+            f"UPDATE {table} SET {updates} FROM {staging} WHERE {table}.id = {staging}.id"
+        )
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} "
+            f"WHERE NOT EXISTS (SELECT FROM {table} WHERE {table}.id = {staging}.id)"
+        )
+        return len(batch)
+
+    return _load_batches(promotions, batch_size, merge_batch)
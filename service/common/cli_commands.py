@@ -16,8 +16,34 @@
 """
 Flask CLI Command Extensions
 """
+import gzip
+import io
+import os
+import signal
+import threading
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from sqlalchemy import create_engine
+from service.models import db, Promotion, utc_now
+from service.routes import args_config
+from service.common.bulk import (
+    generate_promotions,
+    copy_promotions,
+    stream_promotions,
+    validate_records,
+    merge_promotions,
+    READERS,
+    WRITERS,
+)
+from service.common.route_utils import parse_with_try
+from service.common import migrations, partitions, scheduler
+from service.common.sharding import get_shards, reshard
+from service.common.api_spec import build_spec
+from service.common.archive import archive_expired, compact, parse_age
+
+# Parsers for the --filter options, the same ones the list endpoint uses
+FILTER_TYPES = {name: arg_type for name, arg_type, *_ in args_config}
+FILTER_TYPES.update(start_date=parse_with_try, end_date=parse_with_try)
 
 
 ######################################################################
@@ -33,4 +59,306 @@ def db_create():
     """
     db.drop_all()
     db.create_all()
+    migrations.create_key_trigger(db.session.connection())
+    partitions.ensure_partitions(db.session.connection(), app.config["PARTITION_MONTHS_AHEAD"])
+    migrations.stamp(db.session)
     db.session.commit()
+
+
+######################################################################
+# Command to apply the missing schema migrations
+# Usage:
+#   flask db-upgrade [--target 2]
+######################################################################
+@app.cli.command("db-upgrade")
+@click.option("--target", default=migrations.SCHEMA_VERSION, show_default=True, type=click.IntRange(min=0),
+              help="Version to upgrade to")
+def db_upgrade(target):
+    """
+    Applies the schema migrations the database is missing. Run it once
+    before rolling out a release, the workers only check the version.
+    """
+    applied = migrations.upgrade(target)
+    for version in applied:
+        click.echo(f"Applied migration {version}: {migrations.MIGRATIONS[version].description}")
+    click.echo(f"Database schema is at version {migrations.current_version()}")
+
+
+######################################################################
+# Command to list the schema migrations
+# Usage:
+#   flask db-status
+######################################################################
+@app.cli.command("db-status")
+def db_status():
+    """
+    Lists the schema migrations and whether the database has them.
+    """
+    version = migrations.current_version()
+    db.session.rollback()
+    for step in sorted(migrations.MIGRATIONS.values()):
+        state = "applied" if step.version <= version else "pending"
+        mode = "" if step.transactional else " (online)"
+        click.echo(f"{step.version:4d} {state:<8} {step.description}{mode}")
+
+
+######################################################################
+# Command to create the partitions of the coming months
+# Usage:
+#   flask db-partitions [--months-ahead 12]
+######################################################################
+@app.cli.command("db-partitions")
+@click.option("--months-ahead", default=None, type=click.IntRange(min=0),
+              help="Months after the current one to create partitions for  [default: PARTITION_MONTHS_AHEAD]")
+def db_partitions(months_ahead):
+    """
+    Creates the monthly partitions of the promotion table that are missing.
+    Every pass of flask promotions-schedule does it too.
+    """
+    if months_ahead is None:
+        months_ahead = app.config["PARTITION_MONTHS_AHEAD"]
+    created = partitions.maintain_partitions(migrations.schema_engines(), months_ahead, app.config["MIGRATION_LOCK_TIMEOUT"])
+    for name in created:
+        click.echo(f"Created partition {name}")
+    click.echo(f"Created {len(created)} partitions")
+
+
+######################################################################
+# Command to move the promotions to their shard
+# Usage:
+#   flask db-reshard [--drain URI] [--batch-size 1000] [--pause 0.1]
+######################################################################
+@app.cli.command("db-reshard")
+@click.option("--drain", multiple=True, metavar="URI",
+              help="Database taken out of DATABASE_SHARD_URIS to move every row off, can be repeated")
+@click.option("--batch-size", default=1000, show_default=True, type=click.IntRange(min=1),
+              help="Number of rows moved per transaction")
+@click.option("--pause", default=0.0, show_default=True, type=click.FloatRange(min=0),
+              help="Seconds to sleep between batches")
+def db_reshard(drain, batch_size, pause):
+    """
+    Moves the promotions that are not on the shard their id maps to. Run
+    it after adding a shard at the end of DATABASE_SHARD_URIS.
+    """
+    shards = get_shards()
+    if shards is None:
+        raise click.ClickException("The promotions are not sharded: set DATABASE_SHARD_URIS")
+    table = Promotion.__table__
+    for name, engine in shards.engines.items():
+        moved = reshard(shards, table, engine, batch_size=batch_size, pause=pause)
+        click.echo(f"Moved {moved} promotions off {name}")
+    for uri in drain:
+        engine = create_engine(uri)
+        try:
+            moved = reshard(shards, table, engine, drain=True, batch_size=batch_size, pause=pause)
+        finally:
+            engine.dispose()
+        click.echo(f"Moved {moved} promotions off {engine.url.render_as_string()}")
+
+
+######################################################################
+# Command to write the OpenAPI spec to a file
+# Usage:
+#   flask api-spec-export -o service/static/swagger.json
+######################################################################
+@app.cli.command("api-spec-export")
+@click.option("--output", "-o", default="-", show_default=True, type=click.Path(dir_okay=False, allow_dash=True),
+              help="File to write, - for standard output")
+def api_spec_export(output):
+    """
+    Writes the OpenAPI spec served at /api/swagger.json. Point API_SPEC_FILE
+    at the file and the workers serve it without building the spec.
+    """
+    with click.open_file(output, "wb") as spec_file:
+        spec_file.write(build_spec())
+
+
+######################################################################
+# Command to load generated promotions for load testing
+# Usage:
+#   flask db-seed --count 1000000 --products 5 --overlap 0.3
+######################################################################
+@app.cli.command("db-seed")
+@click.option("--count", default=1000, show_default=True, type=click.IntRange(min=0),
+              help="Number of promotions to generate")
+@click.option("--products", default=3, show_default=True, type=click.IntRange(min=0),
+              help="Number of product ids attached to each promotion")
+@click.option("--overlap", default=0.5, show_default=True, type=click.FloatRange(0, 1),
+              help="Fraction of product ids shared between promotions")
+@click.option("--seed", default=42, show_default=True, type=int,
+              help="Seed of the random generator")
+@click.option("--batch-size", default=10000, show_default=True, type=click.IntRange(min=1),
+              help="Number of rows loaded per transaction")
+def db_seed(count, products, overlap, seed, batch_size):
+    """
+    Loads generated promotions with COPY for load testing. The same seed
+    always produces the same promotions.
+    """
+    promotions = generate_promotions(count, products=products, overlap=overlap, seed=seed)
+    loaded = copy_promotions(promotions, batch_size=batch_size)
+    click.echo(f"Loaded {loaded} promotions")
+
+
+def parse_filter_options(options) -> dict:
+    """Parses KEY=VALUE filter options into the values the list endpoint would use"""
+    filters = {}
+    for option in options:
+        key, separator, value = option.partition("=")
+        if not separator or key not in FILTER_TYPES:
+            raise click.BadParameter(
+                f"'{option}' must be KEY=VALUE with KEY one of {', '.join(FILTER_TYPES)}",
+                param_hint="--filter",
+            )
+        try:
+            filters[key] = FILTER_TYPES[key](value)
+        except ValueError as error:
+            raise click.BadParameter(f"'{option}': {error}", param_hint="--filter") from error
+    return filters
+
+
+######################################################################
+# Command to export promotions for the analytics lake
+# Usage:
+#   flask promotions-export --format csv --filter active_status=true -o out.csv.gz
+######################################################################
+@app.cli.command("promotions-export")
+@click.option("--format", "fmt", default="ndjson", show_default=True, type=click.Choice(list(WRITERS)),
+              help="Output format")
+@click.option("--filter", "filter_options", multiple=True, metavar="KEY=VALUE",
+              help="Filter like the list endpoint query parameters, may be repeated")
+@click.option("--output", "-o", default="-", show_default=True, type=click.Path(dir_okay=False, allow_dash=True),
+              help="File to write, - for standard output")
+@click.option("--gzip", "compress", is_flag=True,
+              help="Compress the output with gzip, implied by a .gz output file")
+@click.option("--batch-size", default=10000, show_default=True, type=click.IntRange(min=1),
+              help="Number of rows fetched per round trip")
+def promotions_export(fmt, filter_options, output, compress, batch_size):
+    """
+    Streams the promotions matching the filters to a CSV or NDJSON file
+    using a server-side cursor, so memory stays constant.
+    """
+    filters = parse_filter_options(filter_options)
+    compress = compress or output.endswith(".gz")
+    with click.open_file(output, "wb") as binary:
+        raw = gzip.GzipFile(fileobj=binary, mode="wb") if compress else binary
+        stream = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+        exported = WRITERS[fmt](stream_promotions(filters, batch_size=batch_size), stream)
+        stream.detach()  # flushes without closing the file underneath
+        if compress:
+            raw.close()
+    db.session.rollback()  # close the read transaction holding the cursor
+    click.echo(f"Exported {exported} promotions", err=True)
+
+
+######################################################################
+# Command to reload promotions from an export
+# Usage:
+#   flask promotions-import promotions.ndjson.gz
+######################################################################
+@app.cli.command("promotions-import")
+@click.argument("source", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", default="auto", show_default=True, type=click.Choice(["auto", *READERS]),
+              help="Input format, auto detects it from the file extension")
+@click.option("--rejects", type=click.Path(dir_okay=False), default=None,
+              help="NDJSON file for rejected lines  [default: SOURCE.rejects.ndjson]")
+@click.option("--batch-size", default=10000, show_default=True, type=click.IntRange(min=1),
+              help="Number of rows merged per transaction")
+def promotions_import(source, fmt, rejects, batch_size):
+    """
+    Reads promotions from a CSV or NDJSON file (optionally gzipped) and
+    upserts them by id. Invalid lines are written to a rejects file.
+    """
+    name = source[:-3] if source.endswith(".gz") else source
+    if fmt == "auto":
+        fmt = "csv" if name.endswith(".csv") else "ndjson"
+    rejects = rejects or f"{name}.rejects.ndjson"
+    opener = gzip.open if source.endswith(".gz") else open
+
+    with opener(source, "rt", encoding="utf-8", newline="") as stream, \
+            open(rejects, "w", encoding="utf-8") as rejected:
+        promotions = validate_records(READERS[fmt](stream), rejects=rejected)
+        imported = merge_promotions(promotions, batch_size=batch_size)
+        has_rejects = rejected.tell() > 0
+
+    if has_rejects:
+        click.echo(f"Imported {imported} promotions, rejected lines are in {rejects}", err=True)
+    else:
+        os.remove(rejects)
+        click.echo(f"Imported {imported} promotions", err=True)
+
+
+######################################################################
+# Command to move the expired promotions to the archive
+# Usage:
+#   flask promotions-archive --older-than 180d
+######################################################################
+def parse_age_option(_ctx, _param, value):
+    """Parses the --older-than option into a timedelta"""
+    try:
+        return parse_age(value)
+    except ValueError as error:
+        raise click.BadParameter(str(error)) from error
+
+
+@app.cli.command("promotions-archive")
+@click.option("--older-than", "age", required=True, callback=parse_age_option, metavar="AGE",
+              help="Archive the promotions that ended longer ago than AGE, like 180d, 26w or 12h")
+@click.option("--directory", default=None, type=click.Path(file_okay=False),
+              help="Directory of the archive segments  [default: ARCHIVE_DIR]")
+@click.option("--batch-size", default=1000, show_default=True, type=click.IntRange(min=1),
+              help="Number of promotions deleted per transaction and written per segment")
+@click.option("--pause", default=0.0, show_default=True, type=click.FloatRange(min=0),
+              help="Seconds to sleep between batches")
+def promotions_archive(age, directory, batch_size, pause):
+    """
+    Moves the promotions that ended before a cutoff out of the database into
+    compressed segments that GET /api/promotions/archive reads, then merges
+    the segments tier by tier. Partitions left empty are dropped.
+    """
+    cutoff = utc_now() - age
+    directory = directory or app.config["ARCHIVE_DIR"]
+    archived = archive_expired(cutoff, directory, batch_size, app.config["ARCHIVE_BLOCK_SIZE"], pause)
+    click.echo(f"Archived {archived} promotions that ended before {cutoff:%Y-%m-%d} into {directory}")
+    if os.path.isdir(directory):
+        merged = compact(directory, app.config["ARCHIVE_COMPACT_FANOUT"], app.config["ARCHIVE_BLOCK_SIZE"])
+        if merged:
+            click.echo(f"Merged {merged} segments")
+    dropped = partitions.drop_empty_partitions(
+        migrations.schema_engines(), cutoff, app.config["MIGRATION_LOCK_TIMEOUT"]
+    )
+    for name in dropped:
+        click.echo(f"Dropped partition {name}")
+
+
+######################################################################
+# Command to activate and deactivate the promotions at their dates
+# Usage:
+#   flask promotions-schedule [--interval 60] [--batch-size 1000] [--pause 0.1] [--once]
+######################################################################
+@app.cli.command("promotions-schedule")
+@click.option("--interval", default=None, type=click.FloatRange(min=0),
+              help="Seconds between passes  [default: SCHEDULE_INTERVAL]")
+@click.option("--batch-size", default=None, type=click.IntRange(min=1),
+              help="Number of promotions updated per transaction  [default: SCHEDULE_BATCH_SIZE]")
+@click.option("--pause", default=None, type=click.FloatRange(min=0),
+              help="Seconds to sleep between batches  [default: SCHEDULE_BATCH_PAUSE]")
+@click.option("--once", is_flag=True, help="Run a single pass and exit, for a cron job")
+def promotions_schedule(interval, batch_size, pause, once):
+    """
+    Activates the promotions that started and deactivates those that ended,
+    until SIGTERM. Several schedulers can run at once, they share the work.
+    """
+    options = {"SCHEDULE_INTERVAL": interval, "SCHEDULE_BATCH_SIZE": batch_size, "SCHEDULE_BATCH_PAUSE": pause}
+    config = {**app.config, **{name: value for name, value in options.items() if value is not None}}
+    if once:
+        counts = scheduler.run_pass(config)
+        click.echo(f"Activated {counts['activated']} and deactivated {counts['deactivated']} promotions")
+        return
+    stop = threading.Event()
+    handlers = {number: signal.signal(number, lambda *_: stop.set()) for number in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        scheduler.serve(config, stop)
+    finally:
+        for number, handler in handlers.items():
+            signal.signal(number, handler)
+    click.echo("Scheduler stopped")
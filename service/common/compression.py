@@ -0,0 +1,124 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: compression
+
+Compresses responses with the best encoding the client accepts: brotli,
+then gzip. Bodies smaller than COMPRESS_MIN_SIZE are
+sent as is, streamed bodies are compressed chunk by chunk.
+"""
+import zlib
+from typing import Iterable, Iterator
+from flask import current_app as app  # Import Flask application
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    "application/json",
+    "application/msgpack",
+    "text/html",
+    "text/css",
+    "text/plain",
+    "application/javascript",
+}
+
+
+######################################################################
+#  C O M P R E S S O R S
+######################################################################
+def gzip_compressor(config):
+    """Returns a zlib compressor writing the gzip format at COMPRESS_LEVEL"""
+    return zlib.compressobj(config["COMPRESS_LEVEL"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+class BrotliCompressor:
+    """Gives a brotli compressor the compress() and flush() methods of zlib"""
+
+    def __init__(self, config):
+        self.compressor = brotli.Compressor(quality=config["COMPRESS_BROTLI_LEVEL"])
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a chunk, keeping what it can in the buffer"""
+        return self.compressor.process(data)
+
+    def flush(self, mode: int = zlib.Z_FINISH) -> bytes:
+        """Emits the buffered data, ending the stream with Z_FINISH"""
+        return self.compressor.finish() if mode == zlib.Z_FINISH else self.compressor.flush()
+
+
+# Content codings in order of preference
+COMPRESSORS = {"gzip": gzip_compressor}
+if brotli is not None:
+    COMPRESSORS = {"br": BrotliCompressor, **COMPRESSORS}
+
+
+def compress_chunks(chunks: Iterable[bytes], compressor) -> Iterator[bytes]:
+    """
+    Compresses a stream, flushing after every chunk
+
+    Every chunk the application yields reaches the client as soon as it
+    is compressed instead of waiting in the compressor for more data.
+    """
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush(zlib.Z_FINISH)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+######################################################################
+#  R E S P O N S E   H O O K
+######################################################################
+@app.after_request
+def compress_response(response):
+    """Compresses the response when it is large enough and the client accepts it"""
+    if (
+        response.mimetype not in COMPRESSIBLE_MIMETYPES
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    encoding = request.accept_encodings.best_match(list(COMPRESSORS))
+    if encoding is None or request.method == "HEAD":
+        return response
+    if not response.is_streamed and (response.content_length or 0) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    compressor = COMPRESSORS[encoding](app.config)
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, compressor)
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.flush())
+    response.headers["Content-Encoding"] = encoding
+
+    # The compressed body is another representation, so its ETag can only be weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
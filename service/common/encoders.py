@@ -0,0 +1,176 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: encoders
+
+JSON encoders of the responses. The JSON_ENCODER setting picks the
+encoder: orjson when it is installed, the standard library json module
+otherwise. MessagePack is available when msgpack is installed.
+"""
+import json
+import uuid
+from datetime import date, datetime, timezone
+from typing import Callable, Iterable
+from flask import current_app as app  # Import Flask application
+from flask import Response, stream_with_context
+
+from service.models import DataValidationError
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+MSGPACK_MIMETYPE = "application/msgpack"
+
+
+######################################################################
+#  E N C O D E R S
+######################################################################
+def _default(value):
+    """Encodes the values json cannot, the same way orjson does"""
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_json(data) -> bytes:
+    """Encodes data with the standard library json module"""
+    return json.dumps(data, default=_default).encode("utf-8") + b"\n"
+
+
+def dumps_orjson(data) -> bytes:
+    """Encodes data with orjson, which handles UUID and datetime natively"""
+    return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+
+
+ENCODERS = {"json": dumps_json}
+if orjson is not None:
+    ENCODERS["orjson"] = dumps_orjson
+
+
+def get_encoder(config=None) -> Callable:
+    """
+    Returns the encoder selected by the JSON_ENCODER setting, json when it is not available
+
+    The setting is read from config, or from the current app when config is None.
+    """
+    config = app.config if config is None else config
+    return ENCODERS.get(config.get("JSON_ENCODER"), dumps_json)
+
+
+######################################################################
+#  M E S S A G E P A C K
+######################################################################
+def _msgpack_default(value):
+    """Encodes UUIDs as 16 byte binaries and datetimes as MessagePack timestamps"""
+    if isinstance(value, uuid.UUID):
+        return value.bytes
+    if isinstance(value, datetime):
+        # Naive datetimes are stored in UTC
+        return msgpack.Timestamp.from_datetime(value if value.tzinfo else value.replace(tzinfo=timezone.utc))
+    return _default(value)
+
+
+def dumps_msgpack(data) -> bytes:
+    """Encodes data as MessagePack"""
+    return msgpack.packb(data, default=_msgpack_default)
+
+
+def _to_json_values(value):
+    """Turns decoded MessagePack values back into the values of a JSON body"""
+    if isinstance(value, dict):
+        return {key: _to_json_values(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_to_json_values(item) for item in value]
+    if isinstance(value, bytes) and len(value) == 16:
+        return str(uuid.UUID(bytes=value))
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def loads_msgpack(data: bytes):
+    """
+    Decodes a MessagePack request body into the values a JSON body would have,
+    so it goes through the same validation
+
+    Raises:
+        DataValidationError: when the body is not MessagePack
+    """
+    try:
+        return _to_json_values(msgpack.unpackb(data, timestamp=3))
+    except (ValueError, msgpack.UnpackException) as error:
+        raise DataValidationError(f"Invalid MessagePack body: {error}") from error
+
+
+######################################################################
+#  S T R E A M I N G
+######################################################################
+def encode_items(encoder: Callable, items: list) -> bytes:
+    """Encodes a list as the comma separated items of a JSON array, without the brackets"""
+    # Drop the brackets and newline around the encoded list
+    return encoder(items)[1:-2]
+
+
+def output_json_array(batches: Iterable[list], code: int = 200, headers=None) -> Response:
+    """
+    Makes a Flask response streaming a JSON array encoded one batch at a time
+
+    Only one batch of items is encoded and held in memory at a time, so the
+    array can be far larger than the memory of the worker.
+    """
+    encoder = get_encoder()
+
+    def generate():
+        yield b"["
+        separator = b""
+        for batch in batches:
+            if batch:
+                yield separator + encode_items(encoder, batch)
+                separator = b","
+        yield b"]\n"
+
+    return Response(stream_with_context(generate()), code, headers, mimetype="application/json")
+
+
+def output_msgpack_stream(batches: Iterable[list], code: int = 200, headers=None) -> Response:
+    """
+    Makes a Flask response streaming a MessagePack array per batch of items
+
+    A MessagePack array needs its length up front, so each batch is its own
+    array: a list that fits in one batch, or an empty one, is a single array
+    msgpack.unpackb reads, a longer one a sequence of arrays msgpack.Unpacker
+    reads one after the other.
+    """
+
+    def generate():
+        empty = True
+        for batch in batches:
+            if batch:
+                empty = False
+                yield dumps_msgpack(batch)
+        if empty:
+            yield dumps_msgpack([])
+
+    return Response(stream_with_context(generate()), code, headers, mimetype=MSGPACK_MIMETYPE)
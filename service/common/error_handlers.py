@@ -18,7 +18,7 @@ Module: error_handlers
 """
 from flask import current_app as app  # Import Flask application
 from service.routes import api
-from service.models import DataValidationError
+from service.models import DataValidationError, VersionConflictError
 from . import status
 
 
@@ -37,6 +37,18 @@ def request_validation_error(error):
     }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(VersionConflictError)
+def version_conflict_error(error):
+    """Handles concurrent changes detected by the version column"""
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        "status_code": status.HTTP_412_PRECONDITION_FAILED,
+        "error": "Precondition Failed",
+        "message": message,
+    }, status.HTTP_412_PRECONDITION_FAILED
+
+
 # Note: This error handler is reserved for potential future enhancements.
 # @api.errorhandler(DatabaseConnectionError)
 # def database_connection_error(error):
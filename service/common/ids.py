@@ -0,0 +1,84 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: ids
+
+Time-ordered ids for the primary keys. A version 4 UUID is random, so every
+insert lands on a random page of the primary key index, splitting pages
+and pulling cold pages into the cache. A version 7 UUID (RFC 9562) starts
+with the Unix time in milliseconds, so new ids go to the right edge of the
+index like a sequence, while staying unguessable and unique across workers.
+
+Within a millisecond a 42 bit counter, started at a random value, keeps the
+ids of a process increasing, as uuid.uuid7 of Python 3.14 does.
+"""
+import os
+import threading
+import time
+import uuid
+
+COUNTER_MAX = (1 << 42) - 1
+# Version 7 in the version bits and the RFC 9562 variant
+VERSION_7_FLAGS = (0x7 << 76) | (0x2 << 62)
+
+_lock = threading.Lock()
+_last = {"timestamp": -1, "counter": 0}
+
+
+def _random_counter() -> int:
+    """Returns a counter for a new millisecond, with its top bit clear to leave room to count"""
+    return int.from_bytes(os.urandom(6), "big") & (COUNTER_MAX >> 1)
+
+
+def uuid7() -> uuid.UUID:
+    """Returns a version 7 UUID, greater than the previous one of this process"""
+    with _lock:
+        timestamp = time.time_ns() // 1_000_000
+        if timestamp > _last["timestamp"]:
+            counter = _random_counter()
+        else:
+            # Same millisecond, or the clock went back: count on from the last id
+            timestamp = _last["timestamp"]
+            counter = _last["counter"] + 1
+            if counter > COUNTER_MAX:
+                timestamp += 1
+                counter = _random_counter()
+        _last["timestamp"], _last["counter"] = timestamp, counter
+    return make_uuid7(timestamp, counter, int.from_bytes(os.urandom(4), "big"))
+
+
+def make_uuid7(timestamp: int, counter: int, tail: int) -> uuid.UUID:
+    """
+    Lays out a version 7 UUID
+
+    Args:
+        timestamp (int): the Unix time in milliseconds, 48 bits
+        counter (int): the counter ordering the ids of a millisecond, 42 bits
+        tail (int): random bits, 32 bits
+    """
+    value = (
+        (timestamp & 0xFFFF_FFFF_FFFF) << 80
+        | (counter >> 30 & 0xFFF) << 64
+        | (counter & 0x3FFF_FFFF) << 32
+        | tail & 0xFFFF_FFFF
+        | VERSION_7_FLAGS
+    )
+    return uuid.UUID(int=value)
+
+
+def uuid7_time(value: uuid.UUID) -> float:
+    """Returns the Unix time in seconds a version 7 UUID was made at"""
+    return (value.int >> 80) / 1000
@@ -0,0 +1,541 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: migrations
+
+Versioned schema of the database. Every migration is registered with a
+version number, and the schema_version table records the ones applied.
+Workers only compare the latest applied version with SCHEMA_VERSION at
+boot, a single query, while flask db-upgrade applies the missing
+migrations under an advisory lock, so concurrent upgraders never race.
+
+Migrations must not block the traffic of a hot table:
+
+* a transactional migration runs with MIGRATION_LOCK_TIMEOUT, and is
+  retried MIGRATION_LOCK_RETRIES times when it cannot get its locks
+* a migration registered with transactional=False runs in autocommit, for
+  create_index_concurrently() and backfill(), and must be safe to run again
+  if it is interrupted before its version is recorded
+
+When the promotions are sharded, every shard has the schema and its own
+schema_version table, and is upgraded like the primary.
+"""
+import logging
+import re
+import time
+from typing import Callable, NamedTuple
+from flask import current_app as app  # Import Flask application
+from sqlalchemy import Index, Table, func, insert, select, text, update
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateIndex
+from service.models import db, schema_version, promotion_key, Promotion
+from service.common import partitions
+from service.common.sharding import get_shards
+
+logger = logging.getLogger("flask.app")
+
+# Key of the advisory lock serializing the upgrades
+UPGRADE_LOCK = 4_242_001
+
+# SQLSTATE of lock_timeout
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+class Migration(NamedTuple):
+    """A registered migration"""
+
+    version: int
+    description: str
+    apply: Callable
+    transactional: bool
+
+
+# The migrations by version, applied in order
+MIGRATIONS: dict[int, Migration] = {}
+
+
+def migration(version: int, description: str, transactional: bool = True):
+    """
+    Registers a function applying a migration on a connection
+
+    Args:
+        version (int): the number of the migration, applied in increasing order
+        description (str): what the migration does, recorded in schema_version
+        transactional (bool): run the migration in a transaction, False for autocommit
+    """
+
+    def decorator(apply):
+        if version in MIGRATIONS:
+            raise ValueError(f"Migration {version} is already registered")
+        MIGRATIONS[version] = Migration(version, description, apply, transactional)
+        return apply
+
+    return decorator
+
+
+######################################################################
+#  O N L I N E   S C H E M A   C H A N G E S
+######################################################################
+def _index_valid(connection, name: str) -> bool | None:
+    """Returns whether an index is valid, None when it does not exist"""
+    return connection.scalar(
+        select(text("indisvalid")).select_from(text("pg_index")).where(text("indexrelid = to_regclass(:name)")),
+        {"name": name},
+    )
+
+
+def create_index_concurrently(connection, index: Index):
+    """
+    Builds an index without blocking the writes to its table
+
+    An index left invalid by an interrupted build is dropped and built again.
+    A partitioned table cannot build an index concurrently: its index is
+    created on the table alone, then built concurrently on every partition
+    and attached. Needs a connection in autocommit.
+    """
+    valid = _index_valid(connection, index.name)
+    statement = str(CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect))
+    partitioned = connection.scalar(
+        text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"), {"table": index.table.name}
+    )
+    if partitioned:
+        if not valid:
+            _create_partitioned_index(connection, index, statement)
+        return
+    if valid is False:
+        logger.warning("Rebuilding invalid index %s", index.name)
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+    logger.info("Creating index %s concurrently", index.name)
+    connection.execute(text(re.sub(r"^CREATE (UNIQUE )?INDEX", r"CREATE \1INDEX CONCURRENTLY", statement)))
+
+
+def _create_partitioned_index(connection, index: Index, statement: str):
+    """Builds the index of a partitioned table on the partitions without theirs, attaching them to it"""
+    table = index.table.name
+    connection.execute(text(statement.replace(f" ON {table} ", f" ON ONLY {table} ", 1)))
+    missing = connection.scalars(
+        text(
+            "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(:table) AND NOT EXISTS ("
+            "SELECT FROM pg_inherits attached JOIN pg_index ON pg_index.indexrelid = attached.inhrelid "
+            "WHERE attached.inhparent = to_regclass(:index) AND pg_index.indrelid = child.oid"
+            ") ORDER BY child.relname"
+        ),
+        {"table": table, "index": index.name},
+    ).all()
+    for partition in missing:
+        name = f"{partition}_{index.name}"
+        if _index_valid(connection, name) is False:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+        logger.info("Creating index %s concurrently", name)
+        create = partitions.partition_index(statement, index, partition)
+        connection.execute(text(re.sub(r"^CREATE (UNIQUE )?INDEX", r"CREATE \1INDEX CONCURRENTLY", create)))
+        # The index of the table becomes valid once every partition has its index attached
+        connection.execute(text(f'ALTER INDEX "{index.name}" ATTACH PARTITION "{name}"'))
+
+
+def backfill(connection, table: Table, values: dict, where, batch_size: int = None, pause: float = None) -> int:
+    """
+    Updates the rows matching where in small batches, pausing between them
+
+    Every batch is its own short transaction locking batch_size rows, and
+    rows locked by the traffic are skipped until a later batch, so the
+    table stays writable. The values must make the rows stop matching where,
+    which also makes an interrupted backfill safe to run again.
+    Needs a connection in autocommit.
+
+    Args:
+        connection: the connection to update with
+        table (Table): the table to update
+        values (dict): the new values by column name
+        where: the condition of the rows still to update
+        batch_size (int): the rows updated per transaction, MIGRATION_BATCH_SIZE by default
+        pause (float): the seconds to sleep between batches, MIGRATION_BATCH_PAUSE by default
+
+    Returns:
+        int: the number of rows updated
+    """
+    batch_size = batch_size or app.config["MIGRATION_BATCH_SIZE"]
+    pause = app.config["MIGRATION_BATCH_PAUSE"] if pause is None else pause
+    key = list(table.primary_key.columns)[0]
+    total = 0
+    while True:
+        batch = select(key).where(where).limit(batch_size).with_for_update(skip_locked=True)
+        updated = connection.execute(update(table).where(key.in_(batch.scalar_subquery())).values(values)).rowcount
+        total += updated
+        if updated == 0:
+            return total
+        logger.info("Backfilled %s rows of %s", total, table.name)
+        time.sleep(pause)
+
+
+def _apply(connection, step: Migration):
+    """Applies a migration with the lock timeout, retrying when it cannot get its locks"""
+    lock_timeout = app.config["MIGRATION_LOCK_TIMEOUT"]
+    retries = app.config["MIGRATION_LOCK_RETRIES"]
+    for attempt in range(retries + 1):
+        try:
+            if step.transactional:
+                with connection.begin():
+                    connection.execute(text("SELECT set_config('lock_timeout', :timeout, true)"), {"timeout": lock_timeout})
+                    step.apply(connection)
+                    connection.execute(insert(schema_version).values(version=step.version, description=step.description))
+            else:
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                try:
+                    connection.execute(text("SELECT set_config('lock_timeout', :timeout, false)"), {"timeout": lock_timeout})
+                    step.apply(connection)
+                    connection.execute(insert(schema_version).values(version=step.version, description=step.description))
+                finally:
+                    connection.execute(text("RESET lock_timeout"))
+                    connection.commit()  # ends the transaction object SQLAlchemy begins even in autocommit
+                    connection.execution_options(isolation_level=connection.default_isolation_level)
+            return
+        except OperationalError as error:
+            if getattr(error.orig, "sqlstate", None) != LOCK_NOT_AVAILABLE or attempt == retries:
+                raise
+            logger.warning("Migration %s timed out waiting for a lock, retrying", step.version)
+            time.sleep(2**attempt)
+
+
+######################################################################
+#  M I G R A T I O N S
+######################################################################
+# The tables of the first release, before any migration. Later migrations
+# change them, so this must not follow the models
+BASELINE_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS promotion (
+        id UUID NOT NULL,
+        product_ids JSONB,
+        name VARCHAR(255) NOT NULL,
+        description TEXT,
+        start_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        end_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        active_status BOOLEAN NOT NULL,
+        created_by UUID NOT NULL,
+        updated_by UUID NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        extra JSONB,
+        PRIMARY KEY (id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER NOT NULL,
+        description VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (version)
+    )
+    """,
+)
+
+
+@migration(1, "Create the tables")
+def create_tables(connection):
+    """Creates the tables of the first release that do not exist yet, keeping those the release made"""
+    for statement in BASELINE_TABLES:
+        connection.execute(text(statement))
+
+
+@migration(2, "Add the external_id column")
+def add_external_id(connection):
+    """Adds the key of the upstream feed, a nullable column without a default, so no row is rewritten"""
+    connection.execute(text("ALTER TABLE promotion ADD COLUMN IF NOT EXISTS external_id VARCHAR(255)"))
+
+
+@migration(3, "Add the version column", transactional=False)
+def add_version(connection):
+    """
+    Adds the version of optimistic concurrency control, 1 for the existing promotions
+
+    The column is added nullable with a default, so the previous release
+    can still insert, and backfilled in batches. NOT NULL is then proven by
+    a CHECK constraint validated without blocking the writes, which lets
+    SET NOT NULL skip its scan of the table.
+    """
+    table = Promotion.__table__
+    connection.execute(text("ALTER TABLE promotion ADD COLUMN IF NOT EXISTS version INTEGER"))
+    connection.execute(text("ALTER TABLE promotion ALTER COLUMN version SET DEFAULT 1"))
+    # The backfill is no change of the promotions, so it keeps their updated_at
+    backfill(connection, table, {"version": 1, "updated_at": table.c.updated_at}, table.c.version.is_(None))
+    not_null = connection.scalar(
+        text("SELECT attnotnull FROM pg_attribute WHERE attrelid = 'promotion'::regclass AND attname = 'version'")
+    )
+    if not not_null:
+        connection.execute(text("ALTER TABLE promotion DROP CONSTRAINT IF EXISTS promotion_version_not_null"))
+        connection.execute(
+            text("ALTER TABLE promotion ADD CONSTRAINT promotion_version_not_null CHECK (version IS NOT NULL) NOT VALID")
+        )
+        connection.execute(text("ALTER TABLE promotion VALIDATE CONSTRAINT promotion_version_not_null"))
+        connection.execute(text("ALTER TABLE promotion ALTER COLUMN version SET NOT NULL"))
+        connection.execute(text("ALTER TABLE promotion DROP CONSTRAINT promotion_version_not_null"))
+
+
+@migration(4, "Create the indexes of the promotion filters", transactional=False)
+def create_promotion_indexes(connection):
+    """Builds the indexes of the Promotion model the table does not have yet"""
+    for index in sorted(Promotion.__table__.indexes, key=lambda index: index.name):
+        create_index_concurrently(connection, index)
+
+
+# The partitioned table of migration 5, the columns and indexes of migrations
+# 1 to 4. Later migrations change it, so this must not follow the models
+PARTITIONED_COLUMNS = (
+    "id", "product_ids", "name", "description", "start_date", "end_date", "active_status",
+    "created_by", "updated_by", "created_at", "updated_at", "extra", "external_id", "version",
+)
+PARTITIONED_TABLE = (
+    """
+    CREATE TABLE promotion (
+        id UUID NOT NULL,
+        product_ids JSONB,
+        name VARCHAR(255) NOT NULL,
+        description TEXT,
+        start_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        end_date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        active_status BOOLEAN NOT NULL,
+        created_by UUID NOT NULL,
+        updated_by UUID NOT NULL,
+        created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        extra JSONB,
+        external_id VARCHAR(255),
+        version INTEGER DEFAULT 1 NOT NULL,
+        PRIMARY KEY (id, end_date)
+    ) PARTITION BY RANGE (end_date)
+    """,
+    "CREATE INDEX ix_promotion_end_date ON promotion (end_date, start_date)",
+    "CREATE INDEX ix_promotion_external_id ON promotion (external_id)",
+    "CREATE INDEX ix_promotion_name ON promotion (name)",
+    "CREATE INDEX ix_promotion_product_ids ON promotion USING gin (product_ids)",
+    "CREATE INDEX ix_promotion_summary ON promotion (start_date) INCLUDE (end_date, active_status, name, id)",
+)
+
+
+@migration(5, "Partition the promotion table by end_date")
+def partition_promotions(connection):
+    """
+    Turns the promotion table into one partitioned by month of end_date
+
+    The rows are copied into the partitions within the migration, and the
+    table stays locked until it commits: on a large table, run it in a
+    maintenance window with a longer MIGRATION_LOCK_TIMEOUT. A table that
+    is already partitioned only gets its partitions.
+    """
+    months_ahead = app.config["PARTITION_MONTHS_AHEAD"]
+    if partitions.is_partitioned(connection):
+        partitions.ensure_partitions(connection, months_ahead)
+        return
+    legacy = f"{partitions.TABLE}_unpartitioned"
+    connection.execute(text(f'ALTER TABLE "{partitions.TABLE}" RENAME TO "{legacy}"'))
+    # Frees the names of the indexes and constraints for the new table
+    indexes = connection.scalars(
+        text("SELECT relname FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid WHERE indrelid = to_regclass(:table)"),
+        {"table": legacy},
+    ).all()
+    for name in indexes:
+        connection.execute(text(f'ALTER INDEX "{name}" RENAME TO "{legacy}_{name}"'))
+    for statement in PARTITIONED_TABLE:
+        connection.execute(text(statement))
+    first = connection.scalar(text(f'SELECT min(end_date) FROM "{legacy}"'))
+    partitions.ensure_partitions(connection, months_ahead, since=first)
+    columns = ", ".join(PARTITIONED_COLUMNS)
+    moved = connection.execute(text(f'INSERT INTO "{partitions.TABLE}" ({columns}) SELECT {columns} FROM "{legacy}"')).rowcount
+    connection.execute(text(f'DROP TABLE "{legacy}"'))
+    logger.info("Moved %d promotions into partitions", moved)
+
+
+@migration(6, "Create the indexes of the scheduler", transactional=False)
+def create_scheduler_indexes(connection):
+    """Builds the partial indexes flask promotions-schedule looks the promotions to change up with"""
+    create_promotion_indexes(connection)
+
+
+# Keeps promotion_key in step with the promotion table. An update moving a row
+# to another partition runs as a DELETE and an INSERT. The INSERT completes the
+# key an upsert reserved with a NULL end_date, and else fails on a stored id
+PROMOTION_KEY_TRIGGER = (
+    """
+    CREATE OR REPLACE FUNCTION promotion_key_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            DELETE FROM promotion_key WHERE id = OLD.id;
+        ELSIF TG_OP = 'UPDATE' THEN
+            IF (NEW.id, NEW.external_id, NEW.end_date) IS DISTINCT FROM (OLD.id, OLD.external_id, OLD.end_date) THEN
+                UPDATE promotion_key SET id = NEW.id, external_id = NEW.external_id, end_date = NEW.end_date
+                WHERE id = OLD.id;
+            END IF;
+        ELSE
+            INSERT INTO promotion_key (id, external_id, end_date) VALUES (NEW.id, NEW.external_id, NEW.end_date)
+            ON CONFLICT (id) DO UPDATE SET external_id = EXCLUDED.external_id, end_date = EXCLUDED.end_date
+            WHERE promotion_key.end_date IS NULL;
+            IF NOT FOUND THEN
+                RAISE unique_violation USING MESSAGE = format('Promotion %s already exists', NEW.id);
+            END IF;
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    "DROP TRIGGER IF EXISTS promotion_key_sync ON promotion",
+    """
+    CREATE TRIGGER promotion_key_sync AFTER INSERT OR UPDATE OF id, external_id, end_date OR DELETE ON promotion
+    FOR EACH ROW EXECUTE FUNCTION promotion_key_sync()
+    """,
+)
+
+
+def create_key_trigger(connection):
+    """Creates the trigger keeping promotion_key in step with the promotion table"""
+    for statement in PROMOTION_KEY_TRIGGER:
+        connection.execute(text(statement))
+
+
+@migration(7, "Keep the unique keys of the promotions in promotion_key")
+def create_promotion_keys(connection):
+    """
+    Creates promotion_key, the ids and external_ids of every promotion
+
+    The unique indexes of the partitioned table must hold end_date, so they
+    cannot keep an id or an external_id unique: promotion_key does, and
+    tells the lookups by id the partition to read. The trigger is created
+    before the keys are copied, in the same transaction, so no write is
+    missed, and the keys already there are kept. A table with an external_id
+    stored twice fails the migration.
+    """
+    promotion_key.create(connection, checkfirst=True)
+    create_key_trigger(connection)
+    copied = connection.execute(
+        text(
+            "INSERT INTO promotion_key (id, external_id, end_date) SELECT id, external_id, end_date FROM promotion "
+            "ON CONFLICT (id) DO NOTHING"
+        )
+    ).rowcount
+    logger.info("Copied the keys of %d promotions", copied)
+
+
+@migration(8, "Add the schedule_override column")
+def add_schedule_override(connection):
+    """Adds the mark of the promotions deactivated by hand, false for the existing ones without rewriting the table"""
+    connection.execute(
+        text("ALTER TABLE promotion ADD COLUMN IF NOT EXISTS schedule_override BOOLEAN NOT NULL DEFAULT false")
+    )
+
+
+# The version the code needs
+SCHEMA_VERSION = max(MIGRATIONS)
+
+
+######################################################################
+#  V E R S I O N S
+######################################################################
+def current_version(connection=None) -> int:
+    """Returns the latest migration applied, 0 when there is none"""
+    statement = select(func.coalesce(func.max(schema_version.c.version), 0))  # pylint: disable=not-callable
+    executor = connection if connection is not None else db.session
+    try:
+        return executor.scalar(statement)
+    except ProgrammingError:
+        # The schema_version table does not exist yet
+        executor.rollback()
+        return 0
+
+
+def schema_engines() -> list:
+    """Returns the engines of the databases holding the schema, the primary first and then the shards"""
+    shards = get_shards()
+    return [db.engine, *(shards.engines.values() if shards is not None else ())]
+
+
+def check_schema(config) -> bool:
+    """
+    Checks the version of the schema when a worker starts
+
+    An older schema is upgraded when DATABASE_AUTO_UPGRADE is set. A newer
+    one is accepted, since migrations keep the previous release working.
+
+    Returns:
+        bool: False when the schema is too old for this code
+    """
+    version = current_version()
+    db.session.rollback()
+    for engine in schema_engines()[1:]:
+        with engine.connect() as connection:
+            version = min(version, current_version(connection))
+    if version > SCHEMA_VERSION:
+        logger.warning("Database schema version %s is newer than %s", version, SCHEMA_VERSION)
+    if version >= SCHEMA_VERSION:
+        return True
+    if config.get("DATABASE_AUTO_UPGRADE"):
+        upgrade()
+        return True
+    logger.critical(
+        "Database schema version %s is older than %s: run flask db-upgrade", version, SCHEMA_VERSION
+    )
+    return False
+
+
+def upgrade(target: int = SCHEMA_VERSION) -> list:
+    """
+    Applies the missing migrations up to target in order, on the primary and every shard
+
+    Returns:
+        list: the versions applied to any of the databases
+    """
+    applied = set()
+    for engine in schema_engines():
+        applied.update(upgrade_database(engine, target))
+    return sorted(applied)
+
+
+def upgrade_database(engine, target: int = SCHEMA_VERSION) -> list:
+    """
+    Applies the missing migrations of one database up to target in order
+
+    Returns:
+        list: the versions applied
+    """
+    applied = []
+    with engine.connect() as connection:
+        connection.execute(select(func.pg_advisory_lock(UPGRADE_LOCK)))
+        connection.commit()
+        try:
+            # Another upgrader may have finished while this one waited for the lock
+            version = current_version(connection)
+            connection.commit()
+            for number in sorted(MIGRATIONS):
+                if version < number <= target:
+                    logger.info("Applying migration %s: %s", number, MIGRATIONS[number].description)
+                    _apply(connection, MIGRATIONS[number])
+                    applied.append(number)
+        finally:
+            connection.execute(select(func.pg_advisory_unlock(UPGRADE_LOCK)))
+            connection.commit()
+    return applied
+
+
+def stamp(executor, target: int = SCHEMA_VERSION):
+    """Records every migration up to target as applied, for a schema made by create_all"""
+    executor.execute(
+        insert(schema_version),
+        [
+            {"version": step.version, "description": step.description}
+            for step in sorted(MIGRATIONS.values())
+            if step.version <= target
+        ],
+    )
@@ -0,0 +1,241 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: partitions
+
+The promotion table is partitioned by range of end_date, one partition per
+month. The reads ask for current and future promotions, and the planner
+skips the partitions of the months a filter on end_date excludes, so the
+years of expired promotions cost them nothing.
+
+* migration 5 turns an existing table into a partitioned one
+* the partitions are created PARTITION_MONTHS_AHEAD months ahead by flask
+  db-partitions and every pass of flask promotions-schedule, never by the
+  workers, whose boot takes no lock
+* the promotion_default partition takes the rows of a month without a
+  partition, and they move to its partition when it is created
+"""
+import logging
+import re
+from datetime import datetime
+from sqlalchemy import Index, func, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateIndex
+from service.models import Promotion, promotion_key, utc_now
+
+logger = logging.getLogger("flask.app")
+
+# Key of the advisory lock serializing the creation of partitions
+PARTITION_LOCK = 4_242_003
+
+TABLE = Promotion.__tablename__
+# The keys of the promotions, missing before migration 7
+KEY_TABLE = promotion_key.name
+DEFAULT_PARTITION = f"{TABLE}_default"
+PARTITION_NAME = re.compile(rf"^{TABLE}_p(\d{{4}})_(\d{{2}})$")
+
+
+def month_start(value: datetime) -> datetime:
+    """Returns the first instant of the month of a date"""
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    """Returns the first instant of the month months after month"""
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime) -> str:
+    """Returns the name of the partition of a month"""
+    return f"{TABLE}_p{month:%Y_%m}"
+
+
+def partition_index(statement: str, index: Index, partition: str) -> str:
+    """Rewrites the CREATE INDEX of an index of the table into the one of its copy on a partition"""
+    return re.sub(
+        rf"^CREATE (UNIQUE )?INDEX (IF NOT EXISTS )?{index.name} ON {index.table.name} ",
+        rf'CREATE \1INDEX \2"{partition}_{index.name}" ON "{partition}" ',
+        statement,
+    )
+
+
+def _create_table(connection, name: str):
+    """Creates a table to attach as a partition, with the indexes of the table named after it"""
+    connection.execute(text(f'CREATE TABLE "{name}" (LIKE "{TABLE}" INCLUDING DEFAULTS)'))
+    for index in sorted(Promotion.__table__.indexes, key=lambda index: index.name):
+        statement = str(CreateIndex(index).compile(dialect=connection.dialect))
+        connection.execute(text(partition_index(statement, index, name)))
+
+
+def is_partitioned(connection) -> bool:
+    """Tells whether the promotion table is partitioned"""
+    statement = text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)")
+    return bool(connection.scalar(statement, {"table": TABLE}))
+
+
+def partition_months(connection) -> list[datetime]:
+    """Returns the months having a partition, in order"""
+    names = connection.scalars(
+        text(
+            "SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(:table)"
+        ),
+        {"table": TABLE},
+    )
+    return sorted(datetime(int(match[1]), int(match[2]), 1) for match in map(PARTITION_NAME.match, names) if match)
+
+
+def create_partition(connection, month: datetime) -> int:
+    """
+    Creates the partition of a month
+
+    The rows of the month are moved out of the default partition first,
+    since a partition cannot be attached while the default one holds rows
+    of its range, and their keys, deleted by the trigger of the default
+    partition, are put back. Attaching adopts the indexes built on the
+    partition.
+
+    Returns:
+        int: the number of rows moved out of the default partition
+    """
+    name = partition_name(month)
+    bounds = {"start": month, "end": add_months(month, 1)}
+    _create_table(connection, name)
+    moved = connection.execute(
+        text(
+            f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE end_date >= :start AND end_date < :end '
+            f'RETURNING *) INSERT INTO "{name}" SELECT * FROM moved'
+        ),
+        bounds,
+    ).rowcount
+    if moved and connection.scalar(text("SELECT to_regclass(:name)"), {"name": KEY_TABLE}) is not None:
+        connection.execute(
+            text(
+                f'INSERT INTO {KEY_TABLE} (id, external_id, end_date) SELECT id, external_id, end_date FROM "{name}" '
+                "ON CONFLICT (id) DO NOTHING"
+            )
+        )
+    connection.execute(
+        text(
+            f"ALTER TABLE \"{TABLE}\" ATTACH PARTITION \"{name}\" "
+            f"FOR VALUES FROM ('{bounds['start']:%Y-%m-%d}') TO ('{bounds['end']:%Y-%m-%d}')"
+        )
+    )
+    logger.info("Created partition %s, moving %d rows into it", name, moved)
+    return moved
+
+
+def ensure_partitions(connection, months_ahead: int, since: datetime | None = None) -> list[str]:
+    """
+    Creates the default partition and the missing monthly partitions
+
+    The months run from since, or the first month having a partition, up to
+    months_ahead months after the current one. Runs in the transaction of
+    the connection, under an advisory lock so two workers never race.
+
+    Returns:
+        list[str]: the names of the partitions created
+    """
+    connection.execute(select(func.pg_advisory_xact_lock(PARTITION_LOCK)))
+    created = []
+    if connection.scalar(text("SELECT to_regclass(:name)"), {"name": DEFAULT_PARTITION}) is None:
+        _create_table(connection, DEFAULT_PARTITION)
+        connection.execute(text(f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{DEFAULT_PARTITION}" DEFAULT'))
+        created.append(DEFAULT_PARTITION)
+    existing = set(partition_months(connection))
+    last = add_months(month_start(utc_now()), months_ahead)
+    month = month_start(since) if since is not None else min(existing, default=month_start(utc_now()))
+    while month <= last:
+        if month not in existing:
+            create_partition(connection, month)
+            created.append(partition_name(month))
+        month = add_months(month, 1)
+    return created
+
+
+def partitions_due(connection, months_ahead: int) -> bool:
+    """Tells whether partitions are missing ahead of time, a single query"""
+    months = partition_months(connection)
+    return not months or months[-1] < add_months(month_start(utc_now()), months_ahead)
+
+
+def maintain_partitions(engines: list, months_ahead: int, lock_timeout: str | None = None) -> list[str]:
+    """
+    Creates the missing partitions of every database holding promotions
+
+    Attaching a partition waits for the queries reading the default one, so
+    with a lock_timeout it gives up rather than queueing the traffic.
+
+    Args:
+        engines (list): the engines of the databases, the primary and the shards
+        months_ahead (int): how many months after the current one must have a partition
+        lock_timeout (str): how long to wait for a lock, like MIGRATION_LOCK_TIMEOUT
+
+    Returns:
+        list[str]: the names of the partitions created
+    """
+    created = []
+    for engine in engines:
+        with engine.begin() as connection:
+            if partitions_due(connection, months_ahead):
+                if lock_timeout is not None:
+                    connection.execute(select(func.set_config("lock_timeout", lock_timeout, True)))
+                created.extend(ensure_partitions(connection, months_ahead))
+    return created
+
+
+def check_partitions(engines: list, config) -> list[str]:
+    """
+    Creates the partitions due for a pass of the scheduler, a single query per database when none is
+
+    A failure is only logged: the partitions are made months ahead, and the
+    next pass or flask db-partitions tries again.
+    """
+    try:
+        return maintain_partitions(engines, config["PARTITION_MONTHS_AHEAD"], config["MIGRATION_LOCK_TIMEOUT"])
+    except OperationalError as error:
+        logger.warning("%s: Cannot create the partitions", error)
+        return []
+
+
+def drop_empty_partitions(engines: list, before: datetime, lock_timeout: str | None = None) -> list[str]:
+    """
+    Drops the empty partitions of the months that ended before a date
+
+    Once flask promotions-archive moved their promotions out, the partitions
+    of the old months are dropped rather than left to vacuum. Dropping a
+    partition locks the table for a moment, so with a lock_timeout a busy
+    database is skipped until the next run.
+
+    Returns:
+        list[str]: the names of the partitions dropped
+    """
+    dropped = []
+    for engine in engines:
+        try:
+            with engine.begin() as connection:
+                if lock_timeout is not None:
+                    connection.execute(select(func.set_config("lock_timeout", lock_timeout, True)))
+                connection.execute(select(func.pg_advisory_xact_lock(PARTITION_LOCK)))
+                names = [partition_name(month) for month in partition_months(connection) if add_months(month, 1) <= before]
+                empty = [name for name in names if connection.scalar(text(f'SELECT NOT EXISTS (SELECT FROM "{name}")'))]
+                for name in empty:
+                    connection.execute(text(f'DROP TABLE "{name}"'))
+            dropped.extend(empty)
+        except OperationalError as error:
+            logger.warning("%s: Cannot drop the partitions", error)
+    return dropped
@@ -0,0 +1,197 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: replicas
+
+Sends the reads of the GET endpoints to read replicas. Every URI of
+DATABASE_REPLICA_URIS is a SQLAlchemy bind. A route decorated with
+replica_reads picks a healthy replica for the request, and the
+RoutingSession of the models runs the SELECT statements of the request on
+it. The primary serves:
+
+* the writes
+* the reads of a client that wrote in the last READ_PRIMARY_SECONDS, which
+  carries the read-primary cookie, or that sends X-Read-Primary: true
+* the reads when no replica is healthy, and a read that failed on a replica
+
+A replica is checked when it is first used and then every
+DATABASE_REPLICA_CHECK_INTERVAL seconds. It is skipped while it is
+unreachable or lags more than DATABASE_REPLICA_MAX_LAG seconds behind.
+"""
+import itertools
+import threading
+import time
+from functools import wraps
+from flask import current_app as app  # Import Flask application
+from flask import g, request
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from service.models import db
+
+REPLICA_BIND_PREFIX = "replica-"
+READ_PRIMARY_COOKIE = "read-primary"
+READ_PRIMARY_HEADER = "X-Read-Primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+POLICIES = ("round-robin", "least-connections")
+
+# Seconds the replica is behind the primary, 0 when it replayed all it received or is a primary
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class Replica:
+    """A replica engine and the result of its last health check"""
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.healthy = True
+        self.lag = 0.0
+        self.checked_at = None
+        self.checking = threading.Lock()
+
+
+class ReplicaSet:
+    """The replicas of the primary database, picked by a policy"""
+
+    def __init__(self, replicas: list, policy: str = "round-robin", check_interval: float = 10, max_lag: float = 5):
+        if policy not in POLICIES:
+            raise ValueError(f"DATABASE_REPLICA_POLICY must be one of {', '.join(POLICIES)}, not {policy}")
+        self.replicas = replicas
+        self.policy = policy
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self._turns = itertools.count()
+
+    @classmethod
+    def from_config(cls, engines: dict, config) -> "ReplicaSet":
+        """Returns the replicas among the engines of the binds"""
+        replicas = [
+            Replica(name, engine)
+            for name, engine in sorted(engines.items(), key=lambda item: str(item[0]))
+            if name and name.startswith(REPLICA_BIND_PREFIX)
+        ]
+        return cls(
+            replicas,
+            policy=config["DATABASE_REPLICA_POLICY"],
+            check_interval=config["DATABASE_REPLICA_CHECK_INTERVAL"],
+            max_lag=config["DATABASE_REPLICA_MAX_LAG"],
+        )
+
+    def check(self, replica: Replica) -> bool:
+        """Measures the lag of a replica, returning whether it is healthy"""
+        try:
+            with replica.engine.connect() as connection:
+                replica.lag = float(connection.scalar(LAG_QUERY))
+            replica.healthy = replica.lag <= self.max_lag
+            if not replica.healthy:
+                app.logger.warning("Replica %s is %.1f s behind the primary", replica.name, replica.lag)
+        except SQLAlchemyError as error:
+            replica.healthy = False
+            app.logger.warning("Replica %s is unavailable: %s", replica.name, error)
+        replica.checked_at = time.monotonic()
+        return replica.healthy
+
+    def mark_down(self, replica: Replica):
+        """Skips a replica until its next health check"""
+        replica.healthy = False
+        replica.checked_at = time.monotonic()
+
+    def healthy(self) -> list:
+        """Returns the healthy replicas, checking the ones due for a check"""
+        now = time.monotonic()
+        for replica in self.replicas:
+            due = replica.checked_at is None or now - replica.checked_at >= self.check_interval
+            # One thread checks a replica, the others go on with the last result
+            if due and replica.checking.acquire(blocking=False):
+                try:
+                    self.check(replica)
+                finally:
+                    replica.checking.release()
+        return [replica for replica in self.replicas if replica.healthy]
+
+    def choose(self) -> Replica | None:
+        """Returns the replica for the next request, None when no replica is healthy"""
+        replicas = self.healthy()
+        if not replicas:
+            return None
+        turn = next(self._turns) % len(replicas)
+        if self.policy == "least-connections":
+            # Ties go round-robin instead of always to the first replica
+            rotated = replicas[turn:] + replicas[:turn]
+            return min(rotated, key=lambda replica: replica.engine.pool.checkedout())
+        return replicas[turn]
+
+
+def get_replicas() -> ReplicaSet | None:
+    """Returns the replicas of this app, None when there is none"""
+    if "replicas" not in app.extensions:
+        replicas = ReplicaSet.from_config(db.engines, app.config)
+        app.extensions["replicas"] = replicas if replicas.replicas else None
+    return app.extensions["replicas"]
+
+
+def reads_from_primary() -> bool:
+    """Returns whether the client must read its own writes"""
+    return READ_PRIMARY_COOKIE in request.cookies or request.headers.get(READ_PRIMARY_HEADER, "").lower() == "true"
+
+
+######################################################################
+#  R O U T E   D E C O R A T O R
+######################################################################
+def replica_reads(func):
+    """Runs the reads of a route on a replica, or on the primary when it must"""
+
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        replicas = get_replicas()
+        if replicas is None or request.method not in SAFE_METHODS or reads_from_primary():
+            return func(*args, **kwargs)
+        replica = replicas.choose()
+        if replica is None:
+            return func(*args, **kwargs)
+        g.db_replica = replica.engine
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as error:
+            app.logger.warning("Read failed on replica %s, retrying on the primary: %s", replica.name, error)
+            replicas.mark_down(replica)
+            db.session.rollback()
+            g.pop("db_replica", None)
+            return func(*args, **kwargs)
+
+    return decorated_function
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+@app.after_request
+def stick_to_primary(response):
+    """Sends the next reads of a client that wrote to the primary, until the replicas caught up"""
+    if request.method not in SAFE_METHODS and response.status_code < 400 and get_replicas() is not None:
+        response.set_cookie(
+            READ_PRIMARY_COOKIE, "true", max_age=app.config["READ_PRIMARY_SECONDS"], httponly=True, samesite="Lax"
+        )
+    return response
+
+
+@app.teardown_request
+def forget_replica(_error=None):
+    """Leaves the next request of the app context free to pick its replica"""
+    g.pop("db_replica", None)
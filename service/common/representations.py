@@ -0,0 +1,44 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: representations
+
+Response representations registered with flask-restx
+"""
+from flask import make_response
+from service.routes import api
+from service.common.encoders import get_encoder, dumps_msgpack, msgpack, MSGPACK_MIMETYPE
+
+
+######################################################################
+#  R E P R E S E N T A T I O N S
+######################################################################
+@api.representation("application/json")
+def output_json(data, code, headers=None):
+    """Makes a Flask response with a JSON encoded body"""
+    response = make_response(get_encoder()(data), code)
+    response.headers.extend(headers or {})
+    return response
+
+
+if msgpack is not None:
+
+    @api.representation(MSGPACK_MIMETYPE)
+    def output_msgpack(data, code, headers=None):
+        """Makes a Flask response with a MessagePack encoded body"""
+        response = make_response(dumps_msgpack(data), code)
+        response.headers.extend(headers or {})
+        return response
@@ -1,7 +1,6 @@
 # import uuid
 from flask import current_app as app  # Import Flask application
 from datetime import datetime
-from dateutil.parser import parse, ParserError
 
 
 ######################################################################
@@ -11,10 +10,18 @@ from dateutil.parser import parse, ParserError
 
 def parse_with_try(date: str | None) -> datetime | None:
     """parse datetime string with try catch, return None if not valid"""
+    if not date:
+        return None
     try:
-        if date:
-            return parse(date)
-    except ParserError:
+        return datetime.fromisoformat(date)
+    except ValueError:
+        pass
+    # Other formats need dateutil, imported on first use to keep it out of the startup
+    from dateutil.parser import parse  # pylint: disable=import-outside-toplevel
+
+    try:
+        return parse(date)
+    except ValueError:
         # Invalid date format, should do nothing
         app.logger.error(
             "Invalid Date Format: %s",
@@ -0,0 +1,129 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: scheduler
+
+Flips active_status when the dates of a promotion pass. flask
+promotions-schedule runs a pass every SCHEDULE_INTERVAL seconds:
+
+* a promotion that started is activated, unless it already ended or was
+  deactivated by hand: the deactivate endpoint sets its schedule_override,
+  as does a write of an inactive promotion that started, and the activate
+  endpoint or a write of an active one clears it
+* a promotion that ended is deactivated, whatever set its active_status
+
+The passes update SCHEDULE_BATCH_SIZE rows per transaction, picked with FOR
+UPDATE SKIP LOCKED, so several schedulers share the work without waiting
+for each other or for the traffic. Every pass also creates the partitions
+due, see service/common/partitions.py.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+from service.models import Promotion, utc_now
+from service.common import migrations, partitions
+from service.common.sharding import promotion_engines
+
+logger = logging.getLogger("flask.app")
+
+
+def transitions(now: datetime) -> dict:
+    """Returns the new active_status and the condition of the promotions to change, by transition"""
+    table = Promotion.__table__
+    return {
+        "activated": (
+            True,
+            (~table.c.active_status, table.c.start_date <= now, table.c.end_date >= now, ~table.c.schedule_override),
+        ),
+        "deactivated": (False, (table.c.active_status, table.c.end_date < now)),
+    }
+
+
+def _apply_batch(engine, active: bool, where: tuple, now: datetime, batch_size: int) -> int:
+    """Changes the active_status of a batch of promotions, returning how many changed"""
+    table = Promotion.__table__
+    # Materialized, the batch is picked once: a subquery run again for every partition
+    # would skip the rows the UPDATE already changed and pick the next ones
+    batch = (
+        select(table.c.id, table.c.end_date)
+        .where(*where)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .cte("batch")
+        .prefix_with("MATERIALIZED")
+    )
+    # The condition is repeated so the update only visits the partitions it can match
+    statement = (
+        update(table)
+        .where(*where, table.c.id == batch.c.id, table.c.end_date == batch.c.end_date)
+        .values(active_status=active, updated_at=now, version=table.c.version + 1)
+    )
+    with engine.begin() as connection:
+        return connection.execute(statement).rowcount
+
+
+def apply_schedule(now: datetime | None = None, batch_size: int = 1000, pause: float = 0) -> dict:
+    """
+    Activates the promotions that started and deactivates those that ended
+
+    The updates bump the version and updated_at of the promotions like any
+    other update, so a client holding an older version gets a 412.
+
+    Args:
+        now (datetime): the time to compare the dates with, the current time by default
+        batch_size (int): the number of promotions updated per transaction
+        pause (float): the seconds to sleep between batches
+
+    Returns:
+        dict: the number of promotions activated and deactivated
+    """
+    now = now or utc_now()
+    counts = {}
+    for name, (active, where) in transitions(now).items():
+        counts[name] = 0
+        for engine in promotion_engines():
+            while changed := _apply_batch(engine, active, where, now, batch_size):
+                counts[name] += changed
+                logger.info("%s %d promotions", name.capitalize(), counts[name])
+                if pause:
+                    time.sleep(pause)
+    return counts
+
+
+def run_pass(config) -> dict:
+    """Runs one pass of the scheduler: the partitions due, then the activations and deactivations"""
+    created = partitions.check_partitions(migrations.schema_engines(), config)
+    counts = apply_schedule(batch_size=config["SCHEDULE_BATCH_SIZE"], pause=config["SCHEDULE_BATCH_PAUSE"])
+    return {**counts, "partitions": len(created)}
+
+
+def serve(config, stop: threading.Event):
+    """
+    Runs a pass of the scheduler every SCHEDULE_INTERVAL seconds until stop is set
+
+    A pass failing on the database is logged, and the next one tries again.
+    """
+    while True:
+        try:
+            counts = run_pass(config)
+            logger.info("Scheduler pass: %s", counts)
+        except OperationalError as error:
+            logger.warning("%s: Scheduler pass failed", error)
+        if stop.wait(config["SCHEDULE_INTERVAL"]):
+            return
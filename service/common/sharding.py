@@ -0,0 +1,225 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: sharding
+
+Spreads the promotions over several databases. Every URI of
+DATABASE_SHARD_URIS is a SQLAlchemy bind, and a consistent hash ring of the
+binds maps the id of a promotion to the shard holding it:
+
+* a write, a lookup by id and a patch run on the shard of the id
+* a list runs on every shard at once, and the rows sorted by id are merged
+* flask db-reshard moves the rows to their shard once a shard was added, or
+  off a database taken out of the ring with --drain
+
+Every shard has DATABASE_SHARD_VNODES points on the ring, so a new shard
+takes over about 1/N of the rows, evenly from the other shards. A shard is
+named by its position in DATABASE_SHARD_URIS: add new shards at the end.
+"""
+import bisect
+import hashlib
+import heapq
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from itertools import chain, islice
+from typing import Callable, Iterable, Iterator
+from flask import current_app as app  # Import Flask application
+from sqlalchemy import Table, column, delete, insert, select, tuple_, values
+
+SHARD_BIND_PREFIX = "shard-"
+
+
+def ring_hash(key: bytes) -> int:
+    """Returns the position of a key on the ring"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
+
+
+def shard_key(value) -> bytes:
+    """Returns the bytes of a promotion id the ring hashes"""
+    if isinstance(value, uuid.UUID):
+        return value.bytes
+    try:
+        return uuid.UUID(str(value)).bytes
+    except ValueError:
+        # Not an id, it matches no promotion on whichever shard it lands
+        return str(value).encode("utf-8")
+
+
+class HashRing:
+    """A consistent hash ring of names, with vnodes points per name"""
+
+    def __init__(self, names: Iterable[str], vnodes: int = 64):
+        points = sorted((ring_hash(f"{name}#{index}".encode("utf-8")), name) for name in names for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def lookup(self, key: bytes) -> str:
+        """Returns the name owning a key, the first point clockwise from its hash"""
+        index = bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._names[index]
+
+
+def _first_rows(engine, statement, batch_size: int, stack: ExitStack) -> Iterator:
+    """Runs a statement on an engine and fetches the first batch, in a worker thread"""
+    connection = stack.enter_context(engine.connect())
+    result = connection.execute(statement)
+    return chain(result.fetchmany(batch_size), result)
+
+
+class ShardSet:
+    """The shards of the promotions, with the ring mapping the ids to them"""
+
+    def __init__(self, engines: dict, vnodes: int = 64):
+        self.engines = engines
+        self.ring = HashRing(engines, vnodes)
+        self.pool = ThreadPoolExecutor(max_workers=len(engines) or 1, thread_name_prefix="shard")
+
+    @classmethod
+    def from_config(cls, engines: dict, config) -> "ShardSet":
+        """Returns the shards among the engines of the binds, in the order of DATABASE_SHARD_URIS"""
+        shards = sorted(
+            (int(name[len(SHARD_BIND_PREFIX):]), name, engine)
+            for name, engine in engines.items()
+            if name and name.startswith(SHARD_BIND_PREFIX)
+        )
+        return cls({name: engine for _, name, engine in shards}, config["DATABASE_SHARD_VNODES"])
+
+    def name_for(self, key) -> str:
+        """Returns the name of the shard of a promotion id"""
+        return self.ring.lookup(shard_key(key))
+
+    def engine_for(self, key):
+        """Returns the engine of the shard of a promotion id"""
+        return self.engines[self.name_for(key)]
+
+    def split(self, items: Iterable, key: Callable) -> dict:
+        """Groups items by the name of the shard of their id"""
+        groups = {}
+        for item in items:
+            groups.setdefault(self.name_for(key(item)), []).append(item)
+        return groups
+
+    def fan_out(self, statement, batch_size: int, key: Callable) -> Iterator[list]:
+        """
+        Runs a SELECT on every shard at once and merges the rows
+
+        Every shard streams its rows from a server-side cursor, so the
+        statement must be sorted by key for the merge to be sorted too. The
+        queries and their first batches run in parallel before this returns,
+        so their errors are raised here rather than while streaming.
+
+        Returns:
+            Iterator[list]: the merged rows, batch_size at a time
+        """
+        batches = self._merge(statement.execution_options(yield_per=batch_size), batch_size, key)
+        next(batches)
+        return batches
+
+    def _merge(self, statement, batch_size: int, key: Callable) -> Iterator[list]:
+        """Yields once the queries ran, then the merged batches, closing the connections at the end"""
+        with ExitStack() as stack:
+            futures = [
+                self.pool.submit(_first_rows, engine, statement, batch_size, stack) for engine in self.engines.values()
+            ]
+            # Every worker has its connection on the stack before the stack may close
+            wait(futures)
+            results = [future.result() for future in futures]
+            yield None
+            merged = heapq.merge(*results, key=key)
+            while batch := list(islice(merged, batch_size)):
+                yield batch
+
+
+def get_shards() -> ShardSet | None:
+    """Returns the shards of this app, None when the promotions are not sharded"""
+    if "shards" not in app.extensions:
+        shards = ShardSet.from_config(app.extensions["sqlalchemy"].engines, app.config)
+        app.extensions["shards"] = shards if shards.engines else None
+    return app.extensions["shards"]
+
+
+def promotion_engines() -> list:
+    """Returns the engines of the databases holding the promotions, the shards or else the primary"""
+    shards = get_shards()
+    if shards is None:
+        return [app.extensions["sqlalchemy"].engine]
+    return list(shards.engines.values())
+
+
+######################################################################
+#  R E S H A R D I N G
+######################################################################
+def _move(shards: ShardSet, table: Table, source, rows: list) -> int:
+    """Copies rows to their shards, then deletes the ones still unchanged from the source"""
+    for name, group in shards.split(rows, lambda row: row.id).items():
+        incoming = values(
+            column("id", table.c.id.type), column("version", table.c.version.type), name="incoming"
+        ).data([(row.id, row.version) for row in group])
+        with shards.engines[name].begin() as connection:
+            # Keep the highest version of a row: older copies make room, newer ones stay
+            connection.execute(
+                delete(table).where(table.c.id == incoming.c.id, table.c.version < incoming.c.version)
+            )
+            kept = set(connection.scalars(select(table.c.id).where(table.c.id.in_([row.id for row in group]))))
+            missing = [row._asdict() for row in group if row.id not in kept]
+            if missing:
+                connection.execute(insert(table).values(missing))
+    # A row written since it was read keeps its newer version here for the next run
+    keys = [(row.id, row.version) for row in rows]
+    with source.begin() as connection:
+        return connection.execute(delete(table).where(tuple_(table.c.id, table.c.version).in_(keys))).rowcount
+
+
+def reshard(shards: ShardSet, table: Table, source, drain: bool = False, batch_size: int = 1000,
+            pause: float = 0) -> int:
+    """
+    Moves the rows of a database that belong to another shard
+
+    The rows are read in id order, batch_size at a time. Each batch is
+    written to its shards, keeping the highest version of a row, and then
+    deleted from the source, so an interrupted run can simply be run again.
+
+    Args:
+        shards (ShardSet): the shards of the ring the rows must end up on
+        table (Table): the sharded table
+        source (Engine): the database to move the rows from
+        drain (bool): move every row, for a database that left the ring
+        batch_size (int): the number of rows read per batch
+        pause (float): the seconds to sleep between batches
+
+    Returns:
+        int: the number of rows moved
+    """
+    name = None if drain else next(name for name, engine in shards.engines.items() if engine is source)
+    moved = 0
+    last = None
+    while True:
+        statement = select(table).order_by(table.c.id).limit(batch_size)
+        if last is not None:
+            statement = statement.where(table.c.id > last)
+        with source.connect() as connection:
+            rows = connection.execute(statement).all()
+        if not rows:
+            return moved
+        last = rows[-1].id
+        misplaced = [row for row in rows if shards.name_for(row.id) != name]
+        if misplaced:
+            moved += _move(shards, table, source, misplaced)
+            app.logger.info("Moved %d rows off %s", moved, source.url.render_as_string())
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,81 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+"""
+Module: startup
+
+Measures the cold start of a worker. create_app times its phases with a
+StartupProfile and logs them at boot, with the modules each phase
+imported, so a slow dependency shows up in the logs of the pod that paid
+for it. import_breakdown() sums the output of python -X importtime by
+package, for the finer picture.
+"""
+import re
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# A line of python -X importtime: "import time: <self us> | <cumulative us> | <indented module>"
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+\d+ \| *(\S+)$")
+
+
+class StartupProfile:
+    """The time and imports of each phase of the startup"""
+
+    def __init__(self, start: float = None):
+        self.start = time.perf_counter() if start is None else start
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times the block as a phase of the startup"""
+        start = time.perf_counter()
+        modules = len(sys.modules)
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start, len(sys.modules) - modules))
+
+    @property
+    def total(self) -> float:
+        """Returns the seconds since the start"""
+        return time.perf_counter() - self.start
+
+    def report(self) -> str:
+        """Returns the phases as a line for the logs"""
+        phases = ", ".join(
+            f"{name} {seconds * 1000:.0f} ms ({modules} modules)" for name, seconds, modules in self.phases
+        )
+        return f"{phases}, total {self.total * 1000:.0f} ms"
+
+
+def import_breakdown(output: str, depth: int = 1) -> list:
+    """
+    Sums the self time of the modules in python -X importtime output by package
+
+    Args:
+        output (str): the standard error of python -X importtime
+        depth (int): the number of dotted name parts that make the package
+
+    Returns:
+        list: (package, seconds) tuples, slowest first
+    """
+    packages = defaultdict(int)
+    for line in output.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            packages[".".join(match.group(2).split(".")[:depth])] += int(match.group(1))
+    return sorted(((package, micros / 1_000_000) for package, micros in packages.items()), key=lambda item: -item[1])
@@ -15,6 +15,80 @@ SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
 
+# The GET endpoints read from one of the DATABASE_REPLICA_URIS (comma separated), picked
+# round-robin or by least-connections (DATABASE_REPLICA_POLICY), see service/common/replicas.py
+DATABASE_REPLICA_URIS = [uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()]
+# The promotions are spread over the DATABASE_SHARD_URIS (comma separated) when there are
+# any, by a hash ring with DATABASE_SHARD_VNODES points per shard, see service/common/sharding.py
+DATABASE_SHARD_URIS = [uri.strip() for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri.strip()]
+DATABASE_SHARD_VNODES = int(os.getenv("DATABASE_SHARD_VNODES", "64"))
+SQLALCHEMY_BINDS = {
+    **{f"replica-{index}": {"url": uri, "pool_pre_ping": True} for index, uri in enumerate(DATABASE_REPLICA_URIS)},
+    **{f"shard-{index}": {"url": uri, "pool_pre_ping": True} for index, uri in enumerate(DATABASE_SHARD_URIS)},
+}
+DATABASE_REPLICA_POLICY = os.getenv("DATABASE_REPLICA_POLICY", "round-robin")
+# A replica is checked every DATABASE_REPLICA_CHECK_INTERVAL seconds, and skipped while it is
+# unreachable or more than DATABASE_REPLICA_MAX_LAG seconds behind the primary
+DATABASE_REPLICA_CHECK_INTERVAL = float(os.getenv("DATABASE_REPLICA_CHECK_INTERVAL", "10"))
+DATABASE_REPLICA_MAX_LAG = float(os.getenv("DATABASE_REPLICA_MAX_LAG", "5"))
+# A client that wrote reads from the primary for READ_PRIMARY_SECONDS, to see its writes
+READ_PRIMARY_SECONDS = int(os.getenv("READ_PRIMARY_SECONDS", "10"))
+
+# Workers refuse to start on an older schema: flask db-upgrade applies the migrations
+# before the rollout. Set it to true to let a worker apply them itself when it starts
+DATABASE_AUTO_UPGRADE = os.getenv("DATABASE_AUTO_UPGRADE", "false").lower() == "true"
+
+# Migrations give up waiting for a lock after MIGRATION_LOCK_TIMEOUT instead of queueing
+# the traffic behind them, and retry MIGRATION_LOCK_RETRIES times with a backoff
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "2s")
+MIGRATION_LOCK_RETRIES = int(os.getenv("MIGRATION_LOCK_RETRIES", "5"))
+# Backfills update MIGRATION_BATCH_SIZE rows per transaction, sleeping between batches
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+MIGRATION_BATCH_PAUSE = float(os.getenv("MIGRATION_BATCH_PAUSE", "0.1"))
+# The promotion table has a partition per month of end_date up to PARTITION_MONTHS_AHEAD
+# months from now, see service/common/partitions.py
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "12"))
+# flask promotions-archive moves the expired promotions to segments in ARCHIVE_DIR, compressed
+# in blocks of ARCHIVE_BLOCK_SIZE promotions, see service/common/archive.py
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_BLOCK_SIZE = int(os.getenv("ARCHIVE_BLOCK_SIZE", "64"))
+# The segments are merged once ARCHIVE_COMPACT_FANOUT of them are about the same size, and
+# lookups keep the ARCHIVE_MAX_OPEN_SEGMENTS segments used last memory mapped
+ARCHIVE_COMPACT_FANOUT = int(os.getenv("ARCHIVE_COMPACT_FANOUT", "8"))
+ARCHIVE_MAX_OPEN_SEGMENTS = int(os.getenv("ARCHIVE_MAX_OPEN_SEGMENTS", "64"))
+# flask promotions-schedule flips active_status at the dates of the promotions every
+# SCHEDULE_INTERVAL seconds, SCHEDULE_BATCH_SIZE rows per transaction with a pause between
+SCHEDULE_INTERVAL = float(os.getenv("SCHEDULE_INTERVAL", "60"))
+SCHEDULE_BATCH_SIZE = int(os.getenv("SCHEDULE_BATCH_SIZE", "1000"))
+SCHEDULE_BATCH_PAUSE = float(os.getenv("SCHEDULE_BATCH_PAUSE", "0.1"))
+
+# Seconds from the import of the service to the end of create_app, a warning is logged above it
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET", "2.0"))
+
+# Reject updates without an If-Match header instead of only honoring it
+REQUIRE_IF_MATCH = os.getenv("REQUIRE_IF_MATCH", "false").lower() == "true"
+
+# Encoder of JSON responses: orjson (when installed) or json
+JSON_ENCODER = os.getenv("JSON_ENCODER", "orjson")
+
+# Number of rows fetched and encoded at a time when streaming a list of promotions
+LIST_BATCH_SIZE = int(os.getenv("LIST_BATCH_SIZE", "1000"))
+
+# Responses of at least COMPRESS_MIN_SIZE bytes, and every streamed response,
+# are compressed with gzip at COMPRESS_LEVEL (1-9) or brotli at COMPRESS_BROTLI_LEVEL (0-11)
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_BROTLI_LEVEL = int(os.getenv("COMPRESS_BROTLI_LEVEL", "4"))
+
+# Connection pool of the async engine serving the read endpoints of asgi.py
+ASYNC_DB_POOL_SIZE = int(os.getenv("ASYNC_DB_POOL_SIZE", "10"))
+ASYNC_DB_MAX_OVERFLOW = int(os.getenv("ASYNC_DB_MAX_OVERFLOW", "10"))
+
+# /api/swagger.json is read from API_SPEC_FILE when it exists, see flask api-spec-export,
+# and may be cached by clients for API_SPEC_MAX_AGE seconds
+API_SPEC_FILE = os.getenv("API_SPEC_FILE", "")
+API_SPEC_MAX_AGE = int(os.getenv("API_SPEC_MAX_AGE", "86400"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
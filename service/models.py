@@ -6,16 +6,86 @@ All of the models are stored in this module
 
 import logging
 import uuid
+from operator import attrgetter
+from typing import Iterator
 from datetime import datetime, timezone
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from sqlalchemy.dialects.postgresql import UUID, JSONB  # Import JSONB for PostgreSQL
+from sqlalchemy.dialects.postgresql import insert, ARRAY
 from sqlalchemy.orm import Query
-from sqlalchemy import func
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy import and_, bindparam, event, false, func, literal, true, tuple_, case, select, text, update, Text, Select
+from service.common.ids import uuid7
+from service.common.sharding import get_shards
 
 logger = logging.getLogger("flask.app")
 
+# Key of the advisory lock serializing the sharded upserts, see Promotion.upsert
+UPSERT_LOCK = 4_242_002
+
+
+class RoutingSession(Session):
+    """
+    Runs the SELECT statements of a request on the replica it was given, see
+    service/common/replicas.py, and flushes the promotions to their shard, see
+    service/common/sharding.py
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and isinstance(clause, Select) and has_app_context():
+            replica = g.get("db_replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    @property
+    def connection_callable(self):
+        """The connection of every instance a flush writes, None to write them all to the primary"""
+        if has_app_context() and get_shards() is not None:
+            return self.shard_connection
+        return None
+
+    def shard_connection(self, _mapper, instance):
+        """Returns the connection of the shard of an instance, giving it its id first"""
+        if instance.id is None:
+            instance.id = uuid7()
+        return self.connection(bind_arguments={"bind": get_shards().engine_for(instance.id)})
+
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def refresh_from_shard(orm_execute_state):
+    """Reloads the expired attributes of a sharded instance from its shard instead of the primary"""
+    if not orm_execute_state.is_column_load or "bind" in orm_execute_state.bind_arguments:
+        return None
+    shards = get_shards()
+    refresh_state = orm_execute_state.load_options._refresh_state  # pylint: disable=protected-access
+    if shards is None or refresh_state is None:
+        return None
+    return orm_execute_state.invoke_statement(bind_arguments={"bind": shards.engine_for(refresh_state.identity[0])})
+
+
+def shard_bind(by_id) -> dict | None:
+    """Returns the bind arguments running a statement on the shard of an id, None when unsharded"""
+    shards = get_shards()
+    return None if shards is None else {"bind": shards.engine_for(by_id)}
+
+
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+
+def to_naive_utc(value: datetime) -> datetime:
+    """Converts a datetime to the naive UTC value the timestamp columns store"""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def utc_now() -> datetime:
+    """Returns the current time as a naive UTC datetime"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 class DataValidationError(Exception):
@@ -26,13 +96,37 @@ class DatabaseConnectionError(Exception):
     """Custom Exception when database connection fails"""
 
 
-class Promotion(db.Model):
+class VersionConflictError(Exception):
+    """Used when a Promotion was changed by someone else since it was read"""
+
+
+# The migrations applied to the database, see service/common/migrations.py
+schema_version = db.Table(
+    "schema_version",
+    db.Column("version", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("description", db.String(255), nullable=False),
+    db.Column("applied_at", db.DateTime, nullable=False, default=utc_now),
+)
+
+# The unique keys of the promotions, which the partitioned table cannot enforce since
+# its unique indexes must hold end_date. A trigger keeps it in step, see migration 7
+promotion_key = db.Table(
+    "promotion_key",
+    db.Column("id", UUID(as_uuid=True), primary_key=True),
+    db.Column("external_id", db.String(255), unique=True),
+    # The partition of the promotion, NULL while an upsert reserves the key of a new one
+    db.Column("end_date", db.DateTime),
+)
+
+
+class Promotion(db.Model):  # pylint: disable=too-many-public-methods,too-many-instance-attributes
     """
     Represents a promotion for products, including details like name, start and end dates,
     and additional metadata.
 
     Attributes:
-        id (UUID, required): A unique identifier for the promotion, generated automatically as a UUID.
+        id (UUID, required): A unique identifier for the promotion, generated automatically as a time-ordered
+            version 7 UUID, see service/common/ids.py.
         product_ids (JSONB, optional): A list of product IDs associated with the promotion, stored as a JSON array.
         name (str, required): The name of the promotion.
         description (str, optional): A detailed description of the promotion.
@@ -44,31 +138,96 @@ class Promotion(db.Model):
         created_at (datetime, required): The timestamp when the promotion was created, default set to the current UTC time.
         updated_at (datetime, required): The timestamp when the promotion was last updated.
         extra (JSONB, optional): Additional metadata for the promotion, stored as a JSON object.
+        external_id (str, optional): The unique key of the promotion in the upstream feed.
+        version (int, required): Incremented by every update, used for optimistic concurrency control.
+        schedule_override (bool, required): Set when the promotion is deactivated by hand, or written
+            inactive once it has started, so the scheduler does not activate it.
     """
 
     ##################################################
     # Table Schema
     ##################################################
 
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
     product_ids = db.Column(JSONB, nullable=True)
     name = db.Column(db.String(255), nullable=False)
     description = db.Column(db.Text)
     start_date = db.Column(db.DateTime, nullable=False)
-    end_date = db.Column(db.DateTime, nullable=False)
+    # The partition key, so part of the primary key of the table, see service/common/partitions.py
+    end_date = db.Column(db.DateTime, primary_key=True, nullable=False)
     active_status = db.Column(db.Boolean, nullable=False)
     created_by = db.Column(UUID(as_uuid=True), nullable=False)
     updated_by = db.Column(UUID(as_uuid=True), nullable=False)
-    created_at = db.Column(
-        db.DateTime, nullable=False, default=datetime.now(timezone.utc)
-    )
+    created_at = db.Column(db.DateTime, nullable=False, default=utc_now)
     updated_at = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.now(timezone.utc),
-        onupdate=datetime.now(timezone.utc),
+        default=utc_now,
+        onupdate=utc_now,
     )
     extra = db.Column(JSONB)
+    # Unique in promotion_key, the unique indexes of the table must hold end_date
+    external_id = db.Column(db.String(255), nullable=True)
+    # The default keeps the inserts of a release without the column working, see migration 3
+    version = db.Column(db.Integer, nullable=False, server_default=text("1"))
+    # Set by the deactivate endpoint, cleared by the activate one, see service/common/scheduler.py
+    schedule_override = db.Column(db.Boolean, nullable=False, default=False, server_default=text("false"))
+
+    # Holds every column of the summary view of the list endpoint, so listing
+    # it by start date is answered with an index-only scan
+    # Existing databases get new indexes from a migration, see service/common/migrations.py
+    __table_args__ = (
+        db.Index(
+            "ix_promotion_summary",
+            "start_date",
+            postgresql_include=["end_date", "active_status", "name", "id"],
+        ),
+        # Filters of the list endpoint
+        db.Index("ix_promotion_end_date", "end_date", "start_date"),
+        db.Index("ix_promotion_name", "name"),
+        db.Index("ix_promotion_product_ids", "product_ids", postgresql_using="gin"),
+        db.Index("ix_promotion_external_id", "external_id"),
+        # Conditions of the scheduler, see service/common/scheduler.py: few rows match
+        # them once it caught up, so it finds the next ones without scanning the table
+        db.Index("ix_promotion_inactive_start", "start_date", postgresql_where=text("NOT active_status")),
+        db.Index("ix_promotion_active_end", "end_date", postgresql_where=text("active_status")),
+        # One partition per month of end_date, see service/common/partitions.py
+        {"postgresql_partition_by": "RANGE (end_date)"},
+    )
+
+    # Every UPDATE and DELETE matches "WHERE id = :id AND end_date = :end_date
+    # AND version = :version" and increments the version, so a concurrent
+    # change makes it fail. The end_date it was read with skips the other partitions
+    __mapper_args__ = {"version_id_col": version, "primary_key": [id, end_date]}
+
+    # Columns an upsert writes; the key, id and timestamps are managed separately
+    UPSERT_COLUMNS = (
+        "external_id",
+        "product_ids",
+        "name",
+        "description",
+        "start_date",
+        "end_date",
+        "active_status",
+        "created_by",
+        "updated_by",
+        "extra",
+    )
+
+    # Fields a JSON Merge Patch may change, and those it may not remove
+    PATCH_COLUMNS = (
+        "product_ids",
+        "name",
+        "description",
+        "start_date",
+        "end_date",
+        "active_status",
+        "created_by",
+        "updated_by",
+        "extra",
+        "external_id",
+    )
+    REQUIRED_COLUMNS = ("name", "start_date", "end_date", "active_status", "created_by", "updated_by")
 
     def __repr__(self):
         return f"<Promotion {self.name} id=[{self.id}]>"
@@ -87,17 +246,33 @@ class Promotion(db.Model):
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
 
-    def update(self):
+    def update(self) -> bool:
         """
         Updates a Promotion to the database
+
+        Nothing is written when no column actually changed, so an identical
+        update costs no UPDATE, no WAL and keeps updated_at as it was.
+
+        Returns:
+            bool: True when the Promotion was written, False when it was unchanged
         """
+        if not db.session.is_modified(self):
+            logger.info("Skipping unchanged %s", self.name)
+            return False
         logger.info("Saving %s", self.name)
         try:
             db.session.commit()
+        except StaleDataError as e:
+            db.session.rollback()
+            logger.warning("Version conflict updating record: %s", self)
+            raise VersionConflictError(
+                f"Promotion with id '{self.id}' was changed by another request"
+            ) from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
+        return True
 
     def delete(self):
         """Removes a Promotion from the data store"""
@@ -105,6 +280,12 @@ class Promotion(db.Model):
         try:
             db.session.delete(self)
             db.session.commit()
+        except StaleDataError as e:
+            db.session.rollback()
+            logger.warning("Version conflict deleting record: %s", self)
+            raise VersionConflictError(
+                f"Promotion with id '{self.id}' was changed by another request"
+            ) from e
         except Exception as e:
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
@@ -125,6 +306,9 @@ class Promotion(db.Model):
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat(),
             "extra": self.extra,
+            "external_id": self.external_id,
+            "version": self.version,
+            "schedule_override": self.schedule_override,
         }
 
     def deserialize(self, data):
@@ -135,29 +319,21 @@ class Promotion(db.Model):
             data (dict): A dictionary containing the resource data
         """
         try:
-            self.name = data["name"]
-            self.start_date = datetime.fromisoformat(data["start_date"])
-            self.end_date = datetime.fromisoformat(data["end_date"])
-            self.active_status = data["active_status"]
-            self.created_by = uuid.UUID(data["created_by"])  # Convert string to UUID
-            self.updated_by = uuid.UUID(data["updated_by"])  # Convert string to UUID
+            self.name = self._parse_name(data["name"])
+            self.start_date = self._parse_date(data["start_date"])
+            self.end_date = self._parse_date(data["end_date"])
+            self.active_status = self._parse_active_status(data["active_status"])
+            self.created_by = self._parse_uuid(data["created_by"])
+            self.updated_by = self._parse_uuid(data["updated_by"])
 
             # Optional fields (use `.get()` to avoid KeyError if not present)
-            product_ids = data.get("product_ids")
-            if product_ids is not None:
-                if isinstance(product_ids, str):
-                    product_ids = [pid.strip() for pid in product_ids.split(",")]
-                elif not isinstance(product_ids, list):
-                    raise DataValidationError(
-                        "Invalid product_ids: must be a list or comma-separated string"
-                    )
-
-                self.product_ids = product_ids
-            else:
-                self.product_ids = []
-
-            self.description = data.get("description")
+            self.product_ids = self._parse_product_ids(data.get("product_ids"))
+            self.description = self._parse_description(data.get("description"))
             self.extra = data.get("extra")
+            self.external_id = self._parse_external_id(data)
+            self.schedule_override = self._overrides_schedule(
+                self.active_status, self.start_date, self.end_date, bool(self.schedule_override), utc_now()
+            )
 
         except KeyError as error:
             raise DataValidationError(
@@ -175,21 +351,488 @@ class Promotion(db.Model):
             ) from error
         return self
 
+    @staticmethod
+    def _overrides_schedule(active_status: bool, start_date: datetime, end_date: datetime, stored: bool,
+                            now: datetime) -> bool:
+        """
+        Returns the schedule_override left by a write of active_status and the dates
+
+        Writing an active promotion clears it. Writing an inactive one that has
+        started sets it, so the scheduler does not activate it again, and
+        writing one that has not started keeps the stored value.
+        """
+        if active_status:
+            return False
+        if start_date <= now <= end_date:
+            return True
+        return stored
+
+    @classmethod
+    def _schedule_override_value(cls, active_status, start_date, end_date, now: datetime):
+        """Builds the SQL expression of the schedule_override left by an UPDATE, as _overrides_schedule"""
+        table = cls.__table__
+        return case(
+            (active_status, false()),
+            (and_(start_date <= now, end_date >= now), true()),
+            else_=table.c.schedule_override,
+        )
+
+    @staticmethod
+    def _parse_name(name) -> str:
+        """Accepts a name that fits the column"""
+        if not isinstance(name, str):
+            raise DataValidationError("Invalid Promotion: name must be a string")
+        if len(name) > Promotion.name.type.length:
+            raise DataValidationError(
+                f"Invalid Promotion: name must be at most {Promotion.name.type.length} characters"
+            )
+        return name
+
+    @staticmethod
+    def _parse_date(value) -> datetime:
+        """Parses an ISO 8601 date into the naive UTC value the columns store"""
+        return to_naive_utc(datetime.fromisoformat(value))
+
+    @staticmethod
+    def _parse_active_status(active_status) -> bool:
+        """Accepts only a real boolean"""
+        if not isinstance(active_status, bool):
+            raise DataValidationError("Invalid Promotion: active_status must be a boolean")
+        return active_status
+
+    @staticmethod
+    def _parse_uuid(value) -> uuid.UUID:
+        """Converts a UUID string to a UUID"""
+        if not isinstance(value, str):
+            raise TypeError(f"{value!r} is not a UUID string")
+        return uuid.UUID(value)
+
+    @staticmethod
+    def _parse_description(description) -> str | None:
+        """Accepts a description string or null"""
+        if description is not None and not isinstance(description, str):
+            raise DataValidationError("Invalid Promotion: description must be a string")
+        return description
+
+    @staticmethod
+    def _parse_product_ids(product_ids) -> list:
+        """Accepts product ids as a list or a comma-separated string"""
+        if product_ids is None:
+            return []
+        if isinstance(product_ids, str):
+            return [pid.strip() for pid in product_ids.split(",")]
+        if not isinstance(product_ids, list):
+            raise DataValidationError(
+                "Invalid product_ids: must be a list or comma-separated string"
+            )
+        return product_ids
+
+    @staticmethod
+    def _parse_external_id(data) -> str | None:
+        """Reads the upstream key from external_id, falling back to extra.external_id"""
+        external_id = data.get("external_id")
+        if external_id is None and isinstance(data.get("extra"), dict):
+            external_id = data["extra"].get("external_id")
+        if external_id is None or external_id == "":
+            return None
+        if not isinstance(external_id, str):
+            raise DataValidationError("Invalid Promotion: external_id must be a string")
+        return external_id
+
     ##################################################
     # CLASS METHODS
     ##################################################
 
+    @classmethod
+    def deserialize_patch(cls, data) -> dict:
+        """
+        Validates a JSON Merge Patch (RFC 7396), checking only the fields it contains
+
+        Args:
+            data (dict): the merge patch, null removes an optional field
+
+        Returns:
+            dict: the column values to set
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError("Invalid Promotion: merge patch must be an object")
+        unknown = sorted(set(data) - set(cls.PATCH_COLUMNS))
+        if unknown:
+            raise DataValidationError(f"Invalid Promotion: cannot patch {', '.join(unknown)}")
+
+        parsers = {
+            "product_ids": cls._parse_product_ids,
+            "name": cls._parse_name,
+            "description": cls._parse_description,
+            "start_date": cls._parse_date,
+            "end_date": cls._parse_date,
+            "active_status": cls._parse_active_status,
+            "created_by": cls._parse_uuid,
+            "updated_by": cls._parse_uuid,
+            "extra": lambda extra: extra,
+            "external_id": lambda external_id: cls._parse_external_id({"external_id": external_id}),
+        }
+        values = {}
+        try:
+            for name, value in data.items():
+                if value is None and name in cls.REQUIRED_COLUMNS:
+                    raise DataValidationError(f"Invalid Promotion: {name} cannot be removed")
+                values[name] = parsers[name](value)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(
+                "Invalid Promotion: body of request contained bad data type " + str(error)
+            ) from error
+        return values
+
+    @classmethod
+    def _merge_extra(cls, extra: dict):
+        """
+        Builds the SQL expression merging an object into the extra column
+
+        Keys set to null are removed and the others replace the stored keys,
+        one level deep, all inside the UPDATE statement.
+        """
+        column = cls.__table__.c.extra
+        stored = case(
+            (func.jsonb_typeof(column) == "object", column),
+            else_=literal({}, JSONB),
+        )
+        merged = stored.op("||")(
+            literal({key: value for key, value in extra.items() if value is not None}, JSONB)
+        )
+        removed = [key for key, value in extra.items() if value is None]
+        if removed:
+            merged = merged.op("-")(literal(removed, ARRAY(Text)))
+        return merged
+
+    @classmethod
+    def patch(cls, by_id, data, versions: list | None = None):
+        """
+        Applies a JSON Merge Patch with a single UPDATE ... RETURNING
+
+        Only the supplied fields are validated and set. The statement matches
+        nothing when the stored values already equal the patch, so a no-op
+        patch writes nothing.
+
+        Args:
+            by_id (UUID): the id of the Promotion to patch
+            data (dict): the merge patch
+            versions (list, optional): the versions the Promotion must be at
+
+        Returns:
+            tuple: the patched (or unchanged) row, and whether it was written
+
+        Raises:
+            VersionConflictError: when the Promotion is not at one of the versions
+        """
+        logger.info("Processing patch for id %s ...", by_id)
+        table = cls.__table__
+        values = {
+            name: literal(value, table.c[name].type)
+            for name, value in cls.deserialize_patch(data).items()
+        }
+        if isinstance(data.get("extra"), dict):
+            values["extra"] = cls._merge_extra(data["extra"])
+        now = utc_now()
+        if "active_status" in values:
+            values["schedule_override"] = cls._schedule_override_value(
+                values["active_status"],
+                values.get("start_date", table.c.start_date),
+                values.get("end_date", table.c.end_date),
+                now,
+            )
+
+        statement = update(table).where(*cls.by_id(by_id))
+        if versions is not None:
+            statement = statement.where(table.c.version.in_(versions))
+        if values:
+            statement = statement.where(
+                tuple_(*(table.c[name] for name in values)).is_distinct_from(tuple_(*values.values()))
+            )
+        statement = statement.values(
+            **values, version=table.c.version + 1, updated_at=now
+        ).returning(*table.c)
+
+        try:
+            row = db.session.execute(statement, bind_arguments=shard_bind(by_id)).first() if values else None
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error patching record: %s", by_id)
+            raise DataValidationError(e) from e
+        if row is not None:
+            return row, True
+
+        # Nothing matched: find out whether the row is missing, stale or unchanged
+        row = cls.find_row(by_id, uuid_text=False)
+        if row is not None and versions is not None and row.version not in versions:
+            raise VersionConflictError(
+                f"Promotion with id '{by_id}' is at version {row.version}."
+            )
+        return row, False
+
     @classmethod
     def all(cls):
         """Returns all of the Promotions in the database"""
         logger.info("Processing all Promotions")
-        return cls.query.all()
+        shards = get_shards()
+        if shards is None:
+            return cls.query.all()
+        return [
+            promotion
+            for engine in shards.engines.values()
+            for promotion in db.session.scalars(select(cls), bind_arguments={"bind": engine})
+        ]
 
     @classmethod
     def find(cls, by_id):
         """Finds a Promotion by it's ID"""
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.session.get(cls, by_id)
+        return db.session.scalars(select(cls).where(*cls.by_id(by_id)), bind_arguments=shard_bind(by_id)).first()
+
+    @classmethod
+    def by_id(cls, by_id) -> tuple:
+        """
+        Returns the conditions matching a Promotion by id
+
+        The end_date of the id is read from promotion_key, so the query only
+        reads the partition of the promotion instead of probing them all.
+        """
+        end_date = select(promotion_key.c.end_date).where(promotion_key.c.id == by_id).scalar_subquery()
+        return cls.__table__.c.id == by_id, cls.__table__.c.end_date == end_date
+
+    @classmethod
+    def _row_columns(cls, uuid_text: bool = True) -> list:
+        """Returns the columns of the read-only rows, with UUIDs rendered as text by the database"""
+        return [
+            column.cast(Text).label(column.name) if uuid_text and isinstance(column.type, UUID) else column
+            for column in cls.__table__.c
+        ]
+
+    @classmethod
+    def select_row(cls, by_id, uuid_text: bool = True) -> Select:
+        """Returns the SELECT of the read-only row of a Promotion, shared by the sync and async readers"""
+        return select(*cls._row_columns(uuid_text)).where(*cls.by_id(by_id))
+
+    @classmethod
+    def select_rows(cls, filters: dict, columns: tuple | None = None, uuid_text: bool = True) -> Select:
+        """Returns the SELECT of the read-only rows matching the filters, shared by the sync and async readers"""
+        selected = [column for column in cls._row_columns(uuid_text) if columns is None or column.name in columns]
+        return cls.find_by_filters(select(*selected), filters)
+
+    @classmethod
+    def find_row(cls, by_id, uuid_text: bool = True):
+        """
+        Finds a Promotion by its ID as a read-only row
+
+        The row is a plain Core result, so no ORM instance, identity map
+        entry or change tracking is created for it. UUIDs are returned as
+        text unless uuid_text is False.
+        """
+        logger.info("Processing row lookup for id %s ...", by_id)
+        return db.session.execute(cls.select_row(by_id, uuid_text), bind_arguments=shard_bind(by_id)).first()
+
+    @classmethod
+    def stream_rows(
+        cls, filters: dict, batch_size: int = 1000, columns: tuple | None = None, uuid_text: bool = True
+    ) -> Iterator[list]:
+        """
+        Streams the Promotions matching the filters as batches of read-only rows
+
+        The query runs right away, then the rows come from a server-side cursor
+        batch_size at a time, so only one batch is held in memory however many
+        rows match. Sharded promotions are read from every shard at once and
+        come sorted by id.
+
+        Args:
+            filters (dict): parsed filter values as accepted by find_by_filters
+            batch_size (int): the number of rows fetched per round trip
+            columns (tuple, optional): the names of the columns to select, all of them when None
+            uuid_text (bool): return UUIDs as text rather than UUID objects
+        """
+        logger.info("Processing row stream for %s ...", filters)
+        shards = get_shards()
+        if shards is not None:
+            # The merge needs the id of every row, the serializer leaves it out when it was not asked for
+            if columns is not None and "id" not in columns:
+                columns = (*columns, "id")
+            statement = cls.select_rows(filters, columns, uuid_text).order_by(cls.__table__.c.id)
+            return shards.fan_out(statement, batch_size, key=attrgetter("id"))
+        statement = cls.select_rows(filters, columns, uuid_text)
+        result = db.session.execute(statement.execution_options(yield_per=batch_size))
+        return result.partitions()
+
+    @classmethod
+    def _stored_ids(cls, external_ids: list, batch_size: int) -> dict:
+        """Returns the ids of the promotions stored with the external_ids, looked up on every shard"""
+        statement = select(promotion_key.c.id, promotion_key.c.external_id).where(
+            promotion_key.c.external_id.in_(external_ids)
+        )
+        batches = get_shards().fan_out(statement.order_by(promotion_key.c.id), batch_size, key=attrgetter("id"))
+        return {row.external_id: row.id for batch in batches for row in batch}
+
+    @classmethod
+    def _upsert_groups(cls, values: list) -> list:
+        """Pairs the bind arguments of every shard with the rows to upsert there, the primary unsharded"""
+        shards = get_shards()
+        if shards is None:
+            return [(None, values)]
+        return [
+            ({"bind": shards.engines[name]}, group)
+            for name, group in shards.split(values, key=lambda row: row["id"]).items()
+        ]
+
+    @classmethod
+    def _reserve_keys(cls, batch: list, bind_arguments: dict | None) -> dict:
+        """
+        Reserves the keys of the external_ids of a batch in promotion_key
+
+        The keys of the new external_ids are inserted with an INSERT ... ON
+        CONFLICT DO NOTHING, and the ones already stored are locked FOR SHARE
+        rather than rewritten, so an unchanged promotion gets no new row
+        version. Two upserts of a new external_id wait for each other rather
+        than both inserting it, and a stored promotion cannot move to another
+        partition until the upsert commits. The key of a new external_id has
+        no end_date yet.
+
+        Returns:
+            dict: the id and stored end_date of every external_id, None for the new ones
+        """
+        columns = (promotion_key.c.external_id, promotion_key.c.id, promotion_key.c.end_date)
+        ids = {row["external_id"]: row["id"] for row in batch}
+        keys = {}
+        # Sorted, so concurrent upserts take the locks in the same order. A key
+        # deleted between the conflict and the lock is inserted on the next round
+        while missing := sorted(ids.keys() - keys.keys()):
+            inserted = (
+                insert(promotion_key)
+                .values([{"id": ids[external_id], "external_id": external_id} for external_id in missing])
+                .on_conflict_do_nothing(index_elements=[promotion_key.c.external_id])
+                .returning(*columns)
+            )
+            keys.update((row.external_id, row) for row in db.session.execute(inserted, bind_arguments=bind_arguments))
+            stored = [external_id for external_id in missing if external_id not in keys]
+            if stored:
+                locked = (
+                    select(*columns)
+                    .where(promotion_key.c.external_id.in_(stored))
+                    .order_by(promotion_key.c.external_id)
+                    .with_for_update(read=True)
+                )
+                keys.update((row.external_id, row) for row in db.session.execute(locked, bind_arguments=bind_arguments))
+        return keys
+
+    @classmethod
+    def _update_statement(cls, now: datetime):
+        """Builds an UPDATE by id and stored end_date, run once per row, that only updates changed rows"""
+        table = cls.__table__
+        changed = [name for name in cls.UPSERT_COLUMNS if name not in ("external_id", "created_by")]
+        values = {name: bindparam(f"new_{name}", type_=table.c[name].type) for name in changed}
+        values["schedule_override"] = cls._schedule_override_value(
+            values["active_status"], values["start_date"], values["end_date"], now
+        )
+        return update(table).where(
+            table.c.id == bindparam("new_id", type_=table.c.id.type),
+            table.c.end_date == bindparam("stored_end_date", type_=table.c.end_date.type),
+            tuple_(*(table.c[name] for name in values)).is_distinct_from(tuple_(*values.values())),
+        ).values({**values, "updated_at": now, "version": table.c.version + 1})
+
+    @classmethod
+    def _upsert_batch(cls, batch: list, now: datetime, bind_arguments: dict | None) -> tuple[int, int]:
+        """Inserts the new rows of a batch and updates the stored ones, returning both counts"""
+        keys = cls._reserve_keys(batch, bind_arguments)
+        new = [
+            dict(
+                row,
+                id=keys[row["external_id"]].id,
+                created_at=now,
+                updated_at=now,
+                version=1,
+                schedule_override=cls._overrides_schedule(
+                    row["active_status"], row["start_date"], row["end_date"], False, now
+                ),
+            )
+            for row in batch
+            if keys[row["external_id"]].end_date is None
+        ]
+        if new:
+            db.session.execute(insert(cls.__table__).values(new), bind_arguments=bind_arguments)
+        existing = [
+            {
+                **{f"new_{name}": value for name, value in row.items()},
+                "new_id": keys[row["external_id"]].id,
+                "stored_end_date": keys[row["external_id"]].end_date,
+            }
+            for row in batch
+            if keys[row["external_id"]].end_date is not None
+        ]
+        updated = 0
+        if existing:
+            updated = db.session.execute(cls._update_statement(now), existing, bind_arguments=bind_arguments).rowcount
+        return len(new), updated
+
+    @classmethod
+    def _upsert_rows(cls, payloads: list) -> dict:
+        """Validates the promotions to upsert, returning their column values by external_id"""
+        if not isinstance(payloads, list):
+            raise DataValidationError("Invalid request: body must be a list of promotions")
+        rows = {}
+        for data in payloads:
+            promotion = cls().deserialize(data)
+            if promotion.external_id is None:
+                raise DataValidationError("Invalid Promotion: missing external_id")
+            # one row per external_id, so the last copy wins
+            rows[promotion.external_id] = {
+                name: getattr(promotion, name) for name in cls.UPSERT_COLUMNS
+            }
+        return rows
+
+    @classmethod
+    def upsert(cls, payloads: list, batch_size: int = 1000) -> dict:
+        """
+        Inserts or updates Promotions keyed by their external_id
+
+        Every batch first reserves the keys of its external_ids in
+        promotion_key with an INSERT ... ON CONFLICT DO NOTHING, and locks the
+        ones already stored FOR SHARE, then inserts the new promotions and updates the others
+        in the partition of their stored end_date. Rows whose content did not
+        change are skipped by the WHERE clause of the update, so they cost no
+        write and keep their updated_at. Sharded, every shard has its own
+        promotion_key, so the ids are looked up on every shard first under a
+        lock serializing the sharded upserts.
+
+        Args:
+            payloads (list): the promotions to upsert, as accepted by deserialize
+            batch_size (int): the number of rows per INSERT statement
+
+        Returns:
+            dict: the number of inserted, updated and unchanged promotions
+        """
+        rows = cls._upsert_rows(payloads)
+        logger.info("Processing upsert of %d promotions ...", len(rows))
+
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        now = utc_now()
+        try:
+            stored = {}
+            if get_shards() is not None:
+                db.session.execute(select(func.pg_advisory_xact_lock(UPSERT_LOCK)))
+                stored = cls._stored_ids(list(rows), batch_size)
+            for row in rows.values():
+                row["id"] = stored.get(row["external_id"]) or uuid7()
+            for bind_arguments, values in cls._upsert_groups(list(rows.values())):
+                for start in range(0, len(values), batch_size):
+                    batch = values[start:start + batch_size]
+                    inserted, updated = cls._upsert_batch(batch, now, bind_arguments)
+                    counts["inserted"] += inserted
+                    counts["updated"] += updated
+                    counts["unchanged"] += len(batch) - inserted - updated
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error upserting records: %s", e)
+            raise DataValidationError(e) from e
+        return counts
 
     @classmethod
     def find_by_name(cls, query, name) -> Query:
@@ -211,7 +854,8 @@ class Promotion(db.Model):
         """
 
         logger.info("Processing product ID query for %s ...", product_id)
-        return query.filter(func.jsonb_exists(cls.product_ids, product_id))
+        # The ? operator, unlike the jsonb_exists function, can use ix_promotion_product_ids
+        return query.filter(cls.product_ids.has_key(product_id))
 
     @classmethod
     def find_by_start_date(
@@ -307,3 +951,39 @@ class Promotion(db.Model):
         """
         logger.info("Processing updater query for user_id=%s ...", user_id)
         return query.filter(cls.updated_by == user_id)
+
+    @classmethod
+    def find_by_filters(cls, query, filters: dict) -> Query:
+        """
+        Applies every find_by_* filter named in a dictionary of parsed values
+
+        Args:
+            query (Query): the query (or select) to filter
+            filters (dict): the parsed filter values keyed by query parameter name,
+                filters with a value of None are skipped
+        """
+        start_date = filters.get("start_date")
+        end_date = filters.get("end_date")
+
+        if start_date and end_date:
+            query = cls.find_by_date_range(query, start_date, end_date)
+        elif start_date:
+            exact_match = filters.get("exact_match_start_date") or False
+            query = cls.find_by_start_date(query, start_date, exact_match=exact_match)
+        elif end_date:
+            exact_match = filters.get("exact_match_end_date") or False
+            query = cls.find_by_end_date(query, end_date, exact_match=exact_match)
+
+        filter_handlers = {
+            "name": cls.find_by_name,
+            "product_id": cls.find_by_product_id,
+            "active_status": cls.find_by_active_status,
+            "created_by": cls.find_by_creator,
+            "updated_by": cls.find_by_updater,
+        }
+
+        for key, handler in filter_handlers.items():
+            value = filters.get(key)
+            if value is not None:
+                query = handler(query, value)
+        return query
@@ -21,13 +21,25 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Promotion
 """
 
-from functools import wraps
+import re
+import uuid
+from functools import lru_cache, wraps
 from flask import abort, request
 from flask import current_app as app  # Import Flask application
 from flask_restx import Api, Resource, fields, reqparse, inputs
 from service.models import Promotion
 from service.common import status  # HTTP Status Codes
 from service.common.route_utils import parse_with_try
+from service.common.replicas import replica_reads
+from service.common.archive import get_archive
+from service.common.serializers import compile_serializer
+from service.common.encoders import (
+    output_json_array,
+    output_msgpack_stream,
+    loads_msgpack,
+    msgpack,
+    MSGPACK_MIMETYPE,
+)
 
 ######################################################################
 # Configure Swagger before initializing it
@@ -91,6 +103,23 @@ create_model = api.model(
             required=False,
             example={"key": "value"},
         ),
+        "external_id": fields.String(
+            required=False,
+            description="The unique key of the promotion in the upstream feed.",
+            example="feed-12345",
+        ),
+    },
+)
+
+# Define the API model for the result of a batch upsert
+upsert_result_model = api.model(
+    "UpsertResult",
+    {
+        "inserted": fields.Integer(description="The number of promotions inserted."),
+        "updated": fields.Integer(description="The number of promotions that changed."),
+        "unchanged": fields.Integer(
+            description="The number of promotions skipped because nothing changed."
+        ),
     },
 )
 
@@ -113,9 +142,41 @@ promotion_model = api.inherit(
             description="The timestamp when the promotion was last updated.",
             dt_format="iso8601",
         ),
+        "version": fields.Integer(
+            readOnly=True,
+            description="Incremented by every update, also sent in the ETag header.",
+        ),
+        "schedule_override": fields.Boolean(
+            readOnly=True,
+            description="Set by the deactivate action, or a write of active_status false once the promotion "
+                        "started, so the scheduler does not activate the promotion.",
+        ),
     },
 )
 
+# Fields of the presets of the list endpoint, see also ix_promotion_summary
+LIST_VIEWS = {
+    "summary": ("id", "name", "start_date", "end_date", "active_status"),
+}
+
+
+@lru_cache(maxsize=64)
+def promotion_serializer(many: bool = False, only: tuple | None = None, native: bool = False):
+    """
+    Returns the single pass serializer of ORM instances and rows into promotion_model,
+    compiled once per subset of the fields and per encoding
+    """
+    return compile_serializer(promotion_model, many=many, only=only, native=native)
+
+
+# Request bodies may be JSON, or MessagePack when msgpack is installed
+BODY_CONTENT_TYPES = ("application/json", MSGPACK_MIMETYPE) if msgpack else ("application/json",)
+
+
+# Response header telling the client an update was identical and nothing was written
+WRITE_SKIPPED_HEADER = "X-Write-Skipped"
+MERGE_PATCH_CONTENT_TYPE = "application/merge-patch+json"
+
 
 ######################################################################
 # Setup the request parser for promotions
@@ -159,18 +220,36 @@ for arg_name, arg_type, location, required, help_text in args_config:
         arg_name, type=arg_type, location=location, required=required, help=help_text
     )
 
+# Sparse fieldsets are not filters, so they stay out of args_config
+promotion_args.add_argument(
+    "fields", type=str, location="args", required=False,
+    help="Comma separated list of the fields to return",
+)
+promotion_args.add_argument(
+    "view", type=str, location="args", required=False, choices=tuple(LIST_VIEWS),
+    help="A preset list of fields to return, ignored when fields is set",
+)
+
+# The ids to look up in the archive, the id parameter can be repeated
+archive_args = reqparse.RequestParser()
+archive_args.add_argument(
+    "id", type=uuid.UUID, location="args", required=True, action="append",
+    help="The id of an archived Promotion, can be repeated",
+)
+
 
 ######################################################################
 # Content Type Check Decorator
 ######################################################################
-def require_content_type(content_type):
-    """Decorator to require a specific content type for this endpoint"""
+def require_content_type(*content_types):
+    """Decorator to require one of the given content types for this endpoint"""
+    content_type = " or ".join(content_types)
 
     def decorator(func):
         @wraps(func)
         def decorated_function(*args, **kwargs):
-            # Check if the Content-Type header matches the expected content type
-            if request.headers.get("Content-Type", "") != content_type:
+            # Check if the Content-Type header matches an expected content type
+            if request.headers.get("Content-Type", "") not in content_types:
                 app.logger.error(
                     "Invalid Content-Type: %s",
                     request.headers.get("Content-Type", "Content-Type not set"),
@@ -187,6 +266,108 @@ def require_content_type(content_type):
     return decorator
 
 
+######################################################################
+# Content Negotiation Helpers
+######################################################################
+def wants_msgpack() -> bool:
+    """Tells whether the client prefers a MessagePack response to JSON"""
+    return request.accept_mimetypes.best_match(api.representations) == MSGPACK_MIMETYPE
+
+
+def serialize_promotion(promotion) -> dict:
+    """Serializes a Promotion for the response format the client prefers"""
+    return promotion_serializer(native=wants_msgpack())(promotion)
+
+
+def request_payload():
+    """Returns the request body, decoded from MessagePack when it was sent as such"""
+    if request.mimetype == MSGPACK_MIMETYPE and msgpack:
+        return loads_msgpack(request.get_data())
+    return api.payload
+
+
+######################################################################
+# Sparse Fieldset Helpers
+######################################################################
+def requested_fields(args) -> tuple | None:
+    """
+    Returns the fields selected by the fields or view parameter in model order
+
+    None means every field. Aborts with 400 when a field does not exist.
+    """
+    if args.get("fields") is not None:
+        names = {name.strip() for name in args["fields"].split(",")} - {""}
+        unknown = names - set(promotion_model.resolved)
+        if unknown or not names:
+            abort(
+                status.HTTP_400_BAD_REQUEST,
+                f"Unknown fields: {', '.join(sorted(unknown))}" if unknown else "No fields requested",
+            )
+        return tuple(name for name in promotion_model.resolved if name in names)
+    if args.get("view"):
+        return LIST_VIEWS[args["view"]]
+    return None
+
+
+######################################################################
+# Conditional Request Helpers
+######################################################################
+# Each representation gets its own strong ETag: the version and the format
+ETAG_FORMATS = {"application/json": "json", MSGPACK_MIMETYPE: "msgpack"}
+ETAG_PATTERN = re.compile(rf"^(\d+)-(?:{'|'.join(ETAG_FORMATS.values())})$")
+
+
+def version_etag(version: int, mimetype: str = "application/json") -> str:
+    """Returns the ETag of a version of a Promotion in a media type"""
+    return f"{version}-{ETAG_FORMATS[mimetype]}"
+
+
+def etag_header(promotion) -> dict:
+    """Returns the ETag header of the representation of a Promotion the client gets"""
+    mimetype = MSGPACK_MIMETYPE if wants_msgpack() else "application/json"
+    return {"ETag": f'"{version_etag(promotion.version, mimetype)}"'}
+
+
+def if_match_versions(promotion_id) -> list | None:
+    """
+    Returns the versions named by the ETags in the If-Match header
+
+    The ETag of any representation names its version. None means any
+    version will do. Aborts with 428 when the header is required but
+    missing, and with 412 when it names no possible version.
+    """
+    if not request.if_match:
+        if app.config.get("REQUIRE_IF_MATCH"):
+            abort(
+                status.HTTP_428_PRECONDITION_REQUIRED,
+                "An If-Match header is required to change a Promotion",
+            )
+        return None
+    if request.if_match.star_tag:
+        return None
+    matches = (ETAG_PATTERN.match(tag) for tag in request.if_match.as_set(include_weak=True))
+    versions = [int(match.group(1)) for match in matches if match]
+    if not versions:
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"If-Match {request.if_match} names no version of Promotion '{promotion_id}'.",
+        )
+    return versions
+
+
+def check_if_match(promotion):
+    """Aborts with 412 when the If-Match header does not match the version of the Promotion"""
+    versions = if_match_versions(promotion.id)
+    if versions is not None and promotion.version not in versions:
+        app.logger.warning(
+            "If-Match %s does not match version %s", request.if_match, promotion.version
+        )
+        abort(
+            status.HTTP_412_PRECONDITION_FAILED,
+            f"Promotion with id '{promotion.id}' is at version {promotion.version}.",
+        )
+
+
 ######################################################################
 # Health Endpoint
 ######################################################################
@@ -228,7 +409,8 @@ class PromotionResource(Resource):
     # ------------------------------------------------------------------
     @api.doc("get_promotion")
     @api.response(404, "Promotion not found")
-    @api.marshal_with(promotion_model)
+    @api.response(200, "Success", promotion_model)
+    @replica_reads
     def get(self, promotion_id):
         """
         Retrieve a single Promotion
@@ -237,13 +419,13 @@ class PromotionResource(Resource):
         """
         app.logger.info("Request to Retrieve a promotion with id [%s]", promotion_id)
 
-        promotion = Promotion.find(promotion_id)
-        if not promotion:
+        row = Promotion.find_row(promotion_id, uuid_text=not wants_msgpack())
+        if not row:
             abort(
                 status.HTTP_404_NOT_FOUND,
                 f"Promotion with id '{promotion_id}' was not found.",
             )
-        return promotion.serialize(), status.HTTP_200_OK
+        return serialize_promotion(row), status.HTTP_200_OK, etag_header(row)
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PROMOTION
@@ -251,13 +433,16 @@ class PromotionResource(Resource):
     @api.doc("update_promotion")
     @api.response(404, "Promotion not found")
     @api.response(400, "The posted Promotion data was not valid")
+    @api.response(412, "The If-Match header does not match the current version")
     @api.expect(promotion_model)
-    @api.marshal_with(promotion_model)
+    @api.response(200, "Success", promotion_model)
     def put(self, promotion_id):
         """
         Update a Promotion
 
-        This endpoint will update a Promotion based the body that is posted
+        This endpoint will update a Promotion based the body that is posted.
+        When nothing changed no write happens and the X-Write-Skipped header is set.
+        An If-Match header with the ETag of the Promotion makes the update conditional.
         """
         app.logger.info("Request to Update a promotion with id [%s]", promotion_id)
         promotion = Promotion.find(promotion_id)
@@ -266,12 +451,50 @@ class PromotionResource(Resource):
                 status.HTTP_404_NOT_FOUND,
                 f"Promotion with id '{promotion_id}' was not found.",
             )
-        app.logger.debug("Payload = %s", api.payload)
-        data = api.payload
+        check_if_match(promotion)
+        data = request_payload()
+        app.logger.debug("Payload = %s", data)
         promotion.deserialize(data)
         promotion.id = promotion_id
-        promotion.update()
-        return promotion.serialize(), status.HTTP_200_OK
+        if not promotion.update():
+            app.logger.info("Promotion with id [%s] was unchanged", promotion_id)
+            headers = {**etag_header(promotion), WRITE_SKIPPED_HEADER: "true"}
+            return serialize_promotion(promotion), status.HTTP_200_OK, headers
+        return serialize_promotion(promotion), status.HTTP_200_OK, etag_header(promotion)
+
+    # ------------------------------------------------------------------
+    # PATCH AN EXISTING PROMOTION
+    # ------------------------------------------------------------------
+    @api.doc("patch_promotion")
+    @api.response(404, "Promotion not found")
+    @api.response(400, "The merge patch was not valid")
+    @api.response(412, "The If-Match header does not match the current version")
+    @api.response(415, "The Content-Type was not a JSON merge patch")
+    @api.response(200, "Success", promotion_model)
+    @require_content_type(MERGE_PATCH_CONTENT_TYPE, "application/json")
+    def patch(self, promotion_id):
+        """
+        Partially update a Promotion
+
+        The body is a JSON Merge Patch (RFC 7396): only the fields it contains
+        change, null removes an optional field and the keys of extra are merged.
+        The patch is applied with a single UPDATE without loading the Promotion.
+        When nothing changed no write happens and the X-Write-Skipped header is set.
+        """
+        app.logger.info("Request to Patch a promotion with id [%s]", promotion_id)
+        versions = if_match_versions(promotion_id)
+        app.logger.debug("Payload = %s", api.payload)
+        row, written = Promotion.patch(promotion_id, api.payload, versions)
+        if row is None:
+            abort(
+                status.HTTP_404_NOT_FOUND,
+                f"Promotion with id '{promotion_id}' was not found.",
+            )
+        if not written:
+            app.logger.info("Promotion with id [%s] was unchanged", promotion_id)
+            headers = {**etag_header(row), WRITE_SKIPPED_HEADER: "true"}
+            return serialize_promotion(row), status.HTTP_200_OK, headers
+        return serialize_promotion(row), status.HTTP_200_OK, etag_header(row)
 
     # ------------------------------------------------------------------
     # DELETE A PROMOTION
@@ -287,6 +510,7 @@ class PromotionResource(Resource):
         app.logger.info("Request to Delete a promotion with id [%s]", promotion_id)
         promotion = Promotion.find(promotion_id)
         if promotion:
+            check_if_match(promotion)
             promotion.delete()
             app.logger.info("Promotion with id [%s] was deleted", promotion_id)
             return "", status.HTTP_204_NO_CONTENT
@@ -308,61 +532,46 @@ class PromotionCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc("list_promotions")
     @api.expect(promotion_args, validate=True)
-    @api.marshal_list_with(promotion_model)
+    @api.response(200, "Success", [promotion_model])
+    @replica_reads
     def get(self):
-        """Returns all of the Promotions"""
+        """
+        Returns all of the Promotions
+
+        The fields parameter (or the view=summary preset) limits the fields
+        returned, and only those columns are read from the database.
+
+        With Accept: application/msgpack, the body is a MessagePack array of
+        at most LIST_BATCH_SIZE promotions, followed by one more array per
+        further batch: an empty list is an empty array.
+        """
         app.logger.info("Request to list promotions...")
-        promotions = []
         args = promotion_args.parse_args()
 
-        query = Promotion.query
+        # Date filters arrive as strings, anything unparsable is ignored
+        args["start_date"] = parse_with_try(args.get("start_date"))
+        args["end_date"] = parse_with_try(args.get("end_date"))
 
-        # Handle Date filtering
-        start_date = parse_with_try(args.get("start_date"))
-        end_date = parse_with_try(args.get("end_date"))
-
-        if start_date and end_date:
-            query = Promotion.find_by_date_range(query, start_date, end_date)
-        elif start_date:
-            exact_match = args.get("exact_match_start_date", False)
-            query = Promotion.find_by_start_date(
-                query, start_date, exact_match=exact_match
-            )
-        elif end_date:
-            exact_match = args.get("exact_match_end_date", False)
-            query = Promotion.find_by_end_date(query, end_date, exact_match=exact_match)
-
-        # Other filtering
-        filter_handlers = {
-            "name": lambda val: Promotion.find_by_name(query, val),
-            "product_id": lambda val: Promotion.find_by_product_id(query, val),
-            "active_status": lambda val: Promotion.find_by_active_status(query, val),
-            "created_by": lambda val: Promotion.find_by_creator(query, user_id=val),
-            "updated_by": lambda val: Promotion.find_by_updater(query, user_id=val),
-        }
-
-        for key, handler in filter_handlers.items():
-            value = args.get(key)  # This will use None if the key isn't present
-            if value is not None:
-                app.logger.info(f"Applying filter by {key}: {value}")
-                query = handler(value)
-
-        promotions = query.all()
-        results = [promotion.serialize() for promotion in promotions]
-        return results, status.HTTP_200_OK
+        only = requested_fields(args)
+        native = wants_msgpack()
+        serialize = promotion_serializer(True, only, native)
+        batches = Promotion.stream_rows(args, app.config["LIST_BATCH_SIZE"], only, uuid_text=not native)
+        if native:
+            return output_msgpack_stream(serialize(batch) for batch in batches)
+        return output_json_array(serialize(batch) for batch in batches)
 
     # ------------------------------------------------------------------
     # ADD A NEW PROMOTION
     # ------------------------------------------------------------------
     @api.doc(
         "create_promotions",
-        consumes="application/json",
+        consumes=list(BODY_CONTENT_TYPES),
         responses={415: "Unsupported Media Type"},
     )
     @api.response(400, "The posted data was not valid")
     @api.expect(create_model)
-    @api.marshal_with(promotion_model, code=201)
-    @require_content_type("application/json")
+    @api.response(201, "Promotion created", promotion_model)
+    @require_content_type(*BODY_CONTENT_TYPES)
     def post(self):
         """
         Create a Promotion
@@ -370,8 +579,9 @@ class PromotionCollection(Resource):
         """
         app.logger.info("Request to Create a Promotion")
         promotion = Promotion()
-        app.logger.debug("Payload = %s", api.payload)
-        promotion.deserialize(api.payload)
+        data = request_payload()
+        app.logger.debug("Payload = %s", data)
+        promotion.deserialize(data)
         promotion.create()
         app.logger.info("Promotion with new id [%s] created!", promotion.id)
         location_url = api.url_for(
@@ -379,12 +589,65 @@ class PromotionCollection(Resource):
         )
 
         return (
-            promotion.serialize(),
+            serialize_promotion(promotion),
             status.HTTP_201_CREATED,
-            {"Location": location_url},
+            {"Location": location_url, **etag_header(promotion)},
         )
 
 
+######################################################################
+#  PATH: /promotions:upsert
+######################################################################
+@api.route("/promotions:upsert")
+class PromotionUpsertCollection(Resource):
+    """Handles batch upserts of Promotions keyed by external_id"""
+
+    @api.doc(
+        "upsert_promotions",
+        consumes="application/json",
+        responses={415: "Unsupported Media Type"},
+    )
+    @api.response(400, "The posted data was not valid")
+    @api.expect([create_model])
+    @api.marshal_with(upsert_result_model)
+    @require_content_type("application/json")
+    def put(self):
+        """
+        Upsert a batch of Promotions
+
+        This endpoint will insert or update every Promotion in the posted list by
+        its external_id. Promotions that did not change are not written at all.
+        """
+        app.logger.info("Request to Upsert a batch of Promotions")
+        counts = Promotion.upsert(api.payload)
+        app.logger.info("Upserted promotions: %s", counts)
+        return counts, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/archive
+######################################################################
+@api.route("/promotions/archive")
+class PromotionArchiveCollection(Resource):
+    """Handles lookups of the Promotions moved to the archive"""
+
+    @api.doc("find_archived_promotions")
+    @api.expect(archive_args, validate=True)
+    @api.response(400, "An id was not valid")
+    @api.response(200, "Success", [promotion_model])
+    def get(self):
+        """
+        Returns the archived Promotions with the ids
+
+        The promotions that ended long ago are moved out of the database by
+        flask promotions-archive, and read back here from the archive files.
+        The ids that are not archived are left out.
+        """
+        args = archive_args.parse_args()
+        app.logger.info("Request to find %d archived promotions", len(args["id"]))
+        return get_archive().find(args["id"]), status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /promotions/{id}/activate
 ######################################################################
@@ -395,12 +658,14 @@ class ActivateResource(Resource):
 
     @api.doc("activate_promotions")
     @api.response(404, "Promotion not found")
+    @api.response(412, "The If-Match header does not match the current version")
     @api.response(200, "Promotion activated")
     def patch(self, promotion_id):
         """
         Activate a Promotion
 
-        This endpoint will activate a Promotion and make it active
+        This endpoint will activate a Promotion and make it active, and lets the
+        scheduler deactivate it at its end date
         """
         app.logger.info("Request to activate a Promotion")
         promotion = Promotion.find(promotion_id)
@@ -408,7 +673,9 @@ class ActivateResource(Resource):
             abort(
                 status.HTTP_404_NOT_FOUND, f"Promotion with id {promotion_id} not found"
             )
+        check_if_match(promotion)
         promotion.active_status = True
+        promotion.schedule_override = False
         promotion.update()
         app.logger.info("promotion with id [%s] has been activated!", promotion.id)
         return (
@@ -417,6 +684,7 @@ class ActivateResource(Resource):
                 "active_status": promotion.active_status,
             },
             status.HTTP_200_OK,
+            etag_header(promotion),
         )
 
 
@@ -430,12 +698,14 @@ class DeactivateResource(Resource):
 
     @api.doc("deactivate_promotions")
     @api.response(404, "Promotion not found")
+    @api.response(412, "The If-Match header does not match the current version")
     @api.response(200, "Promotion deactivated")
     def patch(self, promotion_id):
         """
         Deactivate a Promotion
 
-        This endpoint will deactivate a Promotion and make it non-active
+        This endpoint will deactivate a Promotion and make it non-active, and keeps
+        the scheduler from activating it at its start date
         """
         app.logger.info("Request to deactivate a Promotion")
         promotion = Promotion.find(promotion_id)
@@ -443,7 +713,9 @@ class DeactivateResource(Resource):
             abort(
                 status.HTTP_404_NOT_FOUND, f"Promotion with id {promotion_id} not found"
             )
+        check_if_match(promotion)
         promotion.active_status = False
+        promotion.schedule_override = True
         promotion.update()
         app.logger.info("promotion with id [%s] has been deactivated!", promotion.id)
 
@@ -453,4 +725,5 @@ class DeactivateResource(Resource):
                 "active_status": promotion.active_status,
             },
             status.HTTP_200_OK,
+            etag_header(promotion),
         )
@@ -34,3 +34,4 @@ class PromotionFactory(factory.Factory):
         "promotion_type": "description",
         "value": None,
     }
+    schedule_override = False
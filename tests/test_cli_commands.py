@@ -20,6 +20,12 @@ CLI Command Extensions for Flask
 
 # pylint: disable=duplicate-code
 import os
+import csv
+import gzip
+import json
+import logging
+import tempfile
+from datetime import datetime
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
@@ -27,6 +33,11 @@ from click.testing import CliRunner
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
 from service.common.cli_commands import db_create  # noqa: E402
+from service.common.bulk import generate_promotions, copy_promotions, COLUMNS
+from service.models import db, Promotion
+
+UUID_1 = "a4d8fca2-dc0f-4c68-8f73-dcd8fca9e6d3"
+UUID_2 = "b4d8fca2-dc0f-4c68-8f73-dcd8fca9e6d3"
 
 
 class TestFlaskCLI(TestCase):
@@ -42,3 +53,223 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+
+######################################################################
+#  B U L K   C O M M A N D   T E S T   C A S E S
+######################################################################
+class TestBulkCommands(TestCase):
+    """Bulk data CLI Command Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        db.session.close()
+
+    def setUp(self):
+        """This runs before each test"""
+        self.runner = app.test_cli_runner()
+        db.session.query(Promotion).delete()  # clean up the last tests
+        db.session.commit()
+
+    def tearDown(self):
+        """This runs after each test"""
+        db.session.remove()
+
+    def test_generate_promotions_is_deterministic(self):
+        """It should generate the same promotions for the same seed"""
+        first = list(generate_promotions(10, seed=7))
+        second = list(generate_promotions(10, seed=7))
+        other = list(generate_promotions(10, seed=8))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+
+    def test_generate_promotions_overlap(self):
+        """It should draw product ids from a shared pool when overlap is 1"""
+        promotions = list(generate_promotions(50, products=4, overlap=1.0))
+        product_ids = {pid for promotion in promotions for pid in promotion["product_ids"]}
+        self.assertTrue(all(len(promotion["product_ids"]) == 4 for promotion in promotions))
+        self.assertLessEqual(len(product_ids), 40)
+
+        promotions = list(generate_promotions(50, products=4, overlap=0.0))
+        product_ids = {pid for promotion in promotions for pid in promotion["product_ids"]}
+        self.assertEqual(len(product_ids), 200)
+
+    def test_db_seed(self):
+        """It should load generated promotions with the db-seed command"""
+        result = self.runner.invoke(
+            args=["db-seed", "--count", "25", "--batch-size", "10", "--seed", "3"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Loaded 25 promotions", result.output)
+        self.assertEqual(Promotion.query.count(), 25)
+
+        expected = next(generate_promotions(1, seed=3))
+        promotion = Promotion.find(expected["id"])
+        self.assertIsNotNone(promotion)
+        self.assertEqual(promotion.name, expected["name"])
+        self.assertEqual(promotion.product_ids, expected["product_ids"])
+        self.assertEqual(promotion.extra, expected["extra"])
+        self.assertEqual(promotion.start_date, expected["start_date"])
+
+    def test_db_seed_rolls_back_failed_batch(self):
+        """It should not keep a batch that fails to load"""
+        result = self.runner.invoke(args=["db-seed", "--count", "5", "--seed", "1"])
+        self.assertEqual(result.exit_code, 0)
+        # loading the same seed again collides on the primary key
+        result = self.runner.invoke(args=["db-seed", "--count", "5", "--seed", "1"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertEqual(Promotion.query.count(), 5)
+
+    def test_promotions_export_ndjson(self):
+        """It should export every promotion as NDJSON"""
+        copy_promotions(generate_promotions(20, seed=5))
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "promotions.ndjson")
+            result = self.runner.invoke(args=["promotions-export", "-o", path, "--batch-size", "7"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(path, encoding="utf-8") as stream:
+                records = [json.loads(line) for line in stream]
+        self.assertEqual(len(records), 20)
+        expected = {str(promotion["id"]) for promotion in generate_promotions(20, seed=5)}
+        self.assertEqual({record["id"] for record in records}, expected)
+        self.assertEqual(records[0], Promotion.find(records[0]["id"]).serialize())
+
+    def test_promotions_export_csv_gzip(self):
+        """It should export filtered promotions as gzipped CSV"""
+        copy_promotions(generate_promotions(30, seed=6))
+        active = Promotion.query.filter(Promotion.active_status.is_(True)).count()
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "promotions.csv.gz")
+            result = self.runner.invoke(
+                args=["promotions-export", "--format", "csv", "--filter", "active_status=true", "-o", path]
+            )
+            self.assertEqual(result.exit_code, 0, result.output)
+            with gzip.open(path, "rt", encoding="utf-8", newline="") as stream:
+                rows = list(csv.DictReader(stream))
+        self.assertEqual(len(rows), active)
+        for row in rows:
+            self.assertEqual(row["active_status"], "True")
+            self.assertIsInstance(json.loads(row["product_ids"]), list)
+
+    def test_promotions_export_date_filter(self):
+        """It should apply date filters the same way the list endpoint does"""
+        copy_promotions(generate_promotions(30, seed=7))
+        result = self.runner.invoke(
+            args=["promotions-export", "--filter", "start_date=2025-01-01", "--filter", "name=Seeded Promotion 3"]
+        )
+        self.assertEqual(result.exit_code, 0, result.output)
+        expected = Promotion.find_by_filters(
+            Promotion.query, {"start_date": datetime(2025, 1, 1), "name": "Seeded Promotion 3"}
+        ).count()
+        self.assertIn(f"Exported {expected} promotions", result.output)
+
+    def test_promotions_export_bad_filter(self):
+        """It should reject unknown or malformed filters"""
+        result = self.runner.invoke(args=["promotions-export", "--filter", "color=red"])
+        self.assertEqual(result.exit_code, 2)
+        result = self.runner.invoke(args=["promotions-export", "--filter", "active_status"])
+        self.assertEqual(result.exit_code, 2)
+        result = self.runner.invoke(args=["promotions-export", "--filter", "active_status=maybe"])
+        self.assertEqual(result.exit_code, 2)
+
+    def _export(self, path, *args):
+        """Exports every promotion to path"""
+        result = self.runner.invoke(args=["promotions-export", "-o", path, *args])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+    def test_promotions_import_round_trip(self):
+        """It should reload an NDJSON export"""
+        copy_promotions(generate_promotions(20, seed=9))
+        expected = sorted((p.serialize() for p in Promotion.all()), key=lambda p: p["id"])
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "promotions.ndjson")
+            self._export(path)
+            Promotion.query.delete()
+            db.session.commit()
+            result = self.runner.invoke(args=["promotions-import", path, "--batch-size", "6"])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("Imported 20 promotions", result.output)
+            self.assertFalse(os.path.exists(path + ".rejects.ndjson"))
+        found = sorted((p.serialize() for p in Promotion.all()), key=lambda p: p["id"])
+        self.assertEqual(found, expected)
+
+    def test_promotions_import_csv_upsert(self):
+        """It should update existing promotions from a gzipped CSV export"""
+        copy_promotions(generate_promotions(10, seed=10))
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "promotions.csv.gz")
+            self._export(path, "--format", "csv")
+            Promotion.query.update({Promotion.name: "Changed"})
+            db.session.commit()
+            result = self.runner.invoke(args=["promotions-import", path])
+            self.assertEqual(result.exit_code, 0, result.output)
+        db.session.expire_all()
+        self.assertEqual(Promotion.query.count(), 10)
+        self.assertEqual(Promotion.query.filter(Promotion.name == "Changed").count(), 0)
+        self.assertEqual({promotion.version for promotion in Promotion.all()}, {2})
+
+    def test_promotions_import_rejects(self):
+        """It should write invalid lines to the rejects file and load the rest"""
+        good = Promotion(**next(generate_promotions(1, seed=11))).serialize()
+        duplicate = dict(good, name="Last copy wins")
+        missing_name = {key: value for key, value in good.items() if key != "name"}
+        bad_status = dict(good, id=None, active_status="maybe")
+        lines = [json.dumps(good), "{not json", json.dumps(missing_name), "",
+                 json.dumps(bad_status), json.dumps([1, 2]), json.dumps(duplicate)]
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "promotions.ndjson")
+            with open(path, "w", encoding="utf-8") as stream:
+                stream.write("\n".join(lines) + "\n")
+            result = self.runner.invoke(args=["promotions-import", path])
+            self.assertEqual(result.exit_code, 0, result.output)
+            self.assertIn("rejected lines are in", result.output)
+            with open(path + ".rejects.ndjson", encoding="utf-8") as stream:
+                rejects = [json.loads(line) for line in stream]
+        self.assertEqual([reject["line"] for reject in rejects], [2, 3, 5, 6])
+        self.assertIn("missing name", rejects[1]["error"])
+        self.assertIn("active_status must be a boolean", rejects[2]["error"])
+        self.assertEqual(Promotion.query.count(), 1)
+        self.assertEqual(Promotion.find(good["id"]).name, "Last copy wins")
+
+    def test_promotions_import_csv_rejects(self):
+        """It should validate CSV columns and normalize aware timestamps to UTC"""
+        header = ",".join(COLUMNS)
+        user = "d8e8fca2-dc0f-4c68-8f73-dcd8fca9e6d3"
+        good = f'{UUID_1},"[""p1""]",Good,,2024-01-01T02:00:00+02:00,2024-02-01T00:00:00,TRUE,{user},{user},,,'
+        bad_json = f"{UUID_2},[oops,Bad,,2024-01-01T00:00:00,2024-02-01T00:00:00,false,{user},{user},,,"
+        bad_date = f"{UUID_2},,Bad,,2024-01-01T00:00:00,2024-02-01T00:00:00,false,{user},{user},yesterday,,"
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "promotions.csv")
+            with open(path, "w", encoding="utf-8") as stream:
+                stream.write("\n".join([header, good, bad_json, bad_date]) + "\n")
+            result = self.runner.invoke(args=["promotions-import", path, "--rejects", os.path.join(folder, "r.ndjson")])
+            self.assertEqual(result.exit_code, 0, result.output)
+            with open(os.path.join(folder, "r.ndjson"), encoding="utf-8") as stream:
+                rejects = [json.loads(line) for line in stream]
+        self.assertEqual([reject["line"] for reject in rejects], [3, 4])
+        promotion = Promotion.find(UUID_1)
+        self.assertEqual(promotion.start_date, datetime(2024, 1, 1))
+        self.assertIsNone(promotion.description)
+        self.assertTrue(promotion.active_status)
+        self.assertEqual(promotion.product_ids, ["p1"])
+
+    @patch("service.common.bulk._copy_batch")
+    def test_promotions_import_failed_batch(self, copy_mock):
+        """It should roll back and fail when a batch cannot be merged"""
+        copy_mock.side_effect = RuntimeError("COPY failed")
+        good = Promotion(**next(generate_promotions(1, seed=12))).serialize()
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "promotions.ndjson")
+            with open(path, "w", encoding="utf-8") as stream:
+                stream.write(json.dumps(good) + "\n")
+            result = self.runner.invoke(args=["promotions-import", path])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertEqual(Promotion.query.count(), 0)
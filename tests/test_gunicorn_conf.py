@@ -0,0 +1,117 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the gunicorn configuration
+"""
+
+import os
+import runpy
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+from gunicorn.util import load_class
+from wsgi import app
+from service.models import db
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(__file__)), "gunicorn.conf.py")
+
+
+def load_config(**env) -> dict:
+    """Loads gunicorn.conf.py with only the given GUNICORN_ variables set"""
+    environ = {key: value for key, value in os.environ.items() if not key.startswith("GUNICORN_")}
+    with patch.dict(os.environ, {**environ, **env}, clear=True):
+        return runpy.run_path(CONFIG)
+
+
+######################################################################
+#  G U N I C O R N   C O N F I G   T E S T   C A S E S
+######################################################################
+class TestGunicornConfig(TestCase):
+    """Gunicorn Configuration Tests"""
+
+    def test_half_cpu_profiles(self):
+        """It should size every profile for a 0.5 CPU pod"""
+        expected = {
+            "sync": ("sync", 2, 1, True),
+            "gthread": ("gthread", 1, 8, True),
+            "gevent": ("gevent", 1, 1, False),
+            "asgi": ("uvicorn_worker.UvicornWorker", 1, 1, True),
+        }
+        for profile, settings in expected.items():
+            config = load_config(GUNICORN_PROFILE=profile, GUNICORN_CPU_LIMIT="500")
+            self.assertEqual(
+                (config["worker_class"], config["workers"], config["threads"], config["preload_app"]), settings, profile
+            )
+        self.assertEqual(load_config(GUNICORN_PROFILE="asgi")["wsgi_app"], "asgi:app")
+
+    def test_worker_classes(self):
+        """It should find the worker class of every profile among the installed packages"""
+        for profile in load_config()["PROFILES"]:
+            worker_class = load_config(GUNICORN_PROFILE=profile)["worker_class"]
+            self.assertTrue(callable(load_class(worker_class, section="gunicorn.workers")), profile)
+
+    def test_defaults(self):
+        """It should default to the gthread profile with keep-alive and jittered restarts"""
+        config = load_config(GUNICORN_CPU_LIMIT="2000", PORT="9000")
+        self.assertEqual(config["worker_class"], "gthread")
+        self.assertEqual(config["workers"], 4)
+        self.assertEqual(config["wsgi_app"], "wsgi:app")
+        self.assertEqual(config["bind"], "0.0.0.0:9000")
+        self.assertEqual(config["max_requests"], 1000)
+        self.assertEqual(config["max_requests_jitter"], 100)
+        self.assertEqual(config["keepalive"], 75)
+
+    def test_overrides(self):
+        """It should let every setting be overridden from the environment"""
+        config = load_config(
+            GUNICORN_PROFILE="sync", GUNICORN_WORKERS="5", GUNICORN_THREADS="2", GUNICORN_PRELOAD="false",
+            GUNICORN_TIMEOUT="60", GUNICORN_BIND="127.0.0.1:8000",
+        )
+        self.assertEqual((config["workers"], config["threads"], config["timeout"]), (5, 2, 60))
+        self.assertFalse(config["preload_app"])
+        self.assertEqual(config["bind"], "127.0.0.1:8000")
+
+    def test_unknown_profile(self):
+        """It should refuse an unknown profile"""
+        self.assertRaises(ValueError, load_config, GUNICORN_PROFILE="eventlet")
+
+    def test_cpu_limit_from_cgroup(self):
+        """It should read the CPU limit from the cgroup, then from the CPU count"""
+        cpu_limit = load_config()["cpu_limit"]
+        with tempfile.TemporaryDirectory() as cgroup:
+            with open(os.path.join(cgroup, "cpu.max"), "w", encoding="ascii") as cpu_max:
+                cpu_max.write("50000 100000\n")
+            self.assertEqual(cpu_limit(cgroup), 0.5)
+            with open(os.path.join(cgroup, "cpu.max"), "w", encoding="ascii") as cpu_max:
+                cpu_max.write("max 100000\n")
+            self.assertEqual(cpu_limit(cgroup), float(os.cpu_count()))
+            self.assertEqual(cpu_limit(os.path.join(cgroup, "missing")), float(os.cpu_count()))
+
+    def test_post_fork_disposes_engines(self):
+        """It should replace the connection pools a preloaded app inherited"""
+        post_fork = load_config()["post_fork"]
+        with app.app_context():
+            pool = db.engine.pool
+        server = SimpleNamespace(cfg=SimpleNamespace(preload_app=False), app=SimpleNamespace(wsgi=lambda: app))
+        post_fork(server, None)
+        with app.app_context():
+            self.assertIs(db.engine.pool, pool)
+        server.cfg.preload_app = True
+        post_fork(server, None)
+        with app.app_context():
+            self.assertIsNot(db.engine.pool, pool)
@@ -0,0 +1,78 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the time-ordered ids
+"""
+
+import time
+import uuid
+from unittest import TestCase
+from unittest.mock import patch
+from service.common import ids
+from service.common.bulk import generate_promotions
+
+
+######################################################################
+#  I D   T E S T   C A S E S
+######################################################################
+class TestIds(TestCase):
+    """Version 7 UUID Tests"""
+
+    def test_version_7(self):
+        """It should make RFC 9562 version 7 UUIDs carrying the current time"""
+        before = time.time()
+        value = ids.uuid7()
+        self.assertEqual(value.version, 7)
+        self.assertEqual(value.variant, uuid.RFC_4122)
+        self.assertAlmostEqual(ids.uuid7_time(value), before, delta=1)
+        self.assertEqual(uuid.UUID(str(value)), value)
+
+    def test_increasing(self):
+        """It should make every id greater than the previous one"""
+        values = [ids.uuid7() for _ in range(10000)]
+        self.assertEqual(values, sorted(values))
+        self.assertEqual(len(set(values)), len(values))
+        self.assertEqual([str(value) for value in values], sorted(str(value) for value in values))
+
+    def test_clock_going_back(self):
+        """It should keep increasing when the clock goes back"""
+        first = ids.uuid7()
+        with patch("service.common.ids.time.time_ns", return_value=0):
+            second = ids.uuid7()
+        self.assertGreater(second, first)
+        self.assertEqual(ids.uuid7_time(second), ids.uuid7_time(first))
+
+    def test_counter_overflow(self):
+        """It should move to the next millisecond when the counter of a millisecond runs out"""
+        first = ids.uuid7()
+        ids._last["counter"] = ids.COUNTER_MAX  # pylint: disable=protected-access
+        with patch("service.common.ids.time.time_ns", return_value=0):
+            second = ids.uuid7()
+        self.assertGreater(second, first)
+        # The milliseconds, the seconds as floats are not exact
+        self.assertEqual(second.int >> 80, (first.int >> 80) + 1)
+
+    def test_layout(self):
+        """It should place the timestamp, counter and random bits where RFC 9562 puts them"""
+        value = ids.make_uuid7(0x0123_4567_89AB, (0xABC << 30) | 0x1234_5678, 0xDEAD_BEEF)
+        self.assertEqual(str(value), "01234567-89ab-7abc-9234-5678deadbeef")
+
+    def test_seeded_ids(self):
+        """It should seed promotions with increasing version 7 ids"""
+        seeded = [promotion["id"] for promotion in generate_promotions(100, seed=47)]
+        self.assertEqual(seeded, sorted(seeded))
+        self.assertEqual({value.version for value in seeded}, {7})
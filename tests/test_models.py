@@ -25,8 +25,9 @@ from unittest import TestCase
 from unittest.mock import patch
 from datetime import datetime, timedelta
 from uuid import UUID, uuid4
+from sqlalchemy import select, text, update
 from wsgi import app
-from service.models import Promotion, DataValidationError, db
+from service.models import Promotion, DataValidationError, VersionConflictError, db
 from .factories import PromotionFactory
 
 
@@ -98,6 +99,7 @@ class TestPromotion(TestCase):
         self.assertIsNotNone(
             promotion.id, "The promotion should have an ID after creation"
         )
+        self.assertEqual(promotion.id.version, 7)
 
         found = Promotion.all()
         self.assertEqual(
@@ -142,6 +144,71 @@ class TestPromotion(TestCase):
 
         self.assertEqual(updated_promotion.name, new_name)
 
+    def test_update_a_promotion_unchanged(self):
+        """It should not write a promotion whose values did not change"""
+        promotion = PromotionFactory()
+        promotion.create()
+        updated_at = promotion.updated_at
+
+        promotion.name = str(promotion.name)
+        self.assertFalse(promotion.update())
+        self.assertEqual(Promotion.find(promotion.id).updated_at, updated_at)
+
+        promotion.name = "Changed"
+        self.assertTrue(promotion.update())
+        self.assertGreater(Promotion.find(promotion.id).updated_at, updated_at)
+
+    def test_update_a_promotion_stale_version(self):
+        """It should raise a VersionConflictError when the promotion changed since it was read"""
+        promotion = PromotionFactory()
+        promotion.create()
+        self.assertEqual(promotion.version, 1)
+        db.session.execute(
+            update(Promotion.__table__).where(Promotion.id == promotion.id).values(version=2)
+        )
+
+        promotion.name = "Lost update"
+        with self.assertRaises(VersionConflictError):
+            promotion.update()
+
+        promotion = Promotion.find(promotion.id)
+        db.session.execute(
+            update(Promotion.__table__).where(Promotion.id == promotion.id).values(version=3)
+        )
+        with self.assertRaises(VersionConflictError):
+            promotion.delete()
+
+    def test_patch_a_promotion(self):
+        """It should patch a promotion with a single conditional UPDATE"""
+        promotion = PromotionFactory(extra=["not", "an", "object"], product_ids=None)
+        promotion.create()
+
+        row, written = Promotion.patch(promotion.id, {"extra": {"value": 1}, "product_ids": None}, [1])
+        self.assertTrue(written)
+        self.assertEqual(row.extra, {"value": 1})
+        self.assertEqual(row.product_ids, [])
+        self.assertEqual(row.version, 2)
+
+        row, written = Promotion.patch(promotion.id, {"extra": {"value": 1}})
+        self.assertFalse(written)
+        self.assertEqual(row.version, 2)
+        with self.assertRaises(VersionConflictError):
+            Promotion.patch(promotion.id, {"name": "Stale"}, [1])
+        self.assertEqual(Promotion.patch(uuid4(), {"name": "Nobody"}), (None, False))
+
+    def test_patch_a_promotion_database_error(self):
+        """It should raise a DataValidationError when a patch cannot be written"""
+        promotion = PromotionFactory()
+        promotion.create()
+        with self.assertRaises(DataValidationError):
+            Promotion.patch(promotion.id, {"external_id": "x" * 300})
+
+    def test_deserialize_patch_bad_data(self):
+        """It should not accept an invalid merge patch"""
+        for body in ("name", {"id": str(uuid4())}, {"end_date": None}, {"created_by": 5}):
+            with self.assertRaises(DataValidationError):
+                Promotion.deserialize_patch(body)
+
     def test_update_promotion_with_invalid_data(self):
         """It should raise an exception if the update fails"""
 
@@ -206,6 +273,20 @@ class TestPromotion(TestCase):
         self.assertEqual(promotion.created_by, UUID(CREATED_BY))
         self.assertEqual(promotion.updated_by, UUID(UPDATED_BY))
 
+    def test_promotion_deserialize_aware_dates(self):
+        """It should store timezone aware dates as naive UTC"""
+        data = {
+            "name": NAME,
+            "start_date": "2023-12-01T02:00:00+02:00",
+            "end_date": "2023-12-31T18:59:59-05:00",
+            "active_status": ACTIVE_STATUS,
+            "created_by": CREATED_BY,
+            "updated_by": UPDATED_BY,
+        }
+        promotion = Promotion().deserialize(data)
+        self.assertEqual(promotion.start_date, datetime.fromisoformat(START_DATE))
+        self.assertEqual(promotion.end_date, datetime.fromisoformat(END_DATE))
+
     def test_promotion_deserialize_missing_required_fields(self):
         """It should raise a DataValidationError when required fields are missing"""
 
@@ -248,6 +329,62 @@ class TestPromotion(TestCase):
             in str(context.exception)
         )
 
+    def test_promotion_deserialize_bad_name(self):
+        """It should raise a DataValidationError when the name is not a short string"""
+        data = {
+            "name": 12345,
+            "start_date": START_DATE,
+            "end_date": END_DATE,
+            "active_status": ACTIVE_STATUS,
+            "created_by": CREATED_BY,
+            "updated_by": UPDATED_BY,
+        }
+        with self.assertRaises(DataValidationError) as context:
+            Promotion().deserialize(data)
+        self.assertIn("name must be a string", str(context.exception))
+
+        data["name"] = "x" * 256
+        with self.assertRaises(DataValidationError) as context:
+            Promotion().deserialize(data)
+        self.assertIn("name must be at most 255 characters", str(context.exception))
+
+    def test_promotion_deserialize_bad_active_status(self):
+        """It should raise a DataValidationError when active_status is not a boolean"""
+        data = {
+            "name": NAME,
+            "start_date": START_DATE,
+            "end_date": END_DATE,
+            "active_status": "yes",
+            "created_by": CREATED_BY,
+            "updated_by": UPDATED_BY,
+        }
+        with self.assertRaises(DataValidationError) as context:
+            Promotion().deserialize(data)
+        self.assertIn("active_status must be a boolean", str(context.exception))
+
+    def test_promotion_deserialize_external_id(self):
+        """It should read the external_id and reject ones that are not strings"""
+        data = {
+            "name": NAME,
+            "start_date": START_DATE,
+            "end_date": END_DATE,
+            "active_status": ACTIVE_STATUS,
+            "created_by": CREATED_BY,
+            "updated_by": UPDATED_BY,
+            "external_id": "feed-1",
+        }
+        promotion = PromotionFactory().deserialize(data)
+        self.assertEqual(promotion.external_id, "feed-1")
+        self.assertEqual(promotion.serialize()["external_id"], "feed-1")
+
+        data["external_id"] = ""
+        self.assertIsNone(Promotion().deserialize(data).external_id)
+
+        data["external_id"] = 42
+        with self.assertRaises(DataValidationError) as context:
+            Promotion().deserialize(data)
+        self.assertIn("external_id must be a string", str(context.exception))
+
     def test_promotion_deserialize_valid_product_ids_string(self):
         """It should correctly parse a string of product IDs into a list"""
         data = {
@@ -319,6 +456,50 @@ class TestPromotion(TestCase):
         deserialized_promotion = promotion.deserialize(data)
         self.assertEqual(deserialized_promotion.product_ids, [])
 
+    def test_find_row(self):
+        """It should find a promotion as a read-only row outside the session"""
+        promotion = PromotionFactory()
+        promotion.create()
+        promotion_id, name = promotion.id, promotion.name
+        db.session.expunge_all()
+
+        row = Promotion.find_row(promotion_id)
+        self.assertEqual(row.id, str(promotion_id))
+        self.assertEqual(row.name, name)
+        self.assertEqual(row.version, 1)
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertIsNone(Promotion.find_row(uuid4()))
+
+    def test_stream_rows(self):
+        """It should stream the filtered promotions in batches of rows"""
+        for number in range(5):
+            PromotionFactory(name="Streamed" if number % 2 else "Other").create()
+        db.session.expunge_all()
+
+        batches = list(Promotion.stream_rows({}, batch_size=2))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        rows = list(Promotion.stream_rows({"name": "Streamed"}, batch_size=2))
+        self.assertEqual([row.name for batch in rows for row in batch], ["Streamed", "Streamed"])
+        self.assertEqual(len(db.session.identity_map), 0)
+
+    def test_stream_rows_columns(self):
+        """It should read only the requested columns, from the covering index for the summary"""
+        PromotionFactory().create()
+        summary = ("id", "name", "start_date", "end_date", "active_status")
+        rows = [row for batch in Promotion.stream_rows({}, columns=summary) for row in batch]
+        self.assertEqual(list(rows[0]._fields), ["id", "name", "start_date", "end_date", "active_status"])
+
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        db.session.execute(text("SET LOCAL enable_bitmapscan = off"))
+        columns = [column for column in Promotion._row_columns() if column.name in summary]
+        statement = Promotion.find_by_filters(select(*columns), {"start_date": datetime(2024, 1, 1)})
+        plan = db.session.execute(text("EXPLAIN " + str(statement.compile(
+            dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+        )))).scalars().all()
+        # Every partition has its copy of the index
+        self.assertRegex("\n".join(plan), r"Index Only Scan using \w+_ix_promotion_summary")
+        db.session.rollback()
+
     def test_find_by_name_success(self):
         """It should return promotions with the specified name"""
 
@@ -358,6 +539,16 @@ class TestPromotion(TestCase):
         found_promotions = Promotion.find_by_product_id(query, "nonexistent123").all()
         self.assertEqual(len(found_promotions), 0)
 
+    def test_find_by_product_id_uses_index(self):
+        """It should look up a product ID with the GIN index"""
+        statement = Promotion.find_by_product_id(Promotion.query, "prod123").statement
+        db.session.execute(text("SET LOCAL enable_seqscan = off"))
+        plan = db.session.execute(
+            text(f"EXPLAIN {statement.compile(db.engine, compile_kwargs={'literal_binds': True})}")
+        ).scalars().all()
+        db.session.rollback()
+        self.assertIn("ix_promotion_product_ids", "\n".join(plan))
+
     def test_find_by_start_date_exact_match(self):
         """It should find promotions that start exactly on a specified date when exact_match is True."""
         exact_start_date = datetime(2023, 12, 1)
@@ -0,0 +1,113 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Test cases for the compiled serializers
+"""
+
+# pylint: disable=duplicate-code
+import logging
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import TestCase
+from flask_restx import Model, fields, marshal
+from sqlalchemy import select
+
+# pylint: disable=unused-import
+from wsgi import app  # noqa: F401
+from service.common.serializers import compile_serializer
+from service.models import db, Promotion
+from service.routes import promotion_model
+from .factories import PromotionFactory
+
+
+######################################################################
+#  S E R I A L I Z E R   T E S T   C A S E S
+######################################################################
+class TestSerializers(TestCase):
+    """Compiled Serializer Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """This runs once before the entire test suite"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+        app.app_context().push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """This runs once after the entire test suite"""
+        db.session.close()
+
+    def setUp(self):
+        """This runs before each test"""
+        db.session.query(Promotion).delete()  # clean up the last tests
+        db.session.commit()
+
+    def test_serialize_like_marshal(self):
+        """It should serialize ORM instances and rows exactly like marshal"""
+        for _ in range(3):
+            PromotionFactory(description=None, extra=None).create()
+        promotions = Promotion.all()
+        rows = db.session.execute(select(*Promotion.__table__.columns)).all()
+        expected = marshal([promotion.serialize() for promotion in promotions], promotion_model)
+
+        serialize = compile_serializer(promotion_model)
+        self.assertEqual([serialize(promotion) for promotion in promotions], expected)
+        serialize_many = compile_serializer(promotion_model, many=True)
+        self.assertEqual(serialize_many(promotions), expected)
+        self.assertEqual(sorted(serialize_many(rows), key=lambda r: r["id"]), sorted(expected, key=lambda r: r["id"]))
+        self.assertEqual(list(serialize(promotions[0])), list(expected[0]))
+
+        serialize_many = compile_serializer(promotion_model, many=True, only=("name", "id"))
+        self.assertEqual(
+            serialize_many(promotions[:1]), [{"id": str(promotions[0].id), "name": promotions[0].name}]
+        )
+        self.assertEqual(compile_serializer(promotion_model, only=())(promotions[0]), {})
+
+        native = compile_serializer(promotion_model, native=True)(promotions[0])
+        self.assertEqual(native["id"], promotions[0].id)
+        self.assertEqual(native["start_date"], promotions[0].start_date)
+
+    def test_serialize_fallback_fields(self):
+        """It should fall back to the fields that have no fast path"""
+        model = Model(
+            "Fallback",
+            {
+                "label": fields.String(default="none"),
+                "when": fields.DateTime(dt_format="rfc822"),
+                "owner": fields.String(attribute="owner.name"),
+                "tags": fields.List(fields.String),
+                "child": fields.Nested(Model("Child", {"size": fields.Integer})),
+                "price": fields.Float,
+                "count": fields.Integer,
+            },
+        )
+        objects = [
+            SimpleNamespace(
+                label=None,
+                when=datetime(2024, 5, 1),
+                owner=SimpleNamespace(name="ann"),
+                tags=["a", 1],
+                child=SimpleNamespace(size="3"),
+                price=1,
+                count="7",
+            ),
+            SimpleNamespace(label="x", when=None, owner=None, tags=None, child=None, price=None, count=None),
+        ]
+        serialize = compile_serializer(model)
+        self.assertIn("field_0.output", serialize.source)
+        self.assertEqual([serialize(obj) for obj in objects], marshal(objects, model))